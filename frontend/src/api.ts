@@ -11,10 +11,16 @@ const api = axios.create({
   },
 });
 
+export interface MaterialTextRef {
+  hash: string;
+  length: number;
+}
+
 export interface ReadingMaterial {
   id: number;
   title: string;
   content: string;
+  text: MaterialTextRef;
   group: any;
   created_by: any;
   created_at: string;
@@ -51,9 +57,32 @@ export interface Annotation {
   color: string;
 }
 
-// API関数
-export const fetchReadingMaterial = (id: number) => 
-  api.get<ReadingMaterial>(`/materials/${id}/`);
+// 教材本文はハッシュで識別されて内容が変わらないので、一度取得したものは端末に保存して使い回す
+const TEXT_CACHE_PREFIX = 'material-text:';
+const textCache = new Map<string, string>();
+
+export const fetchMaterialText = async (hash: string): Promise<string> => {
+  const cached = textCache.get(hash) ?? localStorage.getItem(TEXT_CACHE_PREFIX + hash);
+  if (cached !== null && cached !== undefined) {
+    textCache.set(hash, cached);
+    return cached;
+  }
+  const { data } = await api.get<{ hash: string; length: number; content: string }>(`/texts/${hash}/`);
+  textCache.set(hash, data.content);
+  try {
+    localStorage.setItem(TEXT_CACHE_PREFIX + hash, data.content);
+  } catch {
+    // 保存容量を超えたらメモリ上のキャッシュだけを使う
+  }
+  return data.content;
+};
+
+// API関数（本文は含めずに取得し、ハッシュで端末のキャッシュから補う）
+export const fetchReadingMaterial = async (id: number) => {
+  const response = await api.get<ReadingMaterial>(`/materials/${id}/`, { params: { omit: 'content' } });
+  response.data.content = await fetchMaterialText(response.data.text.hash);
+  return response;
+};
 
 export const fetchQuestions = (materialId: number) => 
   api.get<Question[]>(`/materials/${materialId}/questions/`);
@@ -61,6 +90,25 @@ export const fetchQuestions = (materialId: number) =>
 export const submitAnswer = (answer: StudentAnswer) => 
   api.post('/answers/', answer);
 
+export interface AnswerDraft {
+  question: number;
+  answer_text: string;
+  reasoning_note: string;
+  citations?: any;
+  revision: number;
+}
+
+export interface AutosaveResult {
+  saved: { id: number; question: number; revision: number }[];
+  stale: number[];
+  // 破棄された下書きの問題の、保存済みの最新リビジョン
+  current: { question: number; revision: number }[];
+}
+
+// 複数の問題の下書きを1リクエストで保存（古いリビジョンはサーバー側で破棄）
+export const autosaveAnswers = (studentId: number, drafts: AnswerDraft[]) =>
+  api.post<AutosaveResult>('/answers/autosave/', { student: studentId, drafts });
+
 export const addAnnotation = (annotation: Annotation) => 
   api.post('/annotations/', annotation);
 
@@ -72,3 +120,168 @@ export default api;
 // 既存のAPI関数の後に追加
 export const deleteAnnotation = (id: number) => 
   api.delete(`/annotations/${id}/`);
+
+export interface AnnotationSyncRequest {
+  student: number;
+  material: number;
+  since?: string;
+  creates?: (Omit<Annotation, 'id' | 'student' | 'material'> & { client_id: string })[];
+  updates?: (Partial<Annotation> & { id: number })[];
+  deletes?: number[];
+}
+
+export interface AnnotationSyncResult {
+  created: { client_id: string; id: number }[];
+  updated: number[];
+  deleted: number[];
+  sync_token: string;
+  changes?: Annotation[];
+  ids?: number[];
+}
+
+// 前回同期以降の注釈の変更をまとめて送信
+export const syncAnnotations = (changes: AnnotationSyncRequest) =>
+  api.post<AnnotationSyncResult>('/annotations/sync/', changes);
+
+// 通知バッジ用の未読件数
+export const fetchUnreadCount = (userId: number) =>
+  api.get<{ unread: number }>(`/notifications/count/?user_id=${userId}`);
+
+export const markAllNotificationsRead = (userId: number) =>
+  api.post<{ updated: number; unread: number }>('/notifications/mark_all_read/', { user_id: userId });
+
+export interface SearchResult {
+  kind: 'material' | 'answer' | 'comment';
+  object_id: number;
+  material: number;
+  user: number | null;
+  rank: number;
+  snippet: string;
+  updated_at: string;
+}
+
+export interface SearchPage {
+  count: number;
+  next: string | null;
+  previous: string | null;
+  results: SearchResult[];
+}
+
+// 教材本文・回答・コメントの全文検索（関連度順）
+export const searchAll = (
+  q: string,
+  filters: { kind?: string; material_id?: number; group_id?: number; user_id?: number; page?: number } = {},
+) => api.get<SearchPage>('/search/', { params: { q, ...filters } });
+
+export interface TextSegment {
+  key: string;
+  position: number;
+  paragraph: number;
+  start: number;
+  end: number;
+  text: string;
+}
+
+export interface SegmentChunk {
+  material: number;
+  total: number;
+  from: number;
+  next: number | null;
+  segments: TextSegment[];
+}
+
+// 本文を文単位の区切りで少しずつ取得（長い本文の遅延読み込み）
+export const fetchSegments = (materialId: number, from = 0, limit = 50) =>
+  api.get<SegmentChunk>(`/materials/${materialId}/segments/`, { params: { from, limit } });
+
+export interface SegmentLocation {
+  offset: number;
+  key: string;
+  position: number;
+  paragraph: number;
+  offset_in_segment: number;
+}
+
+// 本文中の位置・注釈を区切りに変換
+export const locateOffsets = (materialId: number, params: { offsets?: string; student_id?: number; answer_id?: number }) =>
+  api.get<{
+    material: number;
+    offsets?: SegmentLocation[];
+    annotations?: { id: number; start: SegmentLocation; end: SegmentLocation }[];
+    citations?: { start: number; end: number; start_segment: SegmentLocation; end_segment: SegmentLocation }[];
+  }>(`/materials/${materialId}/locate/`, { params });
+
+export interface CitedPassage {
+  segment_key: string;
+  position: number;
+  start: number;
+  end: number;
+  text: string;
+  citation_count: number;
+  student_count: number;
+}
+
+// よく引用される文（定期的に更新される集計表から）
+export const fetchCitedPassages = (materialId: number, limit = 10) =>
+  api.get<{ material: number; refreshed_at: string | null; stale: boolean; passages: CitedPassage[] }>(
+    `/materials/${materialId}/cited_passages/`, { params: { limit } });
+
+export interface ActivityEvent {
+  at: string;
+  material: number;
+  type: 'answer_edit' | 'answer_patch' | 'answer_submit' | 'highlight' | 'sticky_note' | 'annotation_delete' | 'navigate';
+  question: number | null;
+  start: number | null;
+  end: number | null;
+  data: Record<string, unknown> | null;
+}
+
+// 問題の移動などクライアント側の操作をまとめて送る（サーバーはバッファに積むだけ）
+export const postActivity = (
+  studentId: number, materialId: number,
+  events: { type: 'navigate'; question?: number | null; position?: number | null; at?: string }[],
+) => api.post<{ accepted: number }>('/activity/', { student: studentId, material: materialId, events });
+
+// 学生の操作を時刻順に再構成する（授業の再生用）
+export const fetchActivitySession = (
+  studentId: number, params: { materialId?: number; since?: string; until?: string; limit?: number } = {},
+) =>
+  api.get<{
+    student: number;
+    material: number | null;
+    since: string;
+    until: string;
+    truncated: boolean;
+    counts: Record<string, number>;
+    sessions: { started_at: string; ended_at: string; event_count: number }[];
+    events: ActivityEvent[];
+  }>('/activity/', {
+    params: { student_id: studentId, material_id: params.materialId, since: params.since, until: params.until, limit: params.limit },
+  });
+
+export interface MaterialProgress {
+  id: number;
+  title: string;
+  question_count: number;
+  answered: number;
+  students_started: number;
+  completion: number;
+  comments: number;
+  unread_comments: number;
+}
+
+export interface GroupProgress {
+  id: number;
+  name: string;
+  student_count: number;
+  unread_comments: number;
+  materials: MaterialProgress[];
+}
+
+// 教員ダッシュボード（担当グループの教材ごとの完了率・未読コメント）
+export const fetchTeacherDashboard = (teacherId?: number) =>
+  api.get<{ teacher: number; groups: GroupProgress[] }>('/progress/', { params: { teacher_id: teacherId } });
+
+// 教材（と学生）のコメントを確認済みにする
+export const markProgressSeen = (materialId: number, studentId?: number) =>
+  api.post<{ updated: number }>('/progress/seen/', { material: materialId, student: studentId });
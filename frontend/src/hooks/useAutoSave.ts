@@ -1,5 +1,5 @@
 import { useEffect, useRef } from 'react';
-import { submitAnswer } from '../api';
+import { autosaveAnswers } from '../api';
 
 interface UseAutoSaveProps {
   studentId: number;
@@ -18,6 +18,8 @@ export const useAutoSave = ({
 }: UseAutoSaveProps) => {
   const timeoutRef = useRef<NodeJS.Timeout | null>(null);
   const lastSavedRef = useRef<string>('');
+  // サーバーで保存済みの最新リビジョン（端末の時刻が遅れていても、これより大きい値で送る）
+  const revisionRef = useRef<number>(0);
 
   useEffect(() => {
     const currentData = JSON.stringify({ answerText, reasoningNote });
@@ -36,15 +38,25 @@ export const useAutoSave = ({
     timeoutRef.current = setTimeout(async () => {
       try {
         if (answerText.trim() || reasoningNote.trim()) {
-          await submitAnswer({
-            student: studentId,
-            question: questionId,
-            answer_text: answerText,
-            reasoning_note: reasoningNote
-          });
-          
-          lastSavedRef.current = currentData;
-          console.log('回答を自動保存しました');
+          // リビジョンは単調増加する時刻を使い、遅れて届いた保存はサーバー側で破棄させる。
+          // 古いと判定されたら（別の端末や提出で先に進んでいたら）最新のリビジョンの上に送り直す
+          for (let attempt = 0; attempt < 2; attempt++) {
+            const revision = Math.max(Date.now(), revisionRef.current + 1);
+            const { data } = await autosaveAnswers(studentId, [{
+              question: questionId,
+              answer_text: answerText,
+              reasoning_note: reasoningNote,
+              revision
+            }]);
+            const current = data.current?.find(item => item.question === questionId);
+            if (!current) {
+              revisionRef.current = revision;
+              lastSavedRef.current = currentData;
+              console.log('回答を自動保存しました');
+              break;
+            }
+            revisionRef.current = current.revision;
+          }
         }
       } catch (error) {
         console.error('自動保存に失敗しました:', error);
@@ -59,6 +71,11 @@ export const useAutoSave = ({
     };
   }, [studentId, questionId, answerText, reasoningNote, delay]);
 
+  // 問題が変わったら、その問題の保存済みリビジョンは次の保存で受け取り直す
+  useEffect(() => {
+    revisionRef.current = 0;
+  }, [studentId, questionId]);
+
   // コンポーネントのアンマウント時にタイマーをクリア
   useEffect(() => {
     return () => {
@@ -0,0 +1,21 @@
+"""
+gunicorn settings for reading_app_backend.
+
+SERVER_MODE=wsgi (default): sync workers serving reading_app_backend.wsgi.
+SERVER_MODE=asgi: uvicorn workers serving reading_app_backend.asgi. One worker
+per core is enough because each worker multiplexes requests on its event loop;
+Postgres connections per worker are capped by DB_POOL_MAX_SIZE (the pool is on
+by default in this mode) and ASYNC_DB_CONCURRENCY.
+
+The bind address comes from $PORT and the worker count from $WEB_CONCURRENCY
+(both read by gunicorn itself).
+"""
+import multiprocessing
+import os
+
+if os.environ.get('SERVER_MODE', 'wsgi') == 'asgi':
+    wsgi_app = 'reading_app_backend.asgi:application'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+    workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+else:
+    wsgi_app = 'reading_app_backend.wsgi:application'
@@ -0,0 +1,221 @@
+import atexit
+import json
+import time
+import zlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import metrics
+from .batching import BatchWorker
+from .models import ActivityChunk, Question
+
+# --- 学習中の操作ログ ---
+# リクエストの処理中はイベントをキューに積むだけ（DB に触れない）。バックグラウンドスレッドが
+# 数秒ごとに学生・教材ごとへ時刻順に並べて圧縮し、1回の bulk_create で ActivityChunk として追記する。
+# compact_chunks は古いチャンクを学生・教材・日ごとに1行へまとめ直す。
+
+EVENT_TYPES = ('answer_edit', 'answer_patch', 'answer_submit', 'highlight', 'sticky_note', 'annotation_delete', 'navigate')
+_CODES = {kind: code for code, kind in enumerate(EVENT_TYPES)}
+# クライアントから送れる種類（それ以外はサーバー側の処理で記録する）
+CLIENT_EVENT_TYPES = ('navigate',)
+# これより長く操作が無ければ別のセッションとみなす
+SESSION_GAP = timedelta(minutes=30)
+
+EVENTS = metrics.register(metrics.Counter(
+    'reading_activity_events_total', 'Activity events buffered', labels=('type',),
+))
+DROPPED = metrics.register(metrics.Counter(
+    'reading_activity_dropped_total', 'Activity events dropped because the buffer was full', labels=(),
+))
+FLUSH_SECONDS = metrics.register(metrics.Histogram(
+    'reading_activity_flush_seconds', 'Time to write one batch of activity events', metrics.SECONDS_BUCKETS, labels=(),
+))
+
+
+# --- 格納形式 ---
+def pack_events(started_at, events):
+    """[(時刻, 種類, 問題 id, 開始, 終了, 内容)] を started_at からのミリ秒で表し、JSON を zlib で圧縮する"""
+    rows = [
+        [round((at - started_at).total_seconds() * 1000), _CODES[kind], question, start, end, data]
+        for at, kind, question, start, end, data in events
+    ]
+    return zlib.compress(json.dumps(rows, ensure_ascii=False, separators=(',', ':')).encode())
+
+
+def unpack_events(chunk):
+    for offset, code, question, start, end, data in json.loads(zlib.decompress(bytes(chunk.events))):
+        yield chunk.started_at + timedelta(milliseconds=offset), EVENT_TYPES[code], question, start, end, data
+
+
+def build_chunks(events):
+    """キューのイベントから ActivityChunk を組み立てる（保存はしない）
+
+    イベントは (時刻, 学生 id, 教材 id, 問題 id, 種類, 開始, 終了, 内容)。
+    教材 id が無いもの（回答の編集）は問題から1回のクエリでまとめて引く。
+    """
+    missing = {event[3] for event in events if event[2] is None and event[3] is not None}
+    materials = dict(Question.objects.filter(pk__in=missing).values_list('pk', 'material_id')) if missing else {}
+
+    grouped = {}
+    for at, student_id, material_id, question_id, kind, start, end, data in events:
+        if material_id is None:
+            material_id = materials.get(question_id)
+            if material_id is None:
+                continue
+        grouped.setdefault((student_id, material_id), []).append((at, kind, question_id, start, end, data))
+
+    chunks = []
+    for (student_id, material_id), items in grouped.items():
+        items.sort(key=lambda item: item[0])
+        chunks.append(ActivityChunk(
+            student_id=student_id, material_id=material_id, started_at=items[0][0], ended_at=items[-1][0],
+            event_count=len(items), events=pack_events(items[0][0], items),
+        ))
+    return chunks
+
+
+def write_events(events):
+    started = time.perf_counter()
+    chunks = build_chunks(events)
+    ActivityChunk.objects.bulk_create(chunks, batch_size=500)
+    FLUSH_SECONDS.observe(time.perf_counter() - started)
+    return chunks
+
+
+# --- バッファ ---
+class ActivityBuffer(BatchWorker):
+    """イベントを受け取り、バックグラウンドスレッドで interval 秒ごとにまとめて書き込む
+
+    キューが max_queue 件で一杯なら、リクエストを待たせずにイベントを捨てて数える。
+    """
+
+    name = 'activity-log'
+    error_message = '操作ログの書き込みに失敗しました（%d件）'
+
+    def __init__(self, interval=5.0, max_batch=5000, max_queue=100000):
+        super().__init__(delay=interval, max_batch=max_batch, max_queue=max_queue)
+
+    def put(self, event):
+        if not super().put(event):
+            DROPPED.inc()
+            return False
+        EVENTS.inc(event[4])
+        return True
+
+    def handle(self, batch):
+        write_events(batch)
+
+
+_buffer = ActivityBuffer(
+    interval=getattr(settings, 'ACTIVITY_FLUSH_SECONDS', 5.0),
+    max_queue=getattr(settings, 'ACTIVITY_QUEUE_SIZE', 100000),
+)
+atexit.register(_buffer.flush)
+
+
+def record(student_id, kind, material_id=None, question_id=None, start=None, end=None, data=None, at=None):
+    """操作イベントをコミット後にバッファへ積む
+
+    settings.ACTIVITY_LOG_MODE が 'immediate' ならその場で書き込み、'off' なら記録しない。
+    """
+    mode = getattr(settings, 'ACTIVITY_LOG_MODE', 'background')
+    if mode == 'off':
+        return
+    event = (at or timezone.now(), student_id, material_id, question_id, kind, start, end, data)
+    if mode == 'immediate':
+        transaction.on_commit(lambda: write_events([event]))
+    else:
+        transaction.on_commit(lambda: _buffer.enqueue(event))
+
+
+def record_answer_edits(student_id, drafts, saved, kind='answer_edit'):
+    """保存された下書き（upsert_drafts の戻り値）ごとに本文を記録する"""
+    by_question = {draft['question']: draft for draft in drafts}
+    for _, question_id, revision, _ in saved:
+        draft = by_question[question_id]
+        record(student_id, kind, question_id=question_id, data={
+            'revision': revision, 'answer_text': draft.get('answer_text', ''),
+            'reasoning_note': draft.get('reasoning_note', ''),
+        })
+
+
+def record_annotations(annotations):
+    for annotation in annotations:
+        record(
+            annotation.student_id, annotation.annotation_type, material_id=annotation.material_id,
+            start=annotation.start_position, end=annotation.end_position,
+            data={'id': annotation.pk, 'content': annotation.content, 'color': annotation.color},
+        )
+
+
+# --- 再構成 ---
+def session_events(student_id, since, until, material_id=None, limit=5000):
+    """学生の [since, until] の操作を時刻順に返す。(イベントのリスト, 途中で打ち切ったか)
+
+    イベントは (時刻, 教材 id, 種類, 問題 id, 開始, 終了, 内容)。
+    """
+    chunks = ActivityChunk.objects.filter(student_id=student_id, started_at__lte=until, ended_at__gte=since)
+    if material_id is not None:
+        chunks = chunks.filter(material_id=material_id)
+    events, cutoff, truncated = [], None, False
+    for chunk in chunks.order_by('started_at'):
+        if cutoff is not None and chunk.started_at > cutoff:
+            truncated = True
+            break
+        events.extend(
+            (at, chunk.material_id, kind, question, start, end, data)
+            for at, kind, question, start, end, data in unpack_events(chunk)
+            if since <= at <= until
+        )
+        if len(events) >= limit:
+            # チャンクは開始時刻順なので、limit 件目より後に始まるチャンクは読まなくてよい
+            events.sort(key=lambda event: event[0])
+            cutoff = events[limit - 1][0]
+    events.sort(key=lambda event: event[0])
+    return events[:limit], truncated or len(events) > limit
+
+
+def split_sessions(events, gap=SESSION_GAP):
+    """SESSION_GAP より長い空きで区切った (開始, 終了, イベント数) のリスト"""
+    sessions = []
+    for event in events:
+        if sessions and event[0] - sessions[-1][1] <= gap:
+            sessions[-1][1] = event[0]
+            sessions[-1][2] += 1
+        else:
+            sessions.append([event[0], event[0], 1])
+    return [tuple(session) for session in sessions]
+
+
+# --- 圧縮 ---
+def compact_chunks(before):
+    """before より前に終わったチャンクを、学生・教材・日（現地時間）ごとに1行へまとめる
+
+    戻り値は (まとめたグループ数, 削除したチャンク数)。
+    """
+    groups = {}
+    rows = ActivityChunk.objects.filter(ended_at__lt=before).values_list('pk', 'student_id', 'material_id', 'started_at')
+    for pk, student_id, material_id, started_at in rows:
+        groups.setdefault((student_id, material_id, timezone.localdate(started_at)), []).append(pk)
+    merged = removed = 0
+    for pks in groups.values():
+        if len(pks) > 1:
+            _merge(pks)
+            merged += 1
+            removed += len(pks)
+    return merged, removed
+
+
+def _merge(pks):
+    with transaction.atomic():
+        group = list(ActivityChunk.objects.select_for_update().filter(pk__in=pks))
+        items = sorted((event for chunk in group for event in unpack_events(chunk)), key=lambda event: event[0])
+        ActivityChunk.objects.filter(pk__in=pks).delete()
+        ActivityChunk.objects.create(
+            student_id=group[0].student_id, material_id=group[0].material_id,
+            started_at=items[0][0], ended_at=items[-1][0], event_count=len(items),
+            events=pack_events(items[0][0], items),
+        )
@@ -1,6 +1,7 @@
+from django import forms
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import CustomUser, Group, ReadingMaterial, Question, StudentAnswer, Annotation, Comment, Notification
+from .models import CustomUser, Group, ReadingMaterial, Question, StudentAnswer, AnswerPatch, Annotation, Comment, Notification
 
 class CustomUserAdmin(UserAdmin):
     list_display = ('username', 'user_type', 'student_id', 'grade', 'is_staff', 'date_joined')
@@ -13,9 +14,30 @@ class CustomUserAdmin(UserAdmin):
 
 admin.site.register(CustomUser, CustomUserAdmin)
 admin.site.register(Group)
-admin.site.register(ReadingMaterial)
+class ReadingMaterialForm(forms.ModelForm):
+    # 本文は MaterialText に保存されるので、フォームでは content として編集する
+    content = forms.CharField(label='本文', widget=forms.Textarea)
+
+    class Meta:
+        model = ReadingMaterial
+        exclude = ['text']
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.text_id:
+            self.fields['content'].initial = self.instance.content
+
+    def save(self, commit=True):
+        self.instance.content = self.cleaned_data['content']
+        return super().save(commit)
+
+class ReadingMaterialAdmin(admin.ModelAdmin):
+    form = ReadingMaterialForm
+
+admin.site.register(ReadingMaterial, ReadingMaterialAdmin)
 admin.site.register(Question)
 admin.site.register(StudentAnswer)
+admin.site.register(AnswerPatch)
 admin.site.register(Annotation)
 admin.site.register(Comment)
 admin.site.register(Notification)
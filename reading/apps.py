@@ -3,4 +3,7 @@ from django.apps import AppConfig
 
 class ReadingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'reading'
\ No newline at end of file
+    name = 'reading'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,48 @@
+import asyncio
+import weakref
+from contextlib import asynccontextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections
+
+# --- 非同期ビューからの DB アクセス ---
+# ASGI ではリクエストごとに同期処理用のスレッドが作られ、DB 接続もそのスレッドが持つ。
+# DB を使う区間をワーカーあたり ASYNC_DB_CONCURRENCY 件に制限し、区間を出るときに
+# 接続を（CONN_MAX_AGE に従って）閉じる、またはプール（DB_POOL）へ返すことで、
+# 同時接続数を ワーカー数 × この値 に抑える。
+# 待っている間のリクエストはスレッドも接続も持たない。
+
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def _semaphore():
+    # セマフォはイベントループに結び付くので、ループごとに作る
+    loop = asyncio.get_running_loop()
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _semaphores[loop] = asyncio.Semaphore(getattr(settings, 'ASYNC_DB_CONCURRENCY', 8))
+    return semaphore
+
+
+def _release_connections():
+    for connection in connections.all():
+        # トランザクションの途中（テストなど）では閉じない
+        if connection.connection is not None and not connection.in_atomic_block:
+            connection.close_if_unusable_or_obsolete()
+
+
+@asynccontextmanager
+async def db_slot():
+    """DB を使う区間。この中で非同期 ORM（aget / acount / async for）を使う"""
+    async with _semaphore():
+        try:
+            yield
+        finally:
+            await sync_to_async(_release_connections)()
+
+
+async def run_sync(fn, *args, **kwargs):
+    """同期の処理（生 SQL や DRF のビュー）を DB の区間の中で実行する"""
+    async with db_slot():
+        return await sync_to_async(fn)(*args, **kwargs)
@@ -0,0 +1,110 @@
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication, get_authorization_header
+from rest_framework.authtoken.models import Token
+
+from .asyncdb import run_sync
+
+# --- トークン認証のキャッシュ ---
+# プロセス内の LRU（短い TTL）→ 共有キャッシュ → DB の順に引く。
+# ログアウトやユーザーの変更時は invalidate_token / invalidate_user で消す。
+# 他のプロセスの LRU には最大 AUTH_TOKEN_LOCAL_TTL 秒だけ古い値が残る。
+# キャッシュがプロセス内（LocMemCache）のときは共有されないので、同じ短い TTL で DB を引き直す。
+
+_KEY = 'auth-token:{}'
+_local = OrderedDict()
+_lock = threading.Lock()
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _digest(key):
+    # 共有キャッシュのキーにトークンそのものを出さない
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _shared_ttl():
+    if isinstance(caches['default'], LocMemCache):
+        return _setting('AUTH_TOKEN_LOCAL_TTL', 5)
+    return _setting('AUTH_TOKEN_CACHE_TTL', 300)
+
+
+def _local_get(digest):
+    with _lock:
+        entry = _local.get(digest)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del _local[digest]
+            return None
+        _local.move_to_end(digest)
+        return entry[1]
+
+
+def _local_set(digest, value):
+    with _lock:
+        _local[digest] = (time.monotonic() + _setting('AUTH_TOKEN_LOCAL_TTL', 5), value)
+        _local.move_to_end(digest)
+        while len(_local) > _setting('AUTH_TOKEN_LOCAL_SIZE', 1024):
+            _local.popitem(last=False)
+
+
+def invalidate_token(key):
+    digest = _digest(key)
+    cache.delete(_KEY.format(digest))
+    with _lock:
+        _local.pop(digest, None)
+
+
+def invalidate_user(user_id):
+    for key in Token.objects.filter(user_id=user_id).values_list('key', flat=True):
+        invalidate_token(key)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication と同じ判定を、定常状態では DB に触れずに行う"""
+
+    def authenticate_credentials(self, key):
+        digest = _digest(key)
+        entry = _local_get(digest)
+        if entry is None:
+            entry = cache.get(_KEY.format(digest))
+            if entry is None:
+                try:
+                    token = Token.objects.select_related('user').get(key=key)
+                except Token.DoesNotExist:
+                    raise exceptions.AuthenticationFailed(_('Invalid token.'))
+                entry = (token.user, token)
+                cache.set(_KEY.format(digest), entry, _shared_ttl())
+            _local_set(digest, entry)
+        return self._checked(entry)
+
+    async def authenticate_async(self, request):
+        """非同期ビュー用。プロセス内 LRU に当たればイベントループから出ずに判定する"""
+        auth = get_authorization_header(request).split()
+        if len(auth) == 2 and auth[0].lower() == self.keyword.lower().encode():
+            try:
+                entry = _local_get(_digest(auth[1].decode()))
+            except UnicodeError:
+                entry = None
+            if entry is not None:
+                return self._checked(entry)
+        return await run_sync(self.authenticate, request)
+
+    def _checked(self, entry):
+        user, token = entry
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        # キャッシュ上のインスタンスをリクエスト間で共有しない
+        return copy.copy(user), token
@@ -0,0 +1,231 @@
+import atexit
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .batching import BatchWorker
+from .gradebook import answers_changed
+from .models import StudentAnswer, AnswerPatch
+from .citations import sync_citations
+from .progress import schedule_answers_created
+from .search import index_answers
+
+
+def head_revisions(student_id, question_ids):
+    """保存済みの最新リビジョン（未適用の差分を含む）を {問題 id: リビジョン} で返す
+
+    回答が無い問題は含まない。クライアントが古いリビジョンを送ったときの基準として返す。
+    """
+    rows = (
+        StudentAnswer.objects.filter(student_id=student_id, question_id__in=list(question_ids))
+        .annotate(patch_head=Max('patches__revision'))
+        .values_list('question_id', 'revision', 'patch_head')
+    )
+    return {question_id: max(revision, patch_head or 0) for question_id, revision, patch_head in rows}
+
+
+def next_revision(student_id, question_id):
+    """クライアントがリビジョンを送らなかった場合に使う、保存済みの最新リビジョンの次の値"""
+    return head_revisions(student_id, [question_id]).get(question_id, 0) + 1
+
+
+def upsert_drafts(student_id, drafts):
+    """回答の下書きを1つの INSERT ... ON CONFLICT で保存する
+
+    drafts は question / answer_text / reasoning_note / citations / revision を持つ dict のリスト。
+    保存済みのリビジョン以下の下書きは行に触れずに破棄される。未適用の差分（AnswerPatch）の
+    リビジョンも保存済みとみなす（差分より古い全文で上書きすると差分の連鎖が切れる）。
+    citations を省略（None）した場合は既存の値を保持する。
+    保存された行の (id, question_id, revision, 新しく作られたか) のリストを返す。
+    """
+    # 同じ問題が複数含まれる場合は最新のリビジョンだけを残す（ON CONFLICT は同一行を二度更新できない）
+    latest = {}
+    for draft in drafts:
+        kept = latest.get(draft['question'])
+        if kept is None or draft['revision'] > kept['revision']:
+            latest[draft['question']] = draft
+    if not latest:
+        return []
+
+    qn = connection.ops.quote_name
+    opts = StudentAnswer._meta
+    table = qn(opts.db_table)
+    columns = ['student', 'question', 'answer_text', 'reasoning_note', 'citations', 'revision', 'submitted_at', 'updated_at']
+    fields = [opts.get_field(name) for name in columns]
+    now = timezone.now()
+
+    rows, params = [], []
+    for draft in latest.values():
+        values = [
+            student_id, draft['question'], draft.get('answer_text', ''), draft.get('reasoning_note', ''),
+            draft.get('citations'), draft['revision'], now, now,
+        ]
+        rows.append('(' + ', '.join(['%s'] * len(values)) + ')')
+        params.extend(field.get_db_prep_save(value, connection) for field, value in zip(fields, values))
+
+    column_list = ', '.join(qn(field.column) for field in fields)
+    updates = ', '.join(
+        f"{qn(name)} = excluded.{qn(name)}"
+        for name in ('answer_text', 'reasoning_note', 'revision', 'updated_at')
+    )
+    citations = qn(opts.get_field('citations').column)
+    patches = qn(AnswerPatch._meta.db_table)
+    sql = (
+        f"INSERT INTO {table} ({column_list}) VALUES {', '.join(rows)} "
+        f"ON CONFLICT ({qn('student_id')}, {qn('question_id')}) DO UPDATE SET {updates}, "
+        f"{citations} = COALESCE(excluded.{citations}, {table}.{citations}) "
+        f"WHERE {table}.{qn('revision')} < excluded.{qn('revision')} "
+        f"AND NOT EXISTS (SELECT 1 FROM {patches} WHERE {patches}.{qn('answer_id')} = {table}.{qn('id')} "
+        f"AND {patches}.{qn('revision')} >= excluded.{qn('revision')}) "
+        f"RETURNING {qn('id')}, {qn('question_id')}, {qn('revision')}, "
+        # 新しく作られた行だけ作成日時と更新日時が一致する
+        f"{qn('submitted_at')} = {qn('updated_at')}"
+    )
+    # 単一の文なので追加のトランザクションやセーブポイントは不要
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    saved = [(pk, question_id, revision, bool(created)) for pk, question_id, revision, created in rows]
+    # 生の SQL なのでシグナルは発火しない
+    if saved:
+        schedule_answers_created(student_id, [question_id for _, question_id, _, created in saved if created])
+        answers_changed(question_id for _, question_id, _, _ in saved)
+        schedule_answer_refresh(pk for pk, _, _, _ in saved)
+    return saved
+
+
+# --- 全文検索の索引・引用箇所の更新 ---
+# 自動保存のたびに索引と引用箇所を書き直すと保存1回が十数クエリになるので、コミット後にキューへ積み、
+# バックグラウンドスレッドがまとめて読み直して、内容が変わった回答だけ書き込む。
+def refresh_answers(answer_ids):
+    answer_ids = sorted(set(answer_ids))
+    index_answers(answer_ids, only_changed=True)
+    sync_citations(answer_ids)
+
+
+class AnswerRefresher(BatchWorker):
+    name = 'answer-refresh'
+    error_message = '回答の索引・引用箇所の更新に失敗しました（%d件）'
+
+    def handle(self, batch):
+        refresh_answers(batch)
+
+
+_refresher = AnswerRefresher(delay=getattr(settings, 'ANSWER_REFRESH_SECONDS', 2.0), max_batch=1000)
+atexit.register(_refresher.flush)
+
+
+def schedule_answer_refresh(answer_ids):
+    """シグナルが発火しない保存（生の SQL・差分）の後、索引と引用箇所を更新する
+
+    settings.ANSWER_REFRESH_MODE が 'immediate' ならコミット時にその場で、'off' なら行わず、
+    それ以外はバックグラウンドで行う。
+    """
+    answer_ids = list(answer_ids)
+    mode = getattr(settings, 'ANSWER_REFRESH_MODE', 'background')
+    if not answer_ids or mode == 'off':
+        return
+    if mode == 'immediate':
+        transaction.on_commit(lambda: refresh_answers(answer_ids))
+    else:
+        def enqueue():
+            for answer_id in answer_ids:
+                _refresher.enqueue(answer_id)
+        transaction.on_commit(enqueue)
+
+
+# --- 差分による下書き保存 ---
+PATCHED_FIELDS = ('answer_text', 'reasoning_note')
+
+# 未適用の差分がこの数に達したら本体の行へまとめて書き戻す
+COMPACT_EVERY = 20
+
+
+class PatchConflict(Exception):
+    """差分の基準リビジョンが最新でない"""
+
+    def __init__(self, revision):
+        super().__init__(f"base revision is not the latest ({revision})")
+        self.revision = revision
+
+
+def apply_ops(text, ops):
+    """{'at', 'delete', 'insert'} の操作列を先頭から順に適用する（位置はコードポイント単位）"""
+    for op in ops:
+        at, delete, insert = op['at'], op.get('delete', 0), op.get('insert', '')
+        if at < 0 or delete < 0 or at + delete > len(text):
+            raise ValueError(f"operation out of range: at={at} delete={delete} length={len(text)}")
+        text = text[:at] + insert + text[at + delete:]
+    return text
+
+
+def materialize(answer, patches):
+    """保存済みの回答に未適用の差分を連結して、最新のテキストとリビジョンを返す
+
+    基準リビジョンが連鎖しない差分（全文保存で上書きされたもの）は無視する。
+    戻り値は (テキストの dict, リビジョン, 適用した差分の数)。
+    """
+    texts = {name: getattr(answer, name) for name in PATCHED_FIELDS}
+    by_base = {patch.base_revision: patch for patch in patches}
+    revision, applied = answer.revision, 0
+    while revision in by_base:
+        patch = by_base[revision]
+        for name in PATCHED_FIELDS:
+            texts[name] = apply_ops(texts[name], patch.ops.get(name, []))
+        revision, applied = patch.revision, applied + 1
+    return texts, revision, applied
+
+
+def append_patch(student_id, question_id, base_revision, revision, ops):
+    """差分を1行追記する（本文は書き換えない）
+
+    base_revision が最新でなければ PatchConflict、範囲外の操作なら ValueError。
+    差分が COMPACT_EVERY 件たまったら本文へ書き戻す。新しいリビジョンを返す。
+    """
+    answer = StudentAnswer.objects.filter(student_id=student_id, question_id=question_id).first()
+    if answer is None:
+        if base_revision != 0:
+            raise PatchConflict(0)
+        answer, _ = StudentAnswer.objects.get_or_create(
+            student_id=student_id, question_id=question_id, defaults={'answer_text': ''},
+        )
+    patches = list(answer.patches.all())
+    texts, head, applied = materialize(answer, patches)
+    if head != base_revision:
+        raise PatchConflict(head)
+    for name in PATCHED_FIELDS:
+        texts[name] = apply_ops(texts[name], ops.get(name, []))
+
+    try:
+        with transaction.atomic():
+            AnswerPatch.objects.create(answer=answer, base_revision=base_revision, revision=revision, ops=ops)
+    except IntegrityError:
+        # 同じ基準リビジョンへの差分が先に保存された
+        raise PatchConflict(base_revision)
+
+    if applied + 1 >= COMPACT_EVERY:
+        compact(answer, texts, revision)
+    answers_changed([question_id])
+    schedule_answer_refresh([answer.pk])
+    return revision
+
+
+def compact(answer, texts, revision):
+    """差分を適用済みのテキストを本文へ書き戻し、不要になった差分を削除する"""
+    updated = StudentAnswer.objects.filter(pk=answer.pk, revision=answer.revision).update(
+        revision=revision, updated_at=timezone.now(), **texts,
+    )
+    if updated:
+        AnswerPatch.objects.filter(answer=answer, base_revision__lt=revision).delete()
+    return updated
+
+
+def compact_answer(answer):
+    """保存済みの差分をすべて本文へ書き戻す（管理コマンド用）"""
+    texts, revision, applied = materialize(answer, list(answer.patches.all()))
+    if not applied:
+        AnswerPatch.objects.filter(answer=answer, base_revision__lt=answer.revision).delete()
+        return 0
+    return compact(answer, texts, revision)
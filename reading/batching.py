@@ -0,0 +1,77 @@
+import logging
+import queue
+import threading
+import time
+
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+
+class BatchWorker:
+    """キューに積まれた項目を、バックグラウンドスレッドでまとめて handle に渡す
+
+    最初の項目から delay 秒のあいだに届いたもの（最大 max_batch 件）を1バッチとする。
+    max_queue を指定するとキューが一杯のときは待たずに捨て、put は False を返す。
+    サブクラスは name と handle(batch) を定義する。
+    """
+
+    name = 'batch-worker'
+    error_message = 'バックグラウンド処理に失敗しました（%d件）'
+
+    def __init__(self, delay=2.0, max_batch=500, max_queue=0):
+        self.delay = delay
+        self.max_batch = max_batch
+        self._queue = queue.Queue(max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def handle(self, batch):
+        raise NotImplementedError
+
+    def put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            return False
+        return True
+
+    def enqueue(self, item):
+        if self.put(item):
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._process(batch)
+
+    def _process(self, batch):
+        try:
+            self.handle(batch)
+        except Exception:
+            logger.exception(self.error_message, len(batch))
+        finally:
+            close_old_connections()
+
+    def flush(self):
+        """キューに残っている項目を呼び出し元のスレッドで処理する（終了時・テスト用）"""
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self.handle(batch)
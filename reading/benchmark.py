@@ -0,0 +1,353 @@
+import json
+import random
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+from django.contrib.auth.hashers import make_password
+from django.db import connection
+from asgiref.sync import async_to_sync
+from django.test import AsyncClient, Client
+from django.test.utils import (
+    CaptureQueriesContext, override_settings, setup_test_environment, teardown_test_environment,
+)
+
+from .models import (
+    Annotation, Comment, CustomUser, Group, Notification, Question, ReadingMaterial, StudentAnswer,
+)
+from .progress import reconcile_progress
+from .search import rebuild as rebuild_search_index
+from .segments import resegment
+
+# --- 実行環境 ---
+@contextmanager
+def isolated_database():
+    """使い捨てのテスト用データベースとプロセス内キャッシュに切り替える（本番のデータ・キャッシュを汚さない）"""
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        # 操作ログ・回答の索引のバックグラウンド処理は使い捨ての DB より長く生きるので止める（リクエスト側の負担はキューへの追加のみ）
+        with override_settings(
+            CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'benchmark'}},
+            ACTIVITY_LOG_MODE='off', ANSWER_REFRESH_MODE='off',
+        ):
+            yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+# --- データセット ---
+SCALES = {
+    # (グループ数, グループあたりの学生数, グループあたりの教材数, 教材あたりの問題数, 本文の文字数, 学生・教材あたりの注釈数)
+    'tiny': (1, 5, 1, 4, 2000, 3),
+    'small': (1, 40, 2, 12, 10000, 10),
+    'medium': (2, 40, 3, 24, 20000, 20),
+    'large': (4, 40, 5, 36, 40000, 30),
+}
+
+_KANA = 'あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをん'
+_KANJI = '読解文章筆者主張根拠理由結論段落要約意見事実比較対象説明理解考察学習問題社会自然言葉時間'
+
+
+def japanese_text(rng, length):
+    """句読点と改行を含む、それらしい日本語の文章"""
+    parts, size = [], 0
+    while size < length:
+        sentence = ''.join(
+            rng.choice(_KANJI) + rng.choice(_KANJI) + ''.join(rng.choice(_KANA) for _ in range(rng.randint(2, 6)))
+            for _ in range(rng.randint(3, 8))
+        ) + '。'
+        if rng.random() < 0.15:
+            sentence += '\n'
+        parts.append(sentence)
+        size += len(sentence)
+    return ''.join(parts)[:length]
+
+
+@dataclass
+class Dataset:
+    groups: list = field(default_factory=list)
+    materials: list = field(default_factory=list)
+    questions: list = field(default_factory=list)
+    students: list = field(default_factory=list)
+    answers: list = field(default_factory=list)
+
+
+# ベンチマークのユーザー名の接頭辞。データはすべてこのユーザーから辿れる（削除もユーザーごとの CASCADE で済む）
+PREFIX = 'bench_'
+
+
+def _group_name(g, scale, random_seed):
+    return f'ベンチマーク {g}（{scale}, seed={random_seed}）'
+
+
+def load(scale='small', random_seed=0):
+    """seed で作成済みのデータを読み込む（同じ scale と random_seed のものが無ければ None）
+
+    シナリオが使う groups・materials・questions・students だけを作成順に読み込み、answers は空のまま。
+    """
+    names = [_group_name(g, scale, random_seed) for g in range(SCALES[scale][0])]
+    groups = list(Group.objects.filter(teacher__username__startswith=PREFIX, name__in=names).order_by('pk'))
+    if [group.name for group in groups] != names:
+        return None
+    data = Dataset(groups=groups)
+    data.materials = list(ReadingMaterial.objects.filter(group__in=groups).order_by('pk'))
+    data.questions = list(Question.objects.filter(material__in=data.materials).order_by('pk'))
+    data.students = list(CustomUser.objects.filter(student_groups__in=groups).order_by('pk'))
+    return data
+
+
+def seed(scale='small', random_seed=0):
+    """ベンチマーク用のデータを作成する（同じ scale と random_seed なら同じデータ）
+
+    以前に作成したベンチマークのデータ（PREFIX のユーザーとその関連）は消してから作り直すので、何度実行してもよい。
+    """
+    n_groups, n_students, n_materials, n_questions, text_length, n_annotations = SCALES[scale]
+    CustomUser.objects.filter(username__startswith=PREFIX).delete()
+    rng = random.Random(random_seed)
+    password = make_password(None)
+    data = Dataset()
+    for g in range(n_groups):
+        teacher = CustomUser.objects.create(username=f'{PREFIX}teacher{g}', user_type='teacher', password=password)
+        group = Group.objects.create(name=_group_name(g, scale, random_seed), teacher=teacher)
+        students = CustomUser.objects.bulk_create([
+            CustomUser(username=f'{PREFIX}g{g}_s{s}', student_id=f'{g:02d}{s:03d}', password=password)
+            for s in range(n_students)
+        ])
+        group.students.add(*students)
+        data.groups.append(group)
+        data.students.extend(students)
+        for m in range(n_materials):
+            content = japanese_text(rng, text_length)
+            material = ReadingMaterial.objects.create(
+                title=f'教材 {g}-{m}', content=content, group=group, created_by=teacher,
+            )
+            data.materials.append(material)
+            questions = Question.objects.bulk_create([
+                Question(
+                    material=material, question_text=f'問{q + 1} 筆者の主張をまとめなさい。', order=q,
+                    question_type='multiple_choice' if q % 3 == 0 else 'descriptive',
+                    choices=['ア', 'イ', 'ウ', 'エ'] if q % 3 == 0 else None, correct_answer='ア' if q % 3 == 0 else '',
+                )
+                for q in range(n_questions)
+            ])
+            data.questions.extend(questions)
+            answers = StudentAnswer.objects.bulk_create([
+                StudentAnswer(
+                    student=student, question=question,
+                    answer_text=rng.choice('アイウエ') if question.question_type == 'multiple_choice'
+                    else japanese_text(rng, rng.randint(80, 400)),
+                    citations=[{'start': start, 'end': start + rng.randint(5, 60)}
+                               for start in rng.sample(range(text_length - 100), 2)],
+                )
+                for student in students for question in questions
+            ], batch_size=1000)
+            data.answers.extend(answers)
+            Annotation.objects.bulk_create([
+                Annotation(
+                    student=student, material=material, annotation_type=rng.choice(['highlight', 'sticky_note']),
+                    start_position=start, end_position=start + rng.randint(3, 80),
+                )
+                for student in students
+                for start in (rng.randrange(text_length - 100) for _ in range(n_annotations))
+            ], batch_size=1000)
+            comments = Comment.objects.bulk_create([
+                Comment(author=teacher, target_answer=answer, content='根拠となる段落を示しましょう。')
+                for answer in rng.sample(answers, len(answers) // 10)
+            ], batch_size=1000)
+            Notification.objects.bulk_create([
+                Notification(
+                    recipient_id=comment.target_answer.student_id, sender=teacher, notification_type='comment',
+                    title='新しいコメント', message='コメントがあります', related_comment=comment,
+                )
+                for comment in comments
+            ], batch_size=1000)
+            resegment(material)
+    rebuild_search_index()
+    reconcile_progress()
+    return data
+
+
+# --- シナリオ ---
+def scenarios(data):
+    """(名前, メソッド, URL, 本文) のリスト。reading/urls.py の実際のルートを使う"""
+    material, group, student = data.materials[0], data.groups[0], data.students[0]
+    questions = [q for q in data.questions if q.material_id == material.pk]
+    return [
+        ('materials-list', 'get', '/api/materials/', None),
+        ('materials-retrieve', 'get', f'/api/materials/{material.pk}/', None),
+        ('materials-questions', 'get', f'/api/materials/{material.pk}/questions/', None),
+        ('materials-segments', 'get', f'/api/materials/{material.pk}/segments/?limit=100', None),
+        ('materials-annotations', 'get', f'/api/materials/{material.pk}/annotations/?student_id={student.pk}', None),
+        ('materials-annotation-coverage', 'get', f'/api/materials/{material.pk}/annotation_coverage/', None),
+        ('materials-gradebook', 'get', f'/api/materials/{material.pk}/gradebook/', None),
+        ('materials-group-gradebook', 'get', f'/api/materials/gradebook/?group_id={group.pk}', None),
+        ('materials-cited-passages', 'get', f'/api/materials/{material.pk}/cited_passages/', None),
+        ('progress-dashboard', 'get', f'/api/progress/?teacher_id={group.teacher_id}', None),
+        ('answers-list', 'get', '/api/answers/?page_size=50', None),
+        ('annotations-list', 'get', '/api/annotations/?page_size=50', None),
+        ('comments-list', 'get', '/api/comments/?page_size=50', None),
+        ('notifications-count', 'get', f'/api/notifications/count/?user_id={student.pk}', None),
+        ('search', 'get', '/api/search/?q=読解', None),
+        ('answers-autosave', 'post', '/api/answers/autosave/', lambda i: {
+            'student': student.pk,
+            'drafts': [{'question': q.pk, 'answer_text': f'下書き {i}', 'revision': 10 ** 12 + i} for q in questions[:5]],
+        }),
+    ]
+
+
+# --- 実行 ---
+def percentile(values, p):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(int(round(p / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+class InProcessDriver:
+    """Django のテストクライアントでリクエストし、クエリ数も数える"""
+
+    def __init__(self):
+        self.client = Client()
+
+    def send(self, method, url, **kwargs):
+        started = time.perf_counter()
+        response = getattr(self.client, method)(url, **kwargs)
+        return time.perf_counter() - started, response
+
+    def request(self, method, url, body):
+        kwargs = {'data': json.dumps(body), 'content_type': 'application/json'} if body is not None else {}
+        with CaptureQueriesContext(connection) as ctx:
+            elapsed, response = self.send(method, url, **kwargs)
+        if response.status_code >= 400:
+            raise RuntimeError(f'{method.upper()} {url}: {response.status_code} {response.content[:200]!r}')
+        return elapsed, len(ctx.captured_queries)
+
+
+class AsyncInProcessDriver(InProcessDriver):
+    """AsyncClient で ASGI のハンドラーを通す（SERVER_MODE=asgi と同じ経路）"""
+
+    def __init__(self):
+        self.client = AsyncClient()
+
+    def send(self, method, url, **kwargs):
+        return async_to_sync(self._send)(method, url, **kwargs)
+
+    async def _send(self, method, url, **kwargs):
+        # リクエストごとのイベントループの起動は計測に含めない
+        started = time.perf_counter()
+        response = await getattr(self.client, method)(url, **kwargs)
+        return time.perf_counter() - started, response
+
+
+# 実行モード: (ドライバー, URLconf)
+MODES = {
+    'wsgi': (InProcessDriver, 'reading_app_backend.urls'),
+    'asgi': (AsyncInProcessDriver, 'reading_app_backend.urls_asgi'),
+}
+
+
+class HttpDriver:
+    """起動中のサーバー（gunicorn など）へ HTTP でリクエストする。クエリ数は数えない"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def request(self, method, url, body):
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(
+            self.base_url + urllib.request.quote(url, safe='/?=&'), data=data, method=method.upper(),
+            headers={'Content-Type': 'application/json'} if data else {},
+        )
+        started = time.perf_counter()
+        with urllib.request.urlopen(request) as response:
+            response.read()
+        return time.perf_counter() - started, None
+
+
+def run(driver, plan, requests=50, warmup=5, only=None, concurrency=1):
+    """シナリオごとにリクエストを送り、p50/p95/p99（ミリ秒）・スループット・クエリ数を返す
+
+    concurrency が 2 以上なら、その数のスレッドから同時にリクエストする（HttpDriver 用）。
+    """
+    results = {}
+    for name, method, url, body in plan:
+        if only and name not in only:
+            continue
+        send = lambda i: driver.request(method, url, body(i) if callable(body) else body)
+        for i in range(warmup):
+            send(i)
+        started = time.perf_counter()
+        if concurrency > 1:
+            with ThreadPoolExecutor(concurrency) as pool:
+                samples = list(pool.map(send, range(warmup, warmup + requests)))
+        else:
+            samples = [send(i) for i in range(warmup, warmup + requests)]
+        wall = time.perf_counter() - started
+        latencies = [elapsed for elapsed, _ in samples]
+        queries = [count for _, count in samples if count is not None]
+        results[name] = {
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'rps': round(len(latencies) / wall, 1),
+            'queries': max(queries) if queries else None,
+            'requests': len(latencies),
+        }
+    return results
+
+
+def run_modes(plan, modes, **kwargs):
+    """プロセス内で WSGI / ASGI の経路をそれぞれ計測する。{モード: run() の結果} を返す"""
+    results = {}
+    for mode in modes:
+        driver_class, urlconf = MODES[mode]
+        with override_settings(ROOT_URLCONF=urlconf):
+            results[mode] = run(driver_class(), plan, **kwargs)
+    return results
+
+
+def compare(results, baseline, threshold=20.0):
+    """ベースラインより p95 が threshold % 以上遅いか、クエリ数が増えたシナリオを返す"""
+    regressions = []
+    for name, current in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        limit = before['p95_ms'] * (1 + threshold / 100)
+        if current['p95_ms'] > limit:
+            regressions.append(f"{name}: p95 {before['p95_ms']} ms -> {current['p95_ms']} ms (+{threshold}% = {limit:.3f})")
+        if current.get('queries') is not None and before.get('queries') is not None and current['queries'] > before['queries']:
+            regressions.append(f"{name}: queries {before['queries']} -> {current['queries']}")
+    return regressions
+
+
+def format_table(results, baseline=None):
+    lines = [f"{'endpoint':32} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>8} {'queries':>7} {'Δp95':>7}"]
+    for name, r in results.items():
+        before = (baseline or {}).get(name)
+        delta = f"{(r['p95_ms'] / before['p95_ms'] - 1) * 100:+.0f}%" if before and before['p95_ms'] else ''
+        queries = '-' if r['queries'] is None else r['queries']
+        lines.append(
+            f"{name:32} {r['p50_ms']:9.2f} {r['p95_ms']:9.2f} {r['p99_ms']:9.2f} {r['rps']:8.1f} {queries:>7} {delta:>7}"
+        )
+    return '\n'.join(lines)
+
+
+def format_side_by_side(results):
+    """{モード: run() の結果} を、エンドポイントごとに p50/p95/req/s を並べた表にする"""
+    modes = list(results)
+    header = f"{'endpoint':32}" + ''.join(f" {mode + ' p50':>12} {mode + ' p95':>12} {mode + ' req/s':>12}" for mode in modes)
+    lines = [header]
+    names = list(dict.fromkeys(name for result in results.values() for name in result))
+    for name in names:
+        cells = []
+        for mode in modes:
+            r = results[mode].get(name)
+            cells.append(f" {r['p50_ms']:12.2f} {r['p95_ms']:12.2f} {r['rps']:12.1f}" if r else f" {'-':>12} {'-':>12} {'-':>12}")
+        lines.append(f'{name:32}' + ''.join(cells))
+    return '\n'.join(lines)
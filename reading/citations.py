@@ -0,0 +1,133 @@
+from django.db import transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
+
+from .httpcache import invalidate
+from .models import Citation, CitationSummary, CitedPassage, StudentAnswer, TextSegment
+
+
+# --- 引用箇所の正規化 ---
+def citation_spans(citations):
+    """citations（{start, end} の dict かそのリスト）から有効な (start, end) を取り出す"""
+    if isinstance(citations, dict):
+        citations = [citations]
+    if not isinstance(citations, list):
+        return []
+    spans = set()
+    for citation in citations:
+        if not isinstance(citation, dict):
+            continue
+        start = citation.get('start', citation.get('start_position'))
+        end = citation.get('end', citation.get('end_position'))
+        if isinstance(start, int) and isinstance(end, int) and 0 <= start < end:
+            spans.add((start, end))
+    return sorted(spans)
+
+
+def replace_citations(answers, created=False):
+    """回答の引用箇所を側テーブルへ書き直す
+
+    answers は (回答 id, 学生 id, 教材 id, citations) のリスト。
+    新規作成した回答（created=True）は既存の行が無いので削除を省く。
+    """
+    rows = [
+        Citation(answer_id=answer_id, student_id=student_id, material_id=material_id, start=start, end=end)
+        for answer_id, student_id, material_id, citations in answers
+        for start, end in citation_spans(citations)
+    ]
+    if created and not rows:
+        return
+    with transaction.atomic():
+        if not created:
+            Citation.objects.filter(answer_id__in=[answer[0] for answer in answers]).delete()
+        Citation.objects.bulk_create(rows)
+        mark_changed({answer[2] for answer in answers})
+
+
+def sync_citations(answer_ids):
+    """保存済みの回答を読み直して、引用箇所が変わった回答だけ書き直す（シグナルが発火しない保存の後に使う）"""
+    answers = list(StudentAnswer.objects.filter(pk__in=answer_ids).values_list(
+        'pk', 'student_id', 'question__material_id', 'citations',
+    ))
+    saved = {}
+    for answer_id, start, end in Citation.objects.filter(answer_id__in=[answer[0] for answer in answers]).values_list(
+        'answer_id', 'start', 'end',
+    ):
+        saved.setdefault(answer_id, []).append((start, end))
+    changed = [answer for answer in answers if sorted(saved.get(answer[0], [])) != citation_spans(answer[3])]
+    if changed:
+        replace_citations(changed)
+
+
+def mark_changed(material_ids):
+    """教材の集計を再集計待ちにする"""
+    now = timezone.now()
+    CitationSummary.objects.bulk_create(
+        [CitationSummary(material_id=material_id, changed_at=now) for material_id in material_ids],
+        update_conflicts=True, unique_fields=['material'], update_fields=['changed_at'],
+    )
+    for material_id in material_ids:
+        transaction.on_commit(lambda material_id=material_id: invalidate(f'cited:{material_id}'))
+
+
+# --- よく引用される箇所の集計 ---
+def stale_materials():
+    return list(
+        CitationSummary.objects.filter(Q(refreshed_at__isnull=True) | Q(changed_at__gt=F('refreshed_at')))
+        .values_list('material_id', flat=True)
+    )
+
+
+def refresh_cited_passages(material_ids):
+    """教材の文ごとに、重なる引用の数と引用した学生の数を SQL で集計して集計表を作り直す"""
+    material_ids = list(material_ids)
+    if not material_ids:
+        return 0
+    started = timezone.now()
+    overlapping = Q(material__citations__start__lt=F('end'), material__citations__end__gt=F('start'))
+    rows = (
+        TextSegment.objects.filter(material_id__in=material_ids)
+        .annotate(
+            citation_count=Count('material__citations', filter=overlapping),
+            student_count=Count('material__citations__student', filter=overlapping, distinct=True),
+        )
+        .filter(citation_count__gt=0)
+        .values_list('material_id', 'key', 'position', 'start', 'end', 'text', 'citation_count', 'student_count')
+    )
+    passages = [
+        CitedPassage(
+            material_id=material_id, segment_key=key, position=position, start=start, end=end, text=text,
+            citation_count=citation_count, student_count=student_count,
+        )
+        for material_id, key, position, start, end, text, citation_count, student_count in rows
+    ]
+    with transaction.atomic():
+        CitedPassage.objects.filter(material_id__in=material_ids).delete()
+        CitedPassage.objects.bulk_create(passages, batch_size=1000)
+        # 集計中に変わった引用は changed_at が started より新しくなり、次回も再集計される
+        CitationSummary.objects.bulk_create(
+            [CitationSummary(material_id=material_id, changed_at=started, refreshed_at=started) for material_id in material_ids],
+            update_conflicts=True, unique_fields=['material'], update_fields=['refreshed_at'],
+        )
+    for material_id in material_ids:
+        transaction.on_commit(lambda material_id=material_id: invalidate(f'cited:{material_id}'))
+    return len(passages)
+
+
+def most_cited_passages(material_id, limit=10):
+    """集計表から引用の多い順に返す（GET で書き込まないよう、集計は refresh_cited_passages コマンドに任せる）
+
+    一度も集計していない教材は空の結果を stale として返す。
+    """
+    summary = CitationSummary.objects.filter(material_id=material_id).first()
+    passages = (
+        CitedPassage.objects.filter(material_id=material_id)
+        .order_by('-citation_count', 'position')
+        .values('segment_key', 'position', 'start', 'end', 'text', 'citation_count', 'student_count')[:limit]
+    )
+    return {
+        'material': material_id,
+        'refreshed_at': summary.refreshed_at if summary else None,
+        'stale': summary.stale if summary else False,
+        'passages': list(passages),
+    }
@@ -0,0 +1,197 @@
+import os
+import threading
+import time
+from collections import deque
+
+from django.db.utils import OperationalError
+
+from . import metrics
+
+# --- プロセス内の DB 接続プール ---
+# reading.pooled_postgresql バックエンドが使う。Django がリクエストの終わり（ASGI では
+# reading.asyncdb の区間の終わり）に接続を閉じると、実際には切断せずにここへ返す。
+# sync ワーカーのスレッドからも、ASGI のリクエストごとのスレッドからも同じプールを使うので、
+# ワーカーあたりの接続数は max_size を超えない。
+
+CHECKOUTS = metrics.register(metrics.Counter(
+    'reading_db_pool_checkouts_total', 'Connections handed out by the pool', labels=('alias',),
+))
+CONNECTS = metrics.register(metrics.Counter(
+    'reading_db_pool_connects_total', 'New physical connections opened by the pool', labels=('alias',),
+))
+DISCARDS = metrics.register(metrics.Counter(
+    'reading_db_pool_discards_total', 'Connections dropped (health check, lifetime, broken)', labels=('alias',),
+))
+WAITS = metrics.register(metrics.Counter(
+    'reading_db_pool_waits_total', 'Checkouts that had to wait for a free connection', labels=('alias',),
+))
+TIMEOUTS = metrics.register(metrics.Counter(
+    'reading_db_pool_timeouts_total', 'Checkouts that gave up after the pool timeout', labels=('alias',),
+))
+WAIT_SECONDS = metrics.register(metrics.Histogram(
+    'reading_db_pool_wait_seconds', 'Time spent waiting for a free connection', metrics.SECONDS_BUCKETS,
+    labels=('alias',),
+))
+
+
+class PoolTimeout(OperationalError):
+    pass
+
+
+class _Entry:
+    __slots__ = ('connection', 'created_at', 'returned_at')
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created_at = self.returned_at = time.monotonic()
+
+
+class ConnectionPool:
+    """スレッドセーフな接続プール
+
+    connect() は新しい接続を返す関数、check(conn) は疎通確認、reset(conn) はプールへ戻す前の
+    後始末（戻せないなら False）、close(conn) は切断。max_idle 秒使われなかった接続と
+    max_lifetime 秒を超えた接続は捨て、check_after 秒以上使われなかった接続は貸し出す前に確認する。
+    """
+
+    def __init__(self, alias, max_size=10, timeout=5.0, max_idle=300.0, max_lifetime=3600.0, check_after=30.0,
+                 check=None, reset=None, close=None):
+        self.alias = alias
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.check_after = check_after
+        self._check = check
+        self._reset = reset
+        self._close = close or (lambda connection: connection.close())
+        self._idle = deque()
+        self._in_use = {}
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def getconn(self, connect):
+        started = time.monotonic()
+        waited = False
+        while True:
+            entry = None
+            with self._cond:
+                while True:
+                    if self._idle:
+                        # 最後に返された（温まっている）接続から使う
+                        entry = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        break
+                    remaining = started + self.timeout - time.monotonic()
+                    if remaining <= 0:
+                        TIMEOUTS.inc(self.alias)
+                        raise PoolTimeout(
+                            f'DB 接続プール（{self.alias}）の空きを {self.timeout} 秒待ちましたが取得できませんでした'
+                        )
+                    if not waited:
+                        waited = True
+                        WAITS.inc(self.alias)
+                    self._cond.wait(remaining)
+            if entry is None:
+                entry = self._open(connect)
+                break
+            # 確認はロックの外で行う
+            if self._usable(entry):
+                break
+            self._discard(entry)
+        if waited:
+            WAIT_SECONDS.observe(time.monotonic() - started, self.alias)
+        CHECKOUTS.inc(self.alias)
+        with self._cond:
+            self._in_use[id(entry.connection)] = entry
+        return entry.connection
+
+    def putconn(self, connection):
+        with self._cond:
+            entry = self._in_use.pop(id(connection), None)
+        if entry is None:
+            # このプールのものでなければそのまま閉じる
+            self._close(connection)
+            return
+        now = time.monotonic()
+        if now - entry.created_at > self.max_lifetime or (self._reset and not self._reset(connection)):
+            self._discard(entry)
+            return
+        entry.returned_at = now
+        with self._cond:
+            self._idle.append(entry)
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {'idle': len(self._idle), 'in_use': len(self._in_use), 'size': self._size}
+
+    def close_idle(self):
+        with self._cond:
+            entries = list(self._idle)
+            self._idle.clear()
+        for entry in entries:
+            self._discard(entry)
+
+    def _open(self, connect):
+        try:
+            connection = connect()
+        except BaseException:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        CONNECTS.inc(self.alias)
+        return _Entry(connection)
+
+    def _usable(self, entry):
+        now = time.monotonic()
+        if now - entry.created_at > self.max_lifetime or now - entry.returned_at > self.max_idle:
+            return False
+        if getattr(entry.connection, 'closed', False):
+            return False
+        if self._check and now - entry.returned_at > self.check_after:
+            return self._check(entry.connection)
+        return True
+
+    def _discard(self, entry):
+        DISCARDS.inc(self.alias)
+        try:
+            self._close(entry.connection)
+        except Exception:
+            pass
+        finally:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(key, alias, **options):
+    """プロセスごとのプール。fork した子プロセスでは親の接続を使わずに作り直す"""
+    with _pools_lock:
+        entry = _pools.get(key)
+        if entry is None or entry[0] != os.getpid():
+            entry = _pools[key] = (os.getpid(), ConnectionPool(alias, **options))
+        return entry[1]
+
+
+def _pool_stats():
+    totals = {}
+    with _pools_lock:
+        pools = [pool for pid, pool in _pools.values() if pid == os.getpid()]
+    for pool in pools:
+        for state, value in pool.stats().items():
+            totals[(pool.alias, state)] = totals.get((pool.alias, state), 0) + value
+    return totals
+
+
+CONNECTIONS = metrics.register(metrics.Gauge(
+    'reading_db_pool_connections', 'Pooled DB connections by state (idle, in_use, size)', _pool_stats,
+    labels=('alias', 'state'),
+))
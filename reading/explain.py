@@ -0,0 +1,81 @@
+import re
+from urllib.parse import urlencode
+
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from .benchmark import scenarios
+
+# --- EXPLAIN によるインデックスの確認 ---
+_PG_SEQ_SCAN = re.compile(r'Seq Scan on (\S+)')
+
+
+def explain(sql):
+    """クエリの実行計画を行のリストで返す"""
+    with transaction.atomic(), connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            # データが少ないとインデックスがあっても全件走査を選ぶので、使えるインデックスが無いときだけ Seq Scan が残るようにする
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + sql)
+            return [row[0] for row in cursor.fetchall()]
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+def sequential_scans(plan):
+    """実行計画のうち、インデックスを使わずにテーブル全体を読む箇所のテーブル名"""
+    if connection.vendor == 'postgresql':
+        return [match.group(1) for line in plan for match in _PG_SEQ_SCAN.finditer(line)]
+    tables = []
+    for detail in plan:
+        # SQLite: "SCAN tbl"（全件走査）/ "SEARCH tbl USING INDEX ..." / "SCAN tbl USING INDEX ..."（索引順の走査）
+        if detail.startswith('SCAN ') and 'USING' not in detail and 'VIRTUAL TABLE' not in detail:
+            tables.append(detail.split()[1])
+    return tables
+
+
+def endpoint_urls(data):
+    """確認する GET のエンドポイント: ベンチマークのシナリオと、ルーターに登録されたすべての一覧・詳細"""
+    from .models import ActivityChunk, ProgressSummary, SearchDocument
+    from .urls import router
+
+    # 一覧に必須のパラメータ
+    required = {
+        SearchDocument: {'q': '読解'},
+        ActivityChunk: {'student_id': data.students[0].pk},
+        ProgressSummary: {'teacher_id': data.groups[0].teacher_id},
+    }
+    urls = [(name, url) for name, method, url, _ in scenarios(data) if method == 'get']
+    for prefix, viewset, basename in router.registry:
+        model = viewset.queryset.model
+        urls.append((f'{basename}-list', f'/api/{prefix}/?{urlencode(required.get(model, {}))}'))
+        obj = model.objects.order_by('pk').first()
+        if obj is not None and hasattr(viewset, 'retrieve'):
+            urls.append((f'{basename}-detail', f'/api/{prefix}/{obj.pk}/'))
+    return urls
+
+
+def check_endpoints(urls, allow=()):
+    """各エンドポイントで実行された WHERE 付きの SELECT を EXPLAIN し、全件走査を見つける
+
+    戻り値は (エンドポイント名, テーブル名, SQL, 実行計画) のリスト。
+    """
+    client = Client()
+    findings = []
+    seen = set()
+    for name, url in urls:
+        with CaptureQueriesContext(connection) as ctx:
+            response = client.get(url)
+        if response.status_code >= 400:
+            raise RuntimeError(f'GET {url}: {response.status_code}')
+        for query in ctx.captured_queries:
+            sql = query['sql']
+            if not sql.lstrip().upper().startswith('SELECT') or ' WHERE ' not in sql.upper() or sql in seen:
+                continue
+            seen.add(sql)
+            plan = explain(sql)
+            for table in sequential_scans(plan):
+                if table.strip('"') not in allow:
+                    findings.append((name, table, sql, plan))
+    return findings
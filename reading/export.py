@@ -0,0 +1,106 @@
+import csv
+import json
+from itertools import islice
+from types import SimpleNamespace
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .autosave import PATCHED_FIELDS, materialize
+from .models import Annotation, AnswerPatch, Comment, StudentAnswer
+
+CHUNK_SIZE = 2000
+
+# 表計算ソフトが数式として解釈する先頭文字（CSV インジェクション対策で ' を付ける）
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+# --- 出力する列（values() による射影） ---
+EXPORTS = {
+    'answers': (StudentAnswer, 'question__material', [
+        'id', 'student_id', 'student__username', 'student__student_id',
+        'question__material_id', 'question_id', 'question__order', 'question__question_type',
+        'answer_text', 'reasoning_note', 'citations', 'submitted_at', 'updated_at',
+    ]),
+    'annotations': (Annotation, 'material', [
+        'id', 'student_id', 'student__username', 'material_id', 'annotation_type',
+        'start_position', 'end_position', 'content', 'color', 'created_at', 'updated_at',
+    ]),
+    'comments': (Comment, 'target_answer__question__material', [
+        'id', 'author_id', 'author__username', 'target_answer_id', 'target_answer__student_id',
+        'target_answer__question_id', 'content', 'created_at', 'updated_at',
+    ]),
+}
+
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+}
+
+
+def export_rows(kind, material_id=None, group_id=None):
+    """(列名のリスト, 行の dict のイテレータ) を返す。行はチャンク単位で読み込む"""
+    model, material_path, fields = EXPORTS[kind]
+    queryset = model.objects.all()
+    if material_id is not None:
+        queryset = queryset.filter(**{f'{material_path}_id': material_id})
+    if group_id is not None:
+        queryset = queryset.filter(**{f'{material_path}__group_id': group_id})
+    if model is StudentAnswer:
+        rows = queryset.order_by('pk').values(*fields, 'revision').iterator(chunk_size=CHUNK_SIZE)
+        return fields, _with_patches(rows)
+    rows = queryset.order_by('pk').values(*fields).iterator(chunk_size=CHUNK_SIZE)
+    return fields, rows
+
+
+def _with_patches(rows):
+    """回答の行に未適用の差分を適用する（本文へは書き戻さない。差分はチャンクごとに1クエリで読む）"""
+    while True:
+        chunk = list(islice(rows, CHUNK_SIZE))
+        if not chunk:
+            return
+        patches = {}
+        for patch in AnswerPatch.objects.filter(answer_id__in=[row['id'] for row in chunk]):
+            patches.setdefault(patch.answer_id, []).append(patch)
+        for row in chunk:
+            revision = row.pop('revision')
+            if row['id'] in patches:
+                answer = SimpleNamespace(revision=revision, **{name: row[name] for name in PATCHED_FIELDS})
+                row.update(materialize(answer, patches[row['id']])[0])
+            yield row
+
+
+class _Echo:
+    """csv.writer の書き込み先（書いた行をそのまま返す）"""
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(fields, rows):
+    writer = csv.writer(_Echo())
+    # Excel で文字化けしないように BOM を付ける
+    yield '\ufeff' + writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([_csv_value(row[name]) for name in fields])
+
+
+def _csv_value(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    if value is None:
+        return ''
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def iter_jsonl(fields, rows):
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+
+
+def iter_export(kind, output='csv', material_id=None, group_id=None):
+    """エクスポートの本文を少しずつ生成する（メモリ使用量は行数に依存しない）"""
+    fields, rows = export_rows(kind, material_id, group_id)
+    return iter_csv(fields, rows) if output == 'csv' else iter_jsonl(fields, rows)
@@ -0,0 +1,125 @@
+import threading
+
+from django.db import transaction
+from django.db.models import Count, Max, Q
+from django.db.models.functions import Trim
+from django.db.models.lookups import Exact
+from django.http import Http404
+
+from .httpcache import VersionedLocalCache, invalidate
+from .models import CustomUser, Question, ReadingMaterial, StudentAnswer
+
+# --- 問題 → (教材, グループ) の対応 ---
+# 回答の保存のたびに教材を引かなくて済むよう、プロセス内に保持する。
+# 教材のグループや問題の教材が変わったら共有キャッシュのバージョンを進め、全プロセスの対応を捨てる
+_SCOPES = 'all'
+_scopes = VersionedLocalCache('question-scopes:{}', max_size=1)
+_scopes_lock = threading.Lock()
+
+
+def forget_question_scopes():
+    """全プロセスの対応を捨てる（トランザクション中に他プロセスが古い値を読み込むことがあるので、コミット後にも捨てる）"""
+    _scopes.invalidate(_SCOPES)
+    transaction.on_commit(lambda: _scopes.invalidate(_SCOPES))
+
+
+def question_scopes(question_ids):
+    """{問題 id: (教材 id, グループ id)}（存在しない問題は含まない）"""
+    question_ids = set(question_ids)
+    known = _scopes.get(_SCOPES, dict)
+    with _scopes_lock:
+        missing = question_ids - known.keys()
+    if missing:
+        rows = (
+            Question.objects.filter(pk__in=missing)
+            .values_list('pk', 'material_id', 'material__group_id')
+            .order_by()
+        )
+        with _scopes_lock:
+            for pk, material_id, group_id in rows:
+                known[pk] = (material_id, group_id)
+    with _scopes_lock:
+        return {pk: known[pk] for pk in question_ids if pk in known}
+
+
+def invalidate_gradebook(material_id, group_id):
+    invalidate(f'gradebook:material:{material_id}')
+    invalidate(f'gradebook:group:{group_id}')
+
+
+def answers_changed(question_ids):
+    """回答が保存・削除されたときに、関係する成績表のキャッシュを無効にする"""
+    for material_id, group_id in set(question_scopes(question_ids).values()):
+        invalidate_gradebook(material_id, group_id)
+
+
+# --- 集計 ---
+def _is_correct(prefix=''):
+    """選択式で、回答が正解と（前後の空白を除いて）一致する"""
+    return Q(**{f'{prefix}question__question_type': 'multiple_choice'}) & Exact(
+        Trim(f'{prefix}answer_text'), Trim(f'{prefix}question__correct_answer'),
+    )
+
+
+def _question_totals():
+    return {
+        'question_count': Count('questions', distinct=True),
+        'multiple_choice_count': Count(
+            'questions', filter=Q(questions__question_type='multiple_choice'), distinct=True,
+        ),
+    }
+
+
+def material_gradebook(material_id):
+    """教材1つ分の、学生ごとの回答数・正答数・最終更新（2クエリ）"""
+    material = (
+        ReadingMaterial.objects.filter(pk=material_id)
+        .annotate(**_question_totals())
+        .values('id', 'title', 'group_id', 'question_count', 'multiple_choice_count')
+        .first()
+    )
+    if material is None:
+        raise Http404
+    in_material = Q(studentanswer__question__material_id=material_id)
+    students = (
+        CustomUser.objects.filter(student_groups=material['group_id'])
+        .annotate(
+            answered=Count('studentanswer', filter=in_material),
+            correct=Count('studentanswer', filter=in_material & _is_correct('studentanswer__')),
+            last_updated=Max('studentanswer__updated_at', filter=in_material),
+        )
+        .values('id', 'username', 'student_id', 'answered', 'correct', 'last_updated')
+        .order_by('username')
+    )
+    return {'material': material, 'students': list(students)}
+
+
+def group_gradebook(group_id):
+    """グループの全教材について、学生×教材ごとの回答数・正答数・最終更新（3クエリ）"""
+    materials = list(
+        ReadingMaterial.objects.filter(group_id=group_id)
+        .annotate(**_question_totals())
+        .values('id', 'title', 'question_count', 'multiple_choice_count')
+        .order_by('created_at', 'id')
+    )
+    students = list(
+        CustomUser.objects.filter(student_groups=group_id)
+        .values('id', 'username', 'student_id')
+        .order_by('username')
+    )
+    cells = (
+        StudentAnswer.objects.filter(question__material__group_id=group_id)
+        .values('student_id', 'question__material_id')
+        .annotate(answered=Count('id'), correct=Count('id', filter=_is_correct()), last_updated=Max('updated_at'))
+        .order_by()
+    )
+    by_student = {student['id']: student for student in students}
+    for student in students:
+        student['materials'] = {}
+    for cell in cells:
+        student = by_student.get(cell['student_id'])
+        if student is not None:
+            student['materials'][cell['question__material_id']] = {
+                'answered': cell['answered'], 'correct': cell['correct'], 'last_updated': cell['last_updated'],
+            }
+    return {'group': group_id, 'materials': materials, 'students': students}
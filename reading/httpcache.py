@@ -0,0 +1,165 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+RESPONSE_TIMEOUT = 60 * 60 * 24
+_VERSION_KEY = 'response-cache:{}:version'
+_LOCK_TIMEOUT = 10
+_LOCK_WAIT = 2.0
+
+
+def bump_version(key):
+    """共有キャッシュ上のバージョン番号（期限なし）を進める"""
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # add と incr の間にキーが消された
+        cache.set(key, 1, None)
+
+
+def invalidate(scope):
+    """scope（例: 'material:1'）に属するキャッシュ済みレスポンスをすべて無効にする"""
+    bump_version(_VERSION_KEY.format(scope))
+
+
+class VersionedLocalCache:
+    """プロセス内の LRU。共有キャッシュ上のバージョン番号で全プロセスの値を無効にする
+
+    get(key, build) はバージョンが変わっていなければプロセス内の値を、変わっていれば build() の結果を返す。
+    """
+
+    def __init__(self, version_key, max_size=128):
+        self.version_key = version_key
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def invalidate(self, key):
+        bump_version(self.version_key.format(key))
+        with self._lock:
+            self._items.pop(key, None)
+
+    def get(self, key, build):
+        version = cache.get(self.version_key.format(key), 0)
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None and entry[0] == version:
+                self._items.move_to_end(key)
+                return entry[1]
+        value = build()
+        with self._lock:
+            self._items[key] = (version, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        return value
+
+
+def etag_matches(request, etag):
+    """If-None-Match が etag に一致するか
+
+    圧縮したレスポンスの ETag は弱い ETag（W/"..."）になるので、弱い比較で照合する。
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+    tags = {tag[2:] if tag.startswith('W/') else tag for tag in parse_etags(if_none_match)}
+    return etag in tags or if_none_match.strip() == '*'
+
+
+def _with_headers(response, etag):
+    # 更新日時はキャッシュした時刻であって内容の更新日時ではないので、Last-Modified は付けず ETag だけで検証させる
+    response['ETag'] = etag
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+def _entry_key(request, scope, name, version):
+    variant = request.GET.urlencode() if request.GET else ''
+    return f'response-body:{scope}:{version}:{name}:{hashlib.sha1(variant.encode()).hexdigest()}'
+
+
+def conditional_response(request, scope, name, build):
+    """ETag 付きでシリアライズ済みのデータをキャッシュして返す
+
+    build() はキャッシュが無いときだけ呼ばれ、レスポンスのデータを返す。
+    同時に多数のリクエストが来ても build() を呼ぶのは1つだけで、残りはその結果を待つ。
+    """
+    key = _entry_key(request, scope, name, cache.get(_VERSION_KEY.format(scope), 0))
+    entry = cache.get(key)
+    if entry is None:
+        lock = f'{key}:lock'
+        if cache.add(lock, 1, _LOCK_TIMEOUT):
+            try:
+                entry = _build_entry(build)
+                cache.set(key, entry, RESPONSE_TIMEOUT)
+            finally:
+                cache.delete(lock)
+        else:
+            deadline = time.monotonic() + _LOCK_WAIT
+            while entry is None and time.monotonic() < deadline:
+                time.sleep(0.05)
+                entry = cache.get(key)
+            if entry is None:
+                entry = _build_entry(build)
+
+    etag, data = entry
+    if etag_matches(request, etag):
+        return _with_headers(Response(status=status.HTTP_304_NOT_MODIFIED), etag)
+    return _with_headers(Response(data), etag)
+
+
+async def cached_response_async(request, scope, name, build=None):
+    """conditional_response の非同期版。キャッシュ済みなら DB に触れずに返す
+
+    キャッシュに無ければ await build() でデータを作って同じキーに保存する（ETag も同期のビューと同じになる）。
+    build を省略したとき、build が None を返したとき、他のリクエストが作成中で待ちきれなかったときは None を返すので、
+    呼び出し側は同期のビューに処理を任せる。本文は DRF の JSONRenderer と同じバイト列になる。
+    """
+    version = await cache.aget(_VERSION_KEY.format(scope), 0)
+    key = _entry_key(request, scope, name, version)
+    entry = await cache.aget(key)
+    if entry is None:
+        if build is None:
+            return None
+        lock = f'{key}:lock'
+        if await cache.aadd(lock, 1, _LOCK_TIMEOUT):
+            try:
+                data = await build()
+                if data is None:
+                    return None
+                entry = _build_entry(lambda: data)
+                await cache.aset(key, entry, RESPONSE_TIMEOUT)
+            finally:
+                await cache.adelete(lock)
+        else:
+            deadline = time.monotonic() + _LOCK_WAIT
+            while entry is None and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+                entry = await cache.aget(key)
+            if entry is None:
+                return None
+    etag, data = entry
+    if etag_matches(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(JSONRenderer().render(data), content_type='application/json')
+    response['Vary'] = 'Accept'
+    return _with_headers(response, etag)
+
+
+def _build_entry(build):
+    # レスポンスと同じ JSONRenderer で直列化し、そのバイト列から ETag を作る（キーの順序も変えない）
+    body = JSONRenderer().render(build())
+    etag = quote_etag(hashlib.sha1(body).hexdigest())
+    # ReturnDict はシリアライザへの参照を持つので、素の dict / list にしてから保存する
+    return etag, json.loads(body)
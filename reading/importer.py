@@ -0,0 +1,176 @@
+import csv
+import io
+import json
+from collections import Counter
+
+from django.db import transaction
+
+from .gradebook import forget_question_scopes, invalidate_gradebook
+from .httpcache import invalidate
+from .models import MaterialText, Question, ReadingMaterial
+from .search import schedule_material_index
+from .segments import content_saved
+from .serializers import ImportBundleSerializer
+
+MATERIAL_FIELDS = ['title', 'content']
+QUESTION_FIELDS = ['question_text', 'question_type', 'choices', 'correct_answer', 'hide_text', 'order']
+
+
+class BundleError(Exception):
+    """バンドルの読み込み・検証エラー（errors はシリアライザ形式）"""
+
+    def __init__(self, errors):
+        super().__init__(json.dumps(errors, ensure_ascii=False))
+        self.errors = errors
+
+
+# --- 読み込み ---
+def parse_bundle(text, fmt='json'):
+    """JSON / YAML / CSV のバンドルを {'group', 'materials': [...]} の dict にする
+
+    CSV は1行1問で、教材の列（material_key, title, content）は問題ごとに繰り返す。
+    choices は | 区切り。question_key が空の行は問題の無い教材を表す。
+    読み込めない内容は BundleError にする。
+    """
+    try:
+        if fmt == 'json':
+            return json.loads(text)
+        if fmt == 'yaml':
+            return _parse_yaml(text)
+        if fmt == 'csv':
+            return _parse_csv(text)
+    except (ValueError, KeyError, TypeError, csv.Error) as error:
+        raise BundleError({'non_field_errors': [f'読み込めません: {error!r}']})
+    raise BundleError({'format': [f'未対応の形式です: {fmt}']})
+
+
+def _parse_yaml(text):
+    try:
+        import yaml
+    except ImportError:
+        raise BundleError({'format': ['YAML の読み込みには PyYAML が必要です']})
+    try:
+        return yaml.safe_load(text)
+    except yaml.YAMLError as error:
+        raise BundleError({'non_field_errors': [f'YAML を読み込めません: {error}']})
+
+
+def _parse_csv(text):
+    materials = {}
+    for row in csv.DictReader(io.StringIO(text.lstrip('﻿'))):
+        material = materials.setdefault(row['material_key'], {
+            'key': row['material_key'], 'title': row.get('title', ''), 'content': row.get('content', ''),
+            'questions': [],
+        })
+        if row.get('question_key'):
+            choices = row.get('choices') or ''
+            material['questions'].append({
+                'key': row['question_key'],
+                'question_text': row.get('question_text', ''),
+                'question_type': row.get('question_type', 'descriptive'),
+                'choices': choices.split('|') if choices else None,
+                'correct_answer': row.get('correct_answer', ''),
+                'hide_text': (row.get('hide_text') or '').lower() in ('1', 'true', 'yes'),
+                'order': int(row.get('order') or 0),
+            })
+    return {'materials': list(materials.values())}
+
+
+def validate_bundle(data, group=None):
+    """バンドル全体を書き込み前に検証し、validated_data を返す"""
+    if not isinstance(data, dict):
+        raise BundleError({'non_field_errors': ['バンドルはオブジェクトである必要があります']})
+    if group is not None:
+        data = {**data, 'group': group}
+    serializer = ImportBundleSerializer(data=data)
+    if not serializer.is_valid():
+        raise BundleError(serializer.errors)
+    return serializer.validated_data
+
+
+# --- 書き込み ---
+def import_bundle(bundle, created_by=None, batch_size=100):
+    """検証済みのバンドルを外部キーで upsert する
+
+    batch_size 件の教材ごとに1トランザクションで bulk_create / bulk_update するため、
+    途中で止まっても同じバンドルを再実行すれば続きから取り込める（何度実行しても結果は同じ）。
+    """
+    group = bundle['group']
+    created_by = created_by or group.teacher
+    materials = bundle['materials']
+    summary = Counter()
+    for start in range(0, len(materials), batch_size):
+        with transaction.atomic():
+            summary.update(_import_batch(group, created_by, materials[start:start + batch_size]))
+    forget_question_scopes()
+    return dict(summary)
+
+
+def _import_batch(group, created_by, items):
+    summary = Counter()
+    existing = {
+        material.external_key: material
+        for material in ReadingMaterial.objects.filter(
+            group=group, external_key__in=[i['external_key'] for i in items],
+        ).select_related('text')
+    }
+    new, changed = [], []
+    for item in items:
+        material = existing.get(item['external_key'])
+        if material is None:
+            new.append(ReadingMaterial(group=group, created_by=created_by, external_key=item['external_key'],
+                                       **{name: item[name] for name in MATERIAL_FIELDS}))
+        elif _assign(material, item, MATERIAL_FIELDS):
+            changed.append(material)
+    # 本文は先に MaterialText へ保存する（bulk 操作では ReadingMaterial.save が呼ばれない）
+    MaterialText.store(material.text for material in new + changed if material.content_changed)
+    ReadingMaterial.objects.bulk_create(new)
+    ReadingMaterial.objects.bulk_update(changed, ['title', 'text'])
+    for material in new:
+        content_saved(material, created=True)
+    for material in changed:
+        content_saved(material)
+    summary.update(materials_created=len(new), materials_updated=len(changed))
+    by_key = {**existing, **{material.external_key: material for material in new}}
+
+    current = {
+        (question.material_id, question.external_key): question
+        for question in Question.objects.filter(material__in=list(existing.values()))
+    }
+    new_questions, changed_questions = [], []
+    touched = {material.pk for material in new + changed}
+    for item in items:
+        material = by_key[item['external_key']]
+        for data in item['questions']:
+            question = current.get((material.pk, data['external_key']))
+            if question is None:
+                new_questions.append(Question(material=material, external_key=data['external_key'],
+                                              **{name: data.get(name) for name in QUESTION_FIELDS if name in data}))
+                touched.add(material.pk)
+            elif _assign(question, data, QUESTION_FIELDS):
+                changed_questions.append(question)
+                touched.add(material.pk)
+    Question.objects.bulk_create(new_questions)
+    Question.objects.bulk_update(changed_questions, QUESTION_FIELDS)
+    summary.update(questions_created=len(new_questions), questions_updated=len(changed_questions))
+
+    # bulk 操作ではシグナルが発火しないので、キャッシュと検索の索引はここで更新する
+    for material_id in touched:
+        transaction.on_commit(lambda material_id=material_id: _invalidate(material_id, group.pk))
+    schedule_material_index(material.pk for material in new + changed)
+    return summary
+
+
+def _invalidate(material_id, group_id):
+    invalidate(f'material:{material_id}')
+    invalidate_gradebook(material_id, group_id)
+
+
+def _assign(obj, data, fields):
+    """data の値を obj に反映し、変更があれば True"""
+    changed = False
+    for name in fields:
+        if name in data and getattr(obj, name) != data[name]:
+            setattr(obj, name, data[name])
+            changed = True
+    return changed
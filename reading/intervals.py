@@ -0,0 +1,95 @@
+from bisect import bisect_left
+
+from .httpcache import VersionedLocalCache
+
+
+# --- 区間木 ---
+class IntervalTree:
+    """静的な区間木（開始位置でソートした配列を暗黙の平衡二分木とみなし、部分木の最大終了位置を持つ）
+
+    区間は半開区間 [start, end)。overlap() は O(log n + k) で重なる区間を返す。
+    """
+
+    def __init__(self, intervals):
+        self._items = sorted(intervals, key=lambda item: (item[0], item[1]))
+        self._starts = [item[0] for item in self._items]
+        self._max_end = [0] * len(self._items)
+        self._build(0, len(self._items))
+
+    def __len__(self):
+        return len(self._items)
+
+    def _build(self, lo, hi):
+        if lo >= hi:
+            return -1
+        mid = (lo + hi) // 2
+        self._max_end[mid] = max(self._items[mid][1], self._build(lo, mid), self._build(mid + 1, hi))
+        return self._max_end[mid]
+
+    def overlap(self, start, end):
+        """[start, end) と重なる区間を開始位置順に返す"""
+        found = []
+        # start >= end の区間は右側にしかないので、探索範囲を先に絞る
+        stack = [(0, len(self._items), bisect_left(self._starts, end))]
+        while stack:
+            lo, hi, limit = stack.pop()
+            if lo >= hi:
+                continue
+            mid = (lo + hi) // 2
+            if self._max_end[mid] <= start:
+                continue
+            if mid < limit:
+                stack.append((mid + 1, hi, limit))
+                if self._items[mid][1] > start:
+                    found.append(self._items[mid])
+            stack.append((lo, mid, limit))
+        found.sort(key=lambda item: (item[0], item[1]))
+        return found
+
+
+def coverage(intervals, key=lambda item: item):
+    """区間の重なりを走査し、(start, end, 重なっている key の集合) の連続区間を返す
+
+    同じ key（例: 学生）の区間どうしの重なりは1つとして数える。
+    """
+    events = []
+    for item in intervals:
+        if item[1] > item[0]:
+            events.append((item[0], 1, key(item)))
+            events.append((item[1], -1, key(item)))
+    events.sort(key=lambda event: (event[0], event[1]))
+
+    segments, active, position = [], {}, None
+    for point, delta, owner in events:
+        if position is not None and point > position and active:
+            owners = frozenset(active)
+            if segments and segments[-1][1] == position and segments[-1][2] == owners:
+                segments[-1] = (segments[-1][0], point, owners)
+            else:
+                segments.append((position, point, owners))
+        position = point
+        active[owner] = active.get(owner, 0) + delta
+        if not active[owner]:
+            del active[owner]
+    return segments
+
+
+# --- 教材ごとの注釈インデックス ---
+_trees = VersionedLocalCache('annotation-index:{}')
+
+
+def invalidate_annotation_index(material_id):
+    """注釈の変更時に呼ぶ。共有キャッシュ上のバージョンを進めて他プロセスの木も無効にする"""
+    _trees.invalidate(material_id)
+
+
+def get_annotation_index(material_id):
+    """教材の注釈の区間木を返す（値は (start, end, id, student_id, annotation_type)）"""
+    from .models import Annotation
+
+    def build():
+        rows = Annotation.objects.filter(material_id=material_id).values_list(
+            'start_position', 'end_position', 'id', 'student_id', 'annotation_type',
+        )
+        return IntervalTree(rows)
+    return _trees.get(material_id, build)
@@ -0,0 +1,101 @@
+import json
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from reading import benchmark
+
+
+class Command(BaseCommand):
+    help = 'API のベンチマーク（p50/p95/p99・スループット・クエリ数）を取り、ベースラインと比較する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', choices=sorted(benchmark.SCALES), default='small')
+        parser.add_argument('--seed', type=int, default=0, help='データ生成の乱数シード')
+        parser.add_argument('--requests', type=int, default=50, help='シナリオごとのリクエスト数')
+        parser.add_argument('--warmup', type=int, default=5)
+        parser.add_argument('--only', action='append', help='実行するシナリオ名（複数指定可）')
+        parser.add_argument('--mode', choices=['wsgi', 'asgi', 'both'], default='wsgi',
+                            help='プロセス内で計測する経路（both なら WSGI と ASGI を並べて表示）')
+        parser.add_argument('--target', action='append',
+                            help='起動中のサーバーの URL（例: http://127.0.0.1:8000）。省略時はプロセス内で実行。'
+                                 'wsgi=URL のように名前を付けて複数指定すると並べて表示する')
+        parser.add_argument('--concurrency', type=int, default=1, help='--target への同時リクエスト数')
+        parser.add_argument('--seed-target-db', action='store_true',
+                            help='--target 使用時に、同じ scale・seed のデータが設定中のデータベースに無ければ作成する'
+                                 '（以前のベンチマークのデータは消して作り直す。ローカル専用）')
+        parser.add_argument('--baseline', help='ベースラインの JSON ファイル')
+        parser.add_argument('--save-baseline', action='store_true', help='結果を --baseline に保存する')
+        parser.add_argument('--threshold', type=float, default=20.0, help='p95 がこの %% 以上悪化したら失敗')
+        parser.add_argument('--json', help='結果を JSON で書き出すファイル')
+
+    def handle(self, *args, **options):
+        if options['target']:
+            runs = self._run_remote(options)
+        else:
+            runs = self._run_in_process(options)
+
+        if len(runs) > 1:
+            if options['baseline']:
+                raise CommandError('--baseline は1つのモード・ターゲットでのみ使えます')
+            self.stdout.write(benchmark.format_side_by_side(runs))
+            if options['json']:
+                Path(options['json']).write_text(json.dumps(runs, indent=2, ensure_ascii=False))
+            return
+        results, = runs.values()
+
+        baseline_path = Path(options['baseline']) if options['baseline'] else None
+        baseline = None
+        if baseline_path and baseline_path.exists() and not options['save_baseline']:
+            baseline = json.loads(baseline_path.read_text())['results']
+        self.stdout.write(benchmark.format_table(results, baseline))
+        if options['json']:
+            Path(options['json']).write_text(json.dumps(results, indent=2, ensure_ascii=False))
+
+        if options['save_baseline']:
+            if not baseline_path:
+                raise CommandError('--save-baseline には --baseline が必要です')
+            baseline_path.parent.mkdir(parents=True, exist_ok=True)
+            baseline_path.write_text(json.dumps({
+                'scale': options['scale'], 'seed': options['seed'], 'requests': options['requests'], 'results': results,
+            }, indent=2, ensure_ascii=False))
+            self.stdout.write(self.style.SUCCESS(f'ベースラインを {baseline_path} に保存しました'))
+        elif baseline is not None:
+            regressions = benchmark.compare(results, baseline, options['threshold'])
+            if regressions:
+                raise CommandError('性能が悪化しました:\n' + '\n'.join(regressions))
+            self.stdout.write(self.style.SUCCESS('ベースラインからの悪化はありません'))
+
+    def _run_in_process(self, options):
+        if options['concurrency'] > 1:
+            raise CommandError('--concurrency は --target と組み合わせて使ってください')
+        modes = ['wsgi', 'asgi'] if options['mode'] == 'both' else [options['mode']]
+        with benchmark.isolated_database():
+            self.stderr.write(f"データを作成しています（{options['scale']}）...")
+            data = benchmark.seed(options['scale'], options['seed'])
+            return benchmark.run_modes(
+                benchmark.scenarios(data), modes,
+                requests=options['requests'], warmup=options['warmup'], only=options['only'],
+            )
+
+    def _run_remote(self, options):
+        # シナリオの ID は設定中のデータベースにある作成済みのデータから決める（サーバーと同じデータベースを指すこと）
+        data = benchmark.load(options['scale'], options['seed'])
+        if data is None:
+            if not options['seed_target_db']:
+                raise CommandError(
+                    f"--scale {options['scale']} --seed {options['seed']} のデータがありません。"
+                    '--seed-target-db を付けて作成してください'
+                )
+            self.stderr.write(f"データを作成しています（{options['scale']}）...")
+            data = benchmark.seed(options['scale'], options['seed'])
+        runs = {}
+        for target in options['target']:
+            name, sep, url = target.partition('=')
+            if not sep or '://' in name:
+                name = url = target
+            runs[name] = benchmark.run(
+                benchmark.HttpDriver(url), benchmark.scenarios(data),
+                requests=options['requests'], warmup=options['warmup'], only=options['only'],
+                concurrency=options['concurrency'],
+            )
+        return runs
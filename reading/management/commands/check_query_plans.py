@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from reading import benchmark
+from reading.explain import check_endpoints, endpoint_urls
+
+
+class Command(BaseCommand):
+    help = 'データを作成したテスト用データベースで各エンドポイントのクエリを EXPLAIN し、全件走査を報告する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', choices=sorted(benchmark.SCALES), default='tiny')
+        parser.add_argument('--allow', action='append', default=[], help='全件走査を許すテーブル（複数指定可）')
+
+    def handle(self, *args, **options):
+        with benchmark.isolated_database():
+            data = benchmark.seed(options['scale'])
+            urls = endpoint_urls(data)
+            findings = check_endpoints(urls, allow=set(options['allow']))
+        for name, table, sql, plan in findings:
+            self.stderr.write(self.style.WARNING(f'{name}: {table} を全件走査しています'))
+            self.stderr.write(f'  {sql}')
+            for line in plan:
+                self.stderr.write(f'    {line}')
+        if findings:
+            raise CommandError(f'{len(findings)} 件の全件走査が見つかりました')
+        self.stdout.write(self.style.SUCCESS(f'{len(urls)} 件のエンドポイントで全件走査はありませんでした'))
@@ -0,0 +1,18 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from reading.activity import compact_chunks
+
+
+class Command(BaseCommand):
+    help = '古い操作ログのチャンクを学生・教材・日ごとに1行へまとめる（cron 等で1日1回実行する）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=float, default=24, metavar='HOURS',
+                            help='この時間より前に終わったチャンクを対象にする（既定 24 時間）')
+
+    def handle(self, *args, **options):
+        merged, removed = compact_chunks(timezone.now() - timedelta(hours=options['older_than']))
+        self.stdout.write(self.style.SUCCESS(f'{removed} チャンクを {merged} 行にまとめました'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from reading.autosave import compact_answer
+from reading.models import StudentAnswer
+
+
+class Command(BaseCommand):
+    help = '未適用の回答差分を本文へ書き戻す（定期実行用）'
+
+    def handle(self, *args, **options):
+        answers = StudentAnswer.objects.filter(patches__isnull=False).distinct().prefetch_related('patches')
+        compacted = sum(compact_answer(answer) for answer in answers.iterator(chunk_size=200))
+        self.stdout.write(self.style.SUCCESS(f'{compacted} 件の回答を書き戻しました'))
@@ -0,0 +1,27 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from reading.export import EXPORTS, FORMATS, iter_export
+
+
+class Command(BaseCommand):
+    help = '回答・注釈・コメントを CSV / JSONL へ少しずつ書き出す'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(EXPORTS))
+        parser.add_argument('--output', choices=sorted(FORMATS), default='csv')
+        parser.add_argument('--material', type=int, dest='material_id')
+        parser.add_argument('--group', type=int, dest='group_id')
+        parser.add_argument('--file', help='出力先（省略時は標準出力）')
+
+    def handle(self, *args, **options):
+        chunks = iter_export(
+            options['kind'], options['output'], material_id=options['material_id'], group_id=options['group_id'],
+        )
+        if options['file']:
+            with open(options['file'], 'w', encoding='utf-8', newline='') as out:
+                out.writelines(chunks)
+            self.stderr.write(self.style.SUCCESS(f"{options['file']} に書き出しました"))
+        else:
+            sys.stdout.writelines(chunks)
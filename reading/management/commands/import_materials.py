@@ -0,0 +1,35 @@
+import json
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from reading.importer import BundleError, import_bundle, parse_bundle, validate_bundle
+
+
+class Command(BaseCommand):
+    help = '教材と問題を JSON / YAML / CSV から取り込む（external_key で upsert するので再実行できる）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file')
+        parser.add_argument('--format', choices=['json', 'yaml', 'csv'], help='省略時は拡張子から判断する')
+        parser.add_argument('--group', type=int, help='バンドルの group を上書きする（CSV では必須）')
+        parser.add_argument('--batch-size', type=int, default=100, help='1トランザクションで取り込む教材数')
+
+    def handle(self, *args, **options):
+        path = Path(options['file'])
+        fmt = options['format'] or {'.yml': 'yaml', '.yaml': 'yaml', '.csv': 'csv'}.get(path.suffix.lower(), 'json')
+        try:
+            data = parse_bundle(path.read_text(encoding='utf-8'), fmt)
+            bundle = validate_bundle(data, group=options['group'])
+        except BundleError as error:
+            raise CommandError(json.dumps(error.errors, ensure_ascii=False, indent=2))
+        except (OSError, ValueError, KeyError) as error:
+            raise CommandError(f'{path} を読み込めません: {error}')
+        summary = import_bundle(bundle, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            '教材: 作成 {materials_created} / 更新 {materials_updated}、'
+            '問題: 作成 {questions_created} / 更新 {questions_updated}'.format(
+                **{key: summary.get(key, 0) for key in (
+                    'materials_created', 'materials_updated', 'questions_created', 'questions_updated')}
+            )
+        ))
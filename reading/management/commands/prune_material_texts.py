@@ -0,0 +1,18 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from reading.models import MaterialText
+
+
+class Command(BaseCommand):
+    help = 'どの教材からも参照されなくなった教材本文を削除する（cron 等で1日1回実行する）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=float, default=24, metavar='HOURS',
+                            help='この時間より前に保存された本文だけを対象にする（保存中の教材と競合しないように。既定 24 時間）')
+
+    def handle(self, *args, **options):
+        deleted = MaterialText.prune(timezone.now() - timedelta(hours=options['older_than']))
+        self.stdout.write(self.style.SUCCESS(f'{deleted} 件の本文を削除しました'))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from reading.search import INDEXERS, rebuild
+
+
+class Command(BaseCommand):
+    help = '全文検索の索引を作り直す（導入時や、索引と本体がずれたとき用）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kind', action='append', choices=sorted(INDEXERS), help='対象の種類（複数指定可、省略時はすべて）')
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        counts = rebuild(options['kind'], chunk_size=options['chunk_size'])
+        for kind, count in counts.items():
+            self.stdout.write(self.style.SUCCESS(f'{kind}: {count} 件を索引しました'))
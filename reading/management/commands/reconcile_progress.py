@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from reading.progress import reconcile_progress
+
+
+class Command(BaseCommand):
+    help = '教員ダッシュボードの進捗集計を回答・コメントから数え直して照合する（導入時に1回、以後は cron 等で定期的に実行する）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--group', type=int, action='append', dest='group_ids', help='対象のグループ ID（複数指定可）')
+        parser.add_argument('--loop', type=float, metavar='SECONDS', help='指定した秒数おきに繰り返す')
+
+    def handle(self, *args, **options):
+        while True:
+            created, updated, deleted = reconcile_progress(options['group_ids'])
+            self.stdout.write(self.style.SUCCESS(
+                f'進捗集計を照合しました（作成 {created}・修正 {updated}・削除 {deleted} 行）'
+            ))
+            if not options['loop']:
+                break
+            close_old_connections()
+            time.sleep(options['loop'])
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from reading.citations import refresh_cited_passages, stale_materials
+from reading.models import ReadingMaterial
+
+
+class Command(BaseCommand):
+    help = '教材ごとの「よく引用される箇所」の集計表を作り直す（cron 等で定期的に実行する）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='引用が変わっていない教材も集計し直す')
+        parser.add_argument('--material', type=int, action='append', dest='material_ids', help='対象の教材 ID（複数指定可）')
+        parser.add_argument('--loop', type=float, metavar='SECONDS', help='指定した秒数おきに繰り返す')
+
+    def handle(self, *args, **options):
+        while True:
+            if options['material_ids']:
+                material_ids = options['material_ids']
+            elif options['all']:
+                material_ids = list(ReadingMaterial.objects.values_list('pk', flat=True))
+            else:
+                material_ids = stale_materials()
+            passages = refresh_cited_passages(material_ids)
+            self.stdout.write(self.style.SUCCESS(f'{len(material_ids)} 教材・{passages} 箇所を集計しました'))
+            if not options['loop']:
+                break
+            close_old_connections()
+            time.sleep(options['loop'])
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from reading.models import ReadingMaterial
+from reading.segments import resegment
+
+
+class Command(BaseCommand):
+    help = '教材本文の区切り（段落・文）を作り直す（導入時や区切り方を変えたとき用）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--material', type=int, action='append', dest='material_ids', help='対象の教材 ID（複数指定可）')
+
+    def handle(self, *args, **options):
+        materials = ReadingMaterial.objects.select_related('text').order_by('pk')
+        if options['material_ids']:
+            materials = materials.filter(pk__in=options['material_ids'])
+        total = 0
+        for material in materials.iterator(chunk_size=100):
+            total += resegment(material)
+        self.stdout.write(self.style.SUCCESS(f'{total} 件の区切りを作成しました'))
@@ -0,0 +1,135 @@
+import threading
+from bisect import bisect_left
+
+# --- プロセス内のメトリクス（Prometheus テキスト形式で公開する） ---
+# gunicorn などの複数ワーカー構成ではワーカーごとの値になる（スクレイプ側で合算する）
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histogram:
+    """ラベルごとの累積ヒストグラム"""
+
+    def __init__(self, name, help, buckets, labels=('route', 'method')):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labels = labels
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def collect(self):
+        with self._lock:
+            snapshot = {labels: (list(counts), total) for labels, (counts, total) in self._series.items()}
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        for label_values, (counts, total) in sorted(snapshot.items()):
+            labels = _labels(self.labels, label_values)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield f'{self.name}_bucket{_labels(self.labels + ("le",), label_values + (bound,))} {cumulative}'
+            yield f'{self.name}_sum{labels} {total}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+
+class Counter:
+    def __init__(self, name, help, labels=('route', 'method')):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._series[label_values] = self._series.get(label_values, 0) + amount
+
+    def collect(self):
+        with self._lock:
+            snapshot = dict(self._series)
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        for label_values, value in sorted(snapshot.items()):
+            yield f'{self.name}{_labels(self.labels, label_values)} {value}'
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+
+class Gauge:
+    """読み出すたびに fn() を呼んで値を得るゲージ。fn は {ラベル値のタプル: 値} を返す"""
+
+    def __init__(self, name, help, fn, labels=()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labels = labels
+
+    def collect(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} gauge'
+        for label_values, value in sorted(self.fn().items()):
+            yield f'{self.name}{_labels(self.labels, label_values)} {value}'
+
+    def reset(self):
+        pass
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+_registry = []
+
+
+def register(metric):
+    _registry.append(metric)
+    return metric
+
+
+def render():
+    """登録済みのメトリクスを Prometheus のテキスト形式で返す"""
+    return '\n'.join(line for metric in _registry for line in metric.collect()) + '\n'
+
+
+def reset():
+    """値をすべて消す（テスト用）"""
+    for metric in _registry:
+        metric.reset()
+
+
+# --- リクエストのメトリクス ---
+REQUESTS = register(Counter(
+    'reading_requests_total', 'Requests handled (all requests, not sampled)', labels=('route', 'method', 'status'),
+))
+REQUEST_SECONDS = register(Histogram(
+    'reading_request_seconds', 'Wall time per request (all requests, not sampled)', SECONDS_BUCKETS,
+))
+DB_QUERIES = register(Histogram('reading_db_queries', 'DB queries per sampled request', COUNT_BUCKETS))
+DB_SECONDS = register(Histogram('reading_db_seconds', 'DB time per sampled request', SECONDS_BUCKETS))
+RENDER_SECONDS = register(Histogram(
+    'reading_serialize_seconds', 'Response rendering time per sampled request', SECONDS_BUCKETS,
+))
+RESPONSE_BYTES = register(Histogram('reading_response_bytes', 'Response body size per sampled request', BYTES_BUCKETS))
@@ -0,0 +1,256 @@
+import gzip
+import logging
+import random
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.utils.cache import patch_vary_headers
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+from . import metrics
+
+try:
+    import brotli
+except ImportError:  # brotli は任意（無ければ gzip だけを使う）
+    brotli = None
+
+logger = logging.getLogger('reading.profiling')
+
+SLOW_SQL_LIMIT = 20
+
+
+class _QueryRecorder:
+    """connection.execute_wrapper に渡して、クエリの件数・時間・SQL を記録する"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.seconds += elapsed
+            self.queries.append((elapsed, sql))
+
+
+class ProfilingMiddleware:
+    """ルートごとの処理時間・クエリ数・DB 時間・レンダリング時間・レスポンスサイズを記録する
+
+    settings.PROFILING_ENABLED が False なら読み込まれない（オプトイン）。
+    処理時間と件数は全リクエストで記録し、クエリ・レンダリング・サイズは
+    PROFILING_SAMPLE_RATE の割合のリクエストだけで計測する。
+    PROFILING_SLOW_REQUEST_MS を超えたリクエストはログに出す（計測対象なら SQL も含める）。
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILING_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = float(getattr(settings, 'PROFILING_SAMPLE_RATE', 0.01))
+        self.slow_seconds = float(getattr(settings, 'PROFILING_SLOW_REQUEST_MS', 1000)) / 1000
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        recorder = self._sample(request)
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            if recorder is not None:
+                self._record_queries(stack, recorder)
+            response = self.get_response(request)
+        self._observe(request, response, time.perf_counter() - started, recorder)
+        return response
+
+    async def __acall__(self, request):
+        recorder = self._sample(request)
+        started = time.perf_counter()
+        stack = ExitStack()
+        if recorder is not None:
+            # ASGI では DB はリクエスト用のスレッドで使われるので、そのスレッドの接続に仕掛ける
+            await sync_to_async(self._record_queries)(stack, recorder)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(stack.close)()
+        self._observe(request, response, time.perf_counter() - started, recorder)
+        return response
+
+    def _sample(self, request):
+        if random.random() >= self.sample_rate:
+            return None
+        request._profiling_render = [0.0]
+        return _QueryRecorder()
+
+    def _record_queries(self, stack, recorder):
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(recorder))
+
+    def _observe(self, request, response, elapsed, recorder):
+        match = getattr(request, 'resolver_match', None)
+        route = match.view_name if match and match.view_name else 'unresolved'
+        method = request.method
+        metrics.REQUESTS.inc(route, method, str(response.status_code))
+        metrics.REQUEST_SECONDS.observe(elapsed, route, method)
+        if recorder is not None:
+            metrics.DB_QUERIES.observe(recorder.count, route, method)
+            metrics.DB_SECONDS.observe(recorder.seconds, route, method)
+            metrics.RENDER_SECONDS.observe(request._profiling_render[0], route, method)
+            if not response.streaming:
+                metrics.RESPONSE_BYTES.observe(len(response.content), route, method)
+        if elapsed >= self.slow_seconds:
+            self._log_slow(request, route, elapsed, recorder)
+
+    def process_template_response(self, request, response):
+        # DRF の Response はこの後で render() される。その時間をシリアライズ時間として計る
+        timer = getattr(request, '_profiling_render', None)
+        if timer is not None:
+            started = time.perf_counter()
+
+            def rendered(response):
+                timer[0] += time.perf_counter() - started
+            response.add_post_render_callback(rendered)
+        return response
+
+    def _log_slow(self, request, route, elapsed, recorder):
+        if recorder is None:
+            logger.warning('slow request %s %s (%s): %.1f ms', request.method, request.path, route, elapsed * 1000)
+            return
+        slowest = sorted(recorder.queries, key=lambda query: query[0], reverse=True)[:SLOW_SQL_LIMIT]
+        logger.warning(
+            'slow request %s %s (%s): %.1f ms, %d queries, %.1f ms in DB\n%s',
+            request.method, request.path, route, elapsed * 1000, recorder.count, recorder.seconds * 1000,
+            '\n'.join(f'  {seconds * 1000:.1f} ms  {sql}' for seconds, sql in slowest),
+        )
+
+
+class StaticFilesMiddleware(WhiteNoiseMiddleware):
+    """WhiteNoise の非同期対応版
+
+    WhiteNoiseMiddleware は同期専用なので、ASGI ではそれより内側のミドルウェアとビューが
+    すべて同期スレッドで動いてしまう。静的ファイル以外はそのまま非同期で次へ渡す。
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, settings=settings):
+        super().__init__(get_response, settings)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = await sync_to_async(self.find_file)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return await sync_to_async(self.serve)(static_file, request)
+        return await self.get_response(request)
+
+
+# --- レスポンスの圧縮 ---
+COMPRESSED_BYTES = metrics.register(metrics.Counter(
+    'reading_compression_bytes_total', 'Response body bytes before and after compression',
+    labels=('encoding', 'stage'),
+))
+
+
+def accepted_encodings(header):
+    """Accept-Encoding を {符号化: q 値} にする"""
+    accepted = {}
+    for item in header.split(','):
+        name, _, params = item.strip().partition(';')
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name.strip().lower()] = q
+    return accepted
+
+
+def choose_encoding(header):
+    """使う符号化（'br' / 'gzip'）。どちらも受け付けなければ None"""
+    accepted = accepted_encodings(header)
+    candidates = (['br'] if brotli is not None else []) + ['gzip']
+    scored = [(accepted.get(name, accepted.get('*', 0.0)), -rank, name) for rank, name in enumerate(candidates)]
+    q, _, name = max(scored)
+    return name if q > 0 else None
+
+
+class CompressionMiddleware:
+    """レスポンス本文を Accept-Encoding に応じて brotli（インストールされていれば）または gzip で圧縮する
+
+    RESPONSE_COMPRESSION_MIN_BYTES 未満の本文、ストリーミング（SSE・エクスポート）、
+    既に符号化されたもの（WhiteNoise の静的ファイル）は圧縮しない。
+    Django の GZipMiddleware と違い、ASGI でもリクエストを同期スレッドに移さない。
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'RESPONSE_COMPRESSION', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.min_bytes = int(getattr(settings, 'RESPONSE_COMPRESSION_MIN_BYTES', 512))
+        self.gzip_level = int(getattr(settings, 'RESPONSE_GZIP_LEVEL', 6))
+        self.brotli_quality = int(getattr(settings, 'RESPONSE_BROTLI_QUALITY', 5))
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.compress(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.compress(request, await self.get_response(request))
+
+    def compress(self, request, response):
+        if response.streaming or response.has_header('Content-Encoding') or len(response.content) < self.min_bytes:
+            return response
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return response
+        body = response.content
+        if encoding == 'br':
+            compressed = brotli.compress(body, quality=self.brotli_quality)
+        else:
+            compressed = gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
+        if len(compressed) >= len(body):
+            return response
+        COMPRESSED_BYTES.inc(encoding, 'original', amount=len(body))
+        COMPRESSED_BYTES.inc(encoding, 'compressed', amount=len(compressed))
+        response.content = compressed
+        response['Content-Length'] = str(len(compressed))
+        response['Content-Encoding'] = encoding
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            # 符号化した本文は元と同じバイト列ではないので弱い ETag にする（httpcache は弱い比較で照合する）
+            response['ETag'] = 'W/' + etag
+        return response
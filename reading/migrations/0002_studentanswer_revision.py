@@ -0,0 +1,18 @@
+# Generated by Django 4.2.9 on 2026-10-18 13:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reading', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studentanswer',
+            name='revision',
+            field=models.PositiveBigIntegerField(default=0, verbose_name='リビジョン'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.9 on 2026-10-18 13:23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reading', '0002_studentanswer_revision'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnswerPatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('base_revision', models.PositiveBigIntegerField(verbose_name='基準リビジョン')),
+                ('revision', models.PositiveBigIntegerField(verbose_name='リビジョン')),
+                ('ops', models.JSONField(verbose_name='差分操作')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='作成日時')),
+                ('answer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='patches', to='reading.studentanswer', verbose_name='回答')),
+            ],
+            options={
+                'verbose_name': '回答の差分',
+                'verbose_name_plural': '回答の差分',
+                'ordering': ['base_revision'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='answerpatch',
+            constraint=models.UniqueConstraint(fields=('answer', 'base_revision'), name='unique_answer_patch_base'),
+        ),
+    ]
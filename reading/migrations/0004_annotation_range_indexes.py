@@ -0,0 +1,21 @@
+# Generated by Django 4.2.9 on 2026-10-18 13:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reading', '0003_answerpatch'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='annotation',
+            index=models.Index(fields=['material', 'start_position', 'end_position'], name='annotation_material_range'),
+        ),
+        migrations.AddIndex(
+            model_name='annotation',
+            index=models.Index(fields=['material', 'student', 'start_position'], name='annotation_student_range'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.9 on 2026-10-18 13:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reading', '0004_annotation_range_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='annotation',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, verbose_name='更新日時'),
+        ),
+    ]
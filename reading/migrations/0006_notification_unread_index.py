@@ -0,0 +1,17 @@
+# Generated by Django 4.2.9 on 2026-10-18 13:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reading', '0005_annotation_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(('is_read', False)), fields=['recipient', 'is_read'], name='notification_unread'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.9 on 2026-10-18 13:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reading', '0006_notification_unread_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='question',
+            name='external_key',
+            field=models.CharField(blank=True, max_length=100, null=True, verbose_name='外部キー'),
+        ),
+        migrations.AddField(
+            model_name='readingmaterial',
+            name='external_key',
+            field=models.CharField(blank=True, max_length=100, null=True, verbose_name='外部キー'),
+        ),
+        migrations.AddConstraint(
+            model_name='question',
+            constraint=models.UniqueConstraint(fields=('material', 'external_key'), name='unique_question_external_key'),
+        ),
+        migrations.AddConstraint(
+            model_name='readingmaterial',
+            constraint=models.UniqueConstraint(fields=('group', 'external_key'), name='unique_material_external_key'),
+        ),
+    ]
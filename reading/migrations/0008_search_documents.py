@@ -0,0 +1,74 @@
+# Generated by Django 4.2.9 on 2026-10-18 13:35
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+SQLITE_FORWARD = [
+    # tokens だけを持つ外部コンテンツの FTS5 テーブル。トリガーで本体と同期する
+    "CREATE VIRTUAL TABLE reading_searchdocument_fts USING fts5("
+    "tokens, content='reading_searchdocument', content_rowid='id', tokenize='unicode61 remove_diacritics 0')",
+    "CREATE TRIGGER reading_searchdocument_ai AFTER INSERT ON reading_searchdocument BEGIN "
+    "INSERT INTO reading_searchdocument_fts(rowid, tokens) VALUES (new.id, new.tokens); END",
+    "CREATE TRIGGER reading_searchdocument_ad AFTER DELETE ON reading_searchdocument BEGIN "
+    "INSERT INTO reading_searchdocument_fts(reading_searchdocument_fts, rowid, tokens) VALUES ('delete', old.id, old.tokens); END",
+    "CREATE TRIGGER reading_searchdocument_au AFTER UPDATE ON reading_searchdocument BEGIN "
+    "INSERT INTO reading_searchdocument_fts(reading_searchdocument_fts, rowid, tokens) VALUES ('delete', old.id, old.tokens); "
+    "INSERT INTO reading_searchdocument_fts(rowid, tokens) VALUES (new.id, new.tokens); END",
+]
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS reading_searchdocument_au",
+    "DROP TRIGGER IF EXISTS reading_searchdocument_ad",
+    "DROP TRIGGER IF EXISTS reading_searchdocument_ai",
+    "DROP TABLE IF EXISTS reading_searchdocument_fts",
+]
+POSTGRES_FORWARD = [
+    "CREATE INDEX reading_searchdocument_tokens_gin ON reading_searchdocument "
+    "USING gin (to_tsvector('simple'::regconfig, tokens))",
+]
+POSTGRES_BACKWARD = [
+    "DROP INDEX IF EXISTS reading_searchdocument_tokens_gin",
+]
+
+
+def _run(statements):
+    def run(apps, schema_editor):
+        vendor = schema_editor.connection.vendor
+        for sql in statements.get(vendor, []):
+            schema_editor.execute(sql)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reading', '0007_external_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('material', '教材'), ('answer', '回答'), ('comment', 'コメント')], max_length=20, verbose_name='種類')),
+                ('object_id', models.PositiveBigIntegerField(verbose_name='対象 ID')),
+                ('text', models.TextField(verbose_name='本文')),
+                ('tokens', models.TextField(verbose_name='トークン')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新日時')),
+                ('material', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_documents', to='reading.readingmaterial', verbose_name='教材')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='ユーザー')),
+            ],
+            options={
+                'verbose_name': '検索文書',
+                'verbose_name_plural': '検索文書',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='searchdocument',
+            constraint=models.UniqueConstraint(fields=('kind', 'object_id'), name='unique_search_document'),
+        ),
+        migrations.RunPython(
+            _run({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRES_FORWARD}),
+            _run({'sqlite': SQLITE_BACKWARD, 'postgresql': POSTGRES_BACKWARD}),
+        ),
+    ]
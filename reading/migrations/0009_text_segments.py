@@ -0,0 +1,41 @@
+# Generated by Django 4.2.9 on 2026-10-18 13:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reading', '0008_search_documents'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TextSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=20, verbose_name='区切り ID')),
+                ('position', models.PositiveIntegerField(verbose_name='通し番号')),
+                ('paragraph', models.PositiveIntegerField(verbose_name='段落番号')),
+                ('start', models.PositiveIntegerField(verbose_name='開始位置')),
+                ('end', models.PositiveIntegerField(verbose_name='終了位置')),
+                ('text', models.TextField(verbose_name='本文')),
+                ('material', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='segments', to='reading.readingmaterial', verbose_name='教材')),
+            ],
+            options={
+                'verbose_name': '本文の区切り',
+                'verbose_name_plural': '本文の区切り',
+                'ordering': ['position'],
+                'indexes': [models.Index(fields=['material', 'start'], name='segment_material_start')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='textsegment',
+            constraint=models.UniqueConstraint(fields=('material', 'position'), name='unique_segment_position'),
+        ),
+        migrations.AddConstraint(
+            model_name='textsegment',
+            constraint=models.UniqueConstraint(fields=('material', 'key'), name='unique_segment_key'),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 4.2.9 on 2026-10-18 13:39
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reading', '0009_text_segments'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CitationSummary',
+            fields=[
+                ('material', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='citation_summary', serialize=False, to='reading.readingmaterial', verbose_name='教材')),
+                ('changed_at', models.DateTimeField(verbose_name='引用の更新日時')),
+                ('refreshed_at', models.DateTimeField(blank=True, null=True, verbose_name='集計日時')),
+            ],
+            options={
+                'verbose_name': '引用集計の状態',
+                'verbose_name_plural': '引用集計の状態',
+            },
+        ),
+        migrations.CreateModel(
+            name='CitedPassage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('segment_key', models.CharField(max_length=20, verbose_name='区切り ID')),
+                ('position', models.PositiveIntegerField(verbose_name='通し番号')),
+                ('start', models.PositiveIntegerField(verbose_name='開始位置')),
+                ('end', models.PositiveIntegerField(verbose_name='終了位置')),
+                ('text', models.TextField(verbose_name='本文')),
+                ('citation_count', models.PositiveIntegerField(verbose_name='引用数')),
+                ('student_count', models.PositiveIntegerField(verbose_name='引用した学生数')),
+                ('material', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cited_passages', to='reading.readingmaterial', verbose_name='教材')),
+            ],
+            options={
+                'verbose_name': 'よく引用される箇所',
+                'verbose_name_plural': 'よく引用される箇所',
+                'ordering': ['-citation_count', 'position'],
+                'indexes': [models.Index(fields=['material', '-citation_count', 'position'], name='cited_passage_rank')],
+            },
+        ),
+        migrations.CreateModel(
+            name='Citation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.PositiveIntegerField(verbose_name='開始位置')),
+                ('end', models.PositiveIntegerField(verbose_name='終了位置')),
+                ('answer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='citation_spans', to='reading.studentanswer', verbose_name='回答')),
+                ('material', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='citations', to='reading.readingmaterial', verbose_name='教材')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='学生')),
+            ],
+            options={
+                'verbose_name': '引用箇所',
+                'verbose_name_plural': '引用箇所',
+                'indexes': [models.Index(fields=['material', 'start', 'end'], name='citation_material_range')],
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.9 on 2026-10-18 13:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reading', '0010_citations'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='notification',
+            name='notification_unread',
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['target_answer', '-created_at'], name='comment_answer_recent'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['recipient', 'is_read', '-created_at'], name='notification_inbox'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(('is_read', False)), fields=['recipient', '-created_at'], name='notification_unread'),
+        ),
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(fields=['material', 'order'], name='question_material_order'),
+        ),
+        migrations.AddIndex(
+            model_name='studentanswer',
+            index=models.Index(fields=['question', '-updated_at'], name='answer_question_recent'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.9 on 2026-10-18 13:55
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reading', '0011_access_pattern_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivityChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started_at', models.DateTimeField(verbose_name='最初のイベント')),
+                ('ended_at', models.DateTimeField(verbose_name='最後のイベント')),
+                ('event_count', models.PositiveIntegerField(verbose_name='イベント数')),
+                ('events', models.BinaryField(verbose_name='イベント（圧縮済み）')),
+                ('material', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='activity_chunks', to='reading.readingmaterial', verbose_name='教材')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='学生')),
+            ],
+            options={
+                'verbose_name': '操作ログ',
+                'verbose_name_plural': '操作ログ',
+                'indexes': [models.Index(fields=['student', 'material', 'started_at'], name='activity_session'), models.Index(fields=['student', 'started_at'], name='activity_student_time')],
+            },
+        ),
+    ]
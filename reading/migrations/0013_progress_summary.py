@@ -0,0 +1,36 @@
+# Generated by Django 4.2.9 on 2026-10-18 13:59
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reading', '0012_activity_log'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProgressSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('answered_count', models.IntegerField(default=0, verbose_name='回答数')),
+                ('comment_count', models.IntegerField(default=0, verbose_name='コメント数')),
+                ('unread_comment_count', models.IntegerField(default=0, verbose_name='教員の未読コメント数')),
+                ('seen_at', models.DateTimeField(blank=True, null=True, verbose_name='教員が確認した日時')),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='progress', to='reading.group', verbose_name='グループ')),
+                ('material', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='progress', to='reading.readingmaterial', verbose_name='教材')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='学生')),
+            ],
+            options={
+                'verbose_name': '進捗集計',
+                'verbose_name_plural': '進捗集計',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='progresssummary',
+            constraint=models.UniqueConstraint(fields=('group', 'material', 'student'), name='unique_progress_cell'),
+        ),
+    ]
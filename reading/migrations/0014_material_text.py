@@ -0,0 +1,80 @@
+import hashlib
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils import timezone
+
+
+def move_content(apps, schema_editor):
+    """教材の本文を MaterialText へ移し、同じ本文は1行にまとめる"""
+    MaterialText = apps.get_model('reading', 'MaterialText')
+    ReadingMaterial = apps.get_model('reading', 'ReadingMaterial')
+    now = timezone.now()
+    batch = []
+    for material in ReadingMaterial.objects.only('pk', 'content').iterator(chunk_size=500):
+        material.text_id = hashlib.sha256(material.content.encode()).hexdigest()
+        batch.append(material)
+        if len(batch) >= 500:
+            _save(MaterialText, ReadingMaterial, batch, now)
+            batch = []
+    _save(MaterialText, ReadingMaterial, batch, now)
+
+
+def _save(MaterialText, ReadingMaterial, materials, now):
+    texts = {
+        material.text_id: MaterialText(digest=material.text_id, content=material.content, length=len(material.content), used_at=now)
+        for material in materials
+    }
+    MaterialText.objects.bulk_create(texts.values(), ignore_conflicts=True)
+    ReadingMaterial.objects.bulk_update(materials, ['text'])
+
+
+def restore_content(apps, schema_editor):
+    ReadingMaterial = apps.get_model('reading', 'ReadingMaterial')
+    materials = list(ReadingMaterial.objects.select_related('text'))
+    for material in materials:
+        material.content = material.text.content
+    ReadingMaterial.objects.bulk_update(materials, ['content'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reading', '0013_progress_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MaterialText',
+            fields=[
+                ('digest', models.CharField(max_length=64, primary_key=True, serialize=False, verbose_name='SHA-256')),
+                ('content', models.TextField(verbose_name='本文')),
+                ('length', models.PositiveIntegerField(verbose_name='文字数')),
+                ('used_at', models.DateTimeField(auto_now=True, verbose_name='最後に保存された日時')),
+            ],
+            options={
+                'verbose_name': '教材本文',
+                'verbose_name_plural': '教材本文',
+            },
+        ),
+        migrations.AddField(
+            model_name='readingmaterial',
+            name='text',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='materials', to='reading.materialtext', verbose_name='本文'),
+        ),
+        migrations.AlterField(
+            model_name='readingmaterial',
+            name='content',
+            field=models.TextField(default='', verbose_name='本文'),
+        ),
+        migrations.RunPython(move_content, restore_content),
+        migrations.RemoveField(
+            model_name='readingmaterial',
+            name='content',
+        ),
+        migrations.AlterField(
+            model_name='readingmaterial',
+            name='text',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='materials', to='reading.materialtext', verbose_name='本文'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+from django.db import migrations
+
+from reading.segments import segment_keys, split_segments
+
+
+def backfill_segments(apps, schema_editor):
+    """区切りが未作成の教材（0009 より前のデータ）の区切りを作る（GET では作らない）"""
+    ReadingMaterial = apps.get_model('reading', 'ReadingMaterial')
+    TextSegment = apps.get_model('reading', 'TextSegment')
+    materials = ReadingMaterial.objects.filter(segments__isnull=True).select_related('text').order_by('pk')
+    for material in materials.iterator(chunk_size=100):
+        segments = split_segments(material.text.content)
+        keys = segment_keys(text for _, _, _, text in segments)
+        TextSegment.objects.bulk_create([
+            TextSegment(material=material, key=key, position=position, paragraph=paragraph, start=start, end=end, text=text)
+            for position, (key, (paragraph, start, end, text)) in enumerate(zip(keys, segments))
+        ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reading', '0014_material_text'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_segments, migrations.RunPython.noop),
+    ]
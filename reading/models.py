@@ -1,5 +1,8 @@
+import hashlib
+
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
 from django.contrib.auth.models import AbstractUser, BaseUserManager
 
 # --- ユーザーマネージャー ---
@@ -57,21 +60,115 @@ class Group(models.Model):
     def __str__(self):
         return self.name
 
+# --- 教材本文（内容のハッシュで識別し、同じ本文は1行だけ保存する） ---
+class MaterialText(models.Model):
+    digest = models.CharField(max_length=64, primary_key=True, verbose_name='SHA-256')
+    content = models.TextField(verbose_name='本文')
+    length = models.PositiveIntegerField(verbose_name='文字数')
+    used_at = models.DateTimeField(auto_now=True, verbose_name='最後に保存された日時')
+
+    class Meta:
+        verbose_name = '教材本文'
+        verbose_name_plural = '教材本文'
+
+    @staticmethod
+    def digest_of(content):
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    @classmethod
+    def for_content(cls, content):
+        """本文に対応する（未保存の）インスタンス。保存は store で行う"""
+        return cls(digest=cls.digest_of(content), content=content, length=len(content))
+
+    @classmethod
+    def store(cls, texts):
+        """本文を1回の INSERT ... ON CONFLICT で保存する（既にあれば used_at だけ更新する）"""
+        texts = list({text.digest: text for text in texts}.values())
+        if texts:
+            now = timezone.now()
+            for text in texts:
+                text.used_at = now
+            cls.objects.bulk_create(texts, update_conflicts=True, unique_fields=['digest'], update_fields=['used_at'])
+
+    @classmethod
+    def prune(cls, before):
+        """どの教材からも参照されず、before より前に保存された本文を削除する。削除した件数を返す"""
+        return cls.objects.filter(materials__isnull=True, used_at__lt=before).delete()[0]
+
+    def __str__(self):
+        return f"{self.digest[:12]} ({self.length})"
+
 # --- 読解教材 ---
 class ReadingMaterial(models.Model):
     title = models.CharField(max_length=200, verbose_name='タイトル')
-    content = models.TextField(verbose_name='本文')
+    # 本文は MaterialText に置き、content プロパティで読み書きする
+    text = models.ForeignKey(MaterialText, on_delete=models.PROTECT, related_name='materials', verbose_name='本文')
     group = models.ForeignKey(Group, on_delete=models.CASCADE, verbose_name='対象グループ')
     created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name='作成者')
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='作成日時')
+    external_key = models.CharField(max_length=100, blank=True, null=True, verbose_name='外部キー')
     
     class Meta:
         verbose_name = '読解教材'
         verbose_name_plural = '読解教材'
+        constraints = [
+            models.UniqueConstraint(fields=['group', 'external_key'], name='unique_material_external_key'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # 本文の変更時に注釈・引用の位置を移すため、読み込み時の本文のハッシュを覚えておく
+        instance._loaded_digest = instance.__dict__.get('text_id')
+        return instance
+
+    @property
+    def content(self):
+        return self.text.content
+
+    @content.setter
+    def content(self, value):
+        self.text = MaterialText.for_content(value)
+
+    @property
+    def content_changed(self):
+        return self.text_id != getattr(self, '_loaded_digest', None)
+
+    def save(self, *args, **kwargs):
+        if self.text_id is None:
+            self.content = ''
+        if self.content_changed:
+            MaterialText.store([self.text])
+        super().save(*args, **kwargs)
     
     def __str__(self):
         return self.title
 
+# --- 本文の区切り（段落・文） ---
+class TextSegment(models.Model):
+    material = models.ForeignKey(ReadingMaterial, on_delete=models.CASCADE, related_name='segments', verbose_name='教材')
+    key = models.CharField(max_length=20, verbose_name='区切り ID')
+    position = models.PositiveIntegerField(verbose_name='通し番号')
+    paragraph = models.PositiveIntegerField(verbose_name='段落番号')
+    start = models.PositiveIntegerField(verbose_name='開始位置')
+    end = models.PositiveIntegerField(verbose_name='終了位置')
+    text = models.TextField(verbose_name='本文')
+
+    class Meta:
+        verbose_name = '本文の区切り'
+        verbose_name_plural = '本文の区切り'
+        ordering = ['position']
+        constraints = [
+            models.UniqueConstraint(fields=['material', 'position'], name='unique_segment_position'),
+            models.UniqueConstraint(fields=['material', 'key'], name='unique_segment_key'),
+        ]
+        indexes = [
+            models.Index(fields=['material', 'start'], name='segment_material_start'),
+        ]
+
+    def __str__(self):
+        return f"{self.material_id}:{self.key}"
+
 # --- 問題 ---
 class Question(models.Model):
     QUESTION_TYPES = [
@@ -85,11 +182,18 @@ class Question(models.Model):
     correct_answer = models.TextField(blank=True, verbose_name='正解例')
     hide_text = models.BooleanField(default=False, verbose_name='文章を非表示にする')
     order = models.IntegerField(default=0, verbose_name='問題順序')
+    external_key = models.CharField(max_length=100, blank=True, null=True, verbose_name='外部キー')
     
     class Meta:
         verbose_name = '問題'
         verbose_name_plural = '問題'
         ordering = ['order']
+        constraints = [
+            models.UniqueConstraint(fields=['material', 'external_key'], name='unique_question_external_key'),
+        ]
+        indexes = [
+            models.Index(fields=['material', 'order'], name='question_material_order'),
+        ]
     
     def __str__(self):
         return f"{self.material.title} - 問題{self.order}"
@@ -101,6 +205,7 @@ class StudentAnswer(models.Model):
     answer_text = models.TextField(verbose_name='回答内容')
     reasoning_note = models.TextField(blank=True, verbose_name='思考過程のノート')
     citations = models.JSONField(blank=True, null=True, verbose_name='引用箇所')
+    revision = models.PositiveBigIntegerField(default=0, verbose_name='リビジョン')
     submitted_at = models.DateTimeField(auto_now_add=True, verbose_name='提出日時')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='更新日時')
     
@@ -108,10 +213,33 @@ class StudentAnswer(models.Model):
         verbose_name = '学生回答'
         verbose_name_plural = '学生回答'
         unique_together = ['student', 'question']
+        indexes = [
+            # 問題ごとの集計（回答数・最終更新）用。question 単独の FK インデックスを兼ねる
+            models.Index(fields=['question', '-updated_at'], name='answer_question_recent'),
+        ]
     
     def __str__(self):
         return f"{self.student.username} - {self.question}"
 
+# --- 回答の差分 ---
+class AnswerPatch(models.Model):
+    answer = models.ForeignKey(StudentAnswer, on_delete=models.CASCADE, related_name='patches', verbose_name='回答')
+    base_revision = models.PositiveBigIntegerField(verbose_name='基準リビジョン')
+    revision = models.PositiveBigIntegerField(verbose_name='リビジョン')
+    ops = models.JSONField(verbose_name='差分操作')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='作成日時')
+
+    class Meta:
+        verbose_name = '回答の差分'
+        verbose_name_plural = '回答の差分'
+        ordering = ['base_revision']
+        constraints = [
+            models.UniqueConstraint(fields=['answer', 'base_revision'], name='unique_answer_patch_base'),
+        ]
+
+    def __str__(self):
+        return f"{self.answer} ({self.base_revision} → {self.revision})"
+
 # --- 注釈 ---
 class Annotation(models.Model):
     ANNOTATION_TYPES = [
@@ -133,10 +261,15 @@ class Annotation(models.Model):
     content = models.TextField(blank=True, verbose_name='注釈内容')
     color = models.CharField(max_length=7, choices=COLORS, default='#ffff00', verbose_name='色')
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='作成日時')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='更新日時')
     
     class Meta:
         verbose_name = '注釈'
         verbose_name_plural = '注釈'
+        indexes = [
+            models.Index(fields=['material', 'start_position', 'end_position'], name='annotation_material_range'),
+            models.Index(fields=['material', 'student', 'start_position'], name='annotation_student_range'),
+        ]
     
     def __str__(self):
         return f"{self.student.username} - {self.get_annotation_type_display()}"
@@ -153,6 +286,9 @@ class Comment(models.Model):
         verbose_name = 'コメント'
         verbose_name_plural = 'コメント'
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['target_answer', '-created_at'], name='comment_answer_recent'),
+        ]
     
     def __str__(self):
         return f"{self.author.username} → {self.target_answer.student.username}"
@@ -177,6 +313,148 @@ class Notification(models.Model):
         verbose_name = '通知'
         verbose_name_plural = '通知'
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['recipient', 'is_read', '-created_at'], name='notification_inbox'),
+            # 未読は全体のごく一部なので、未読件数・未読一覧は小さい部分インデックスで引く
+            models.Index(
+                fields=['recipient', '-created_at'], condition=models.Q(is_read=False), name='notification_unread',
+            ),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # 未読数カウンタの増減判定のため、読み込み時の既読状態を覚えておく
+        instance._loaded_is_read = instance.__dict__.get('is_read')
+        return instance
     
     def __str__(self):
         return f"{self.recipient.username} - {self.title}"
+
+# --- 全文検索 ---
+class SearchDocument(models.Model):
+    """教材・回答・コメントの検索用の文書（本文を n-gram に分割したもの）
+
+    SQLite では FTS5 の仮想テーブル、Postgres では tokens の GIN インデックスで検索する（migrations 参照）。
+    """
+    KINDS = [
+        ('material', '教材'),
+        ('answer', '回答'),
+        ('comment', 'コメント'),
+    ]
+    kind = models.CharField(max_length=20, choices=KINDS, verbose_name='種類')
+    object_id = models.PositiveBigIntegerField(verbose_name='対象 ID')
+    material = models.ForeignKey(ReadingMaterial, on_delete=models.CASCADE, related_name='search_documents', verbose_name='教材')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True, blank=True, verbose_name='ユーザー')
+    text = models.TextField(verbose_name='本文')
+    tokens = models.TextField(verbose_name='トークン')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='更新日時')
+
+    class Meta:
+        verbose_name = '検索文書'
+        verbose_name_plural = '検索文書'
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'object_id'], name='unique_search_document'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind}:{self.object_id}"
+
+# --- 引用箇所（StudentAnswer.citations を正規化したもの） ---
+class Citation(models.Model):
+    answer = models.ForeignKey(StudentAnswer, on_delete=models.CASCADE, related_name='citation_spans', verbose_name='回答')
+    material = models.ForeignKey(ReadingMaterial, on_delete=models.CASCADE, related_name='citations', verbose_name='教材')
+    student = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+', verbose_name='学生')
+    start = models.PositiveIntegerField(verbose_name='開始位置')
+    end = models.PositiveIntegerField(verbose_name='終了位置')
+
+    class Meta:
+        verbose_name = '引用箇所'
+        verbose_name_plural = '引用箇所'
+        indexes = [
+            models.Index(fields=['material', 'start', 'end'], name='citation_material_range'),
+        ]
+
+    def __str__(self):
+        return f"{self.answer_id}: {self.start}-{self.end}"
+
+class CitedPassage(models.Model):
+    """教材の文ごとの引用数の集計（refresh_cited_passages で定期的に作り直す）"""
+    material = models.ForeignKey(ReadingMaterial, on_delete=models.CASCADE, related_name='cited_passages', verbose_name='教材')
+    segment_key = models.CharField(max_length=20, verbose_name='区切り ID')
+    position = models.PositiveIntegerField(verbose_name='通し番号')
+    start = models.PositiveIntegerField(verbose_name='開始位置')
+    end = models.PositiveIntegerField(verbose_name='終了位置')
+    text = models.TextField(verbose_name='本文')
+    citation_count = models.PositiveIntegerField(verbose_name='引用数')
+    student_count = models.PositiveIntegerField(verbose_name='引用した学生数')
+
+    class Meta:
+        verbose_name = 'よく引用される箇所'
+        verbose_name_plural = 'よく引用される箇所'
+        ordering = ['-citation_count', 'position']
+        indexes = [
+            models.Index(fields=['material', '-citation_count', 'position'], name='cited_passage_rank'),
+        ]
+
+    def __str__(self):
+        return f"{self.material_id}:{self.segment_key} ({self.citation_count})"
+
+class CitationSummary(models.Model):
+    """教材ごとの集計の状態（changed_at が refreshed_at より新しければ再集計が必要）"""
+    material = models.OneToOneField(ReadingMaterial, on_delete=models.CASCADE, primary_key=True, related_name='citation_summary', verbose_name='教材')
+    changed_at = models.DateTimeField(verbose_name='引用の更新日時')
+    refreshed_at = models.DateTimeField(null=True, blank=True, verbose_name='集計日時')
+
+    class Meta:
+        verbose_name = '引用集計の状態'
+        verbose_name_plural = '引用集計の状態'
+
+    @property
+    def stale(self):
+        return self.refreshed_at is None or self.changed_at > self.refreshed_at
+
+    def __str__(self):
+        return f"{self.material_id} ({'stale' if self.stale else 'fresh'})"
+
+# --- 学習中の操作ログ（授業の再生用。reading.activity がまとめて追記する） ---
+class ActivityChunk(models.Model):
+    """学生・教材ごとの操作イベントを時刻順に並べて圧縮したもの（追記のみ）"""
+    student = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+', verbose_name='学生')
+    material = models.ForeignKey(ReadingMaterial, on_delete=models.CASCADE, related_name='activity_chunks', verbose_name='教材')
+    started_at = models.DateTimeField(verbose_name='最初のイベント')
+    ended_at = models.DateTimeField(verbose_name='最後のイベント')
+    event_count = models.PositiveIntegerField(verbose_name='イベント数')
+    events = models.BinaryField(verbose_name='イベント（圧縮済み）')
+
+    class Meta:
+        verbose_name = '操作ログ'
+        verbose_name_plural = '操作ログ'
+        indexes = [
+            models.Index(fields=['student', 'material', 'started_at'], name='activity_session'),
+            models.Index(fields=['student', 'started_at'], name='activity_student_time'),
+        ]
+
+    def __str__(self):
+        return f"{self.student_id}:{self.material_id} {self.started_at:%Y-%m-%d %H:%M} ({self.event_count})"
+
+# --- 教員ダッシュボード用の進捗集計（reading.progress がシグナルで増減し、reconcile_progress で照合する） ---
+class ProgressSummary(models.Model):
+    """グループ・教材・学生ごとの回答数とコメント数"""
+    group = models.ForeignKey(Group, on_delete=models.CASCADE, related_name='progress', verbose_name='グループ')
+    material = models.ForeignKey(ReadingMaterial, on_delete=models.CASCADE, related_name='progress', verbose_name='教材')
+    student = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+', verbose_name='学生')
+    answered_count = models.IntegerField(default=0, verbose_name='回答数')
+    comment_count = models.IntegerField(default=0, verbose_name='コメント数')
+    unread_comment_count = models.IntegerField(default=0, verbose_name='教員の未読コメント数')
+    seen_at = models.DateTimeField(null=True, blank=True, verbose_name='教員が確認した日時')
+
+    class Meta:
+        verbose_name = '進捗集計'
+        verbose_name_plural = '進捗集計'
+        constraints = [
+            models.UniqueConstraint(fields=['group', 'material', 'student'], name='unique_progress_cell'),
+        ]
+
+    def __str__(self):
+        return f"{self.group_id}:{self.material_id}:{self.student_id} ({self.answered_count})"
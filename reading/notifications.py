@@ -0,0 +1,199 @@
+import atexit
+import logging
+import re
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .asyncdb import db_slot
+from .batching import BatchWorker
+from .models import Comment, CustomUser, Notification
+from .pubsub import get_pubsub, user_channel
+
+logger = logging.getLogger(__name__)
+
+
+# --- 通知の配信 ---
+def notification_event(notification):
+    """SSE で送る通知のペイロード（ネストしたユーザーは含めない）"""
+    return {
+        'type': 'notification',
+        'notification': {
+            'id': notification.pk,
+            'sender': notification.sender_id,
+            'notification_type': notification.notification_type,
+            'title': notification.title,
+            'message': notification.message,
+            'related_comment': notification.related_comment_id,
+            'is_read': notification.is_read,
+            'created_at': notification.created_at.isoformat(),
+        },
+    }
+
+
+def publish_notifications(notifications):
+    """コミット後に受信者ごとのチャンネルへ新しい通知を配信する"""
+    events = [(user_channel(n.recipient_id), notification_event(n)) for n in notifications]
+    if events:
+        transaction.on_commit(lambda: _publish(events))
+
+
+def publish_read_state(recipient_id, ids, is_read=True):
+    """既読状態の変更を配信する（ids が None なら全件）"""
+    event = {'type': 'read_state', 'ids': ids, 'is_read': is_read}
+    transaction.on_commit(lambda: _publish([(user_channel(recipient_id), event)]))
+
+
+def _publish(events):
+    # プッシュ配信は補助（クライアントは未読数で追いつく）なので、配信の失敗で保存のリクエストを失敗させない
+    try:
+        pubsub = get_pubsub()
+        for channel, event in events:
+            pubsub.publish(channel, event)
+    except Exception:
+        logger.exception('通知の配信に失敗しました（%d件）', len(events))
+
+
+# --- 未読数カウンタ ---
+UNREAD_KEY = 'notifications:unread:{}'
+UNREAD_TIMEOUT = 60 * 60
+
+
+def unread_count(user_id):
+    """キャッシュ上の未読数を返す（無ければ部分インデックスで数えてキャッシュする）"""
+    key = UNREAD_KEY.format(user_id)
+    count = cache.get(key)
+    if count is None:
+        count = Notification.objects.filter(recipient_id=user_id, is_read=False).count()
+        cache.add(key, count, UNREAD_TIMEOUT)
+    return count
+
+
+async def unread_count_async(user_id):
+    """unread_count の非同期版（非同期ビュー用）"""
+    key = UNREAD_KEY.format(user_id)
+    count = await cache.aget(key)
+    if count is None:
+        async with db_slot():
+            count = await Notification.objects.filter(recipient_id=user_id, is_read=False).acount()
+        await cache.aadd(key, count, UNREAD_TIMEOUT)
+    return count
+
+
+def adjust_unread(counts):
+    """{ユーザー id: 増減} をカウンタへ反映する（キャッシュに無いユーザーは次回の読み出しで数え直す）"""
+    for user_id, delta in counts.items():
+        if not delta:
+            continue
+        try:
+            if cache.incr(UNREAD_KEY.format(user_id), delta) < 0:
+                cache.delete(UNREAD_KEY.format(user_id))
+        except ValueError:
+            pass
+
+
+def reset_unread(user_id):
+    cache.set(UNREAD_KEY.format(user_id), 0, UNREAD_TIMEOUT)
+
+
+def track_unread(counts):
+    """コミット後にカウンタを増減する"""
+    if any(counts.values()):
+        transaction.on_commit(lambda: adjust_unread(counts))
+
+
+# --- コメントからの通知生成 ---
+# ユーザー名に使える ASCII の文字だけを拾う（\w だと「@taroさん」の「さん」まで名前に含まれてしまう）
+MENTION_RE = re.compile(r'@([A-Za-z0-9_.+-]+)')
+
+
+def parse_mentions(text):
+    """本文中の @ユーザー名 を集める"""
+    return set(MENTION_RE.findall(text or ''))
+
+
+def build_comment_notifications(comments):
+    """コメントから通知を組み立てる（保存はしない）
+
+    受信者は回答した学生・グループの担当教員・メンションされたユーザー（投稿者本人は除く）。
+    同じ回答への同じ受信者宛てのコメントが複数あれば、1件のまとめ通知にする。
+    """
+    mentions = {comment.pk: parse_mentions(comment.content) for comment in comments}
+    names = set().union(*mentions.values()) if mentions else set()
+    users = dict(CustomUser.objects.filter(username__in=names).values_list('username', 'pk')) if names else {}
+
+    grouped = {}
+    for comment in comments:
+        answer = comment.target_answer
+        targets = {users[name]: 'mention' for name in mentions[comment.pk] if name in users}
+        targets.setdefault(answer.student_id, 'comment')
+        targets.setdefault(answer.question.material.group.teacher_id, 'comment')
+        targets.pop(comment.author_id, None)
+        for recipient_id, kind in targets.items():
+            grouped.setdefault((recipient_id, answer.pk), []).append((comment, kind))
+
+    notifications = []
+    for (recipient_id, _), items in grouped.items():
+        latest = items[-1][0]
+        kinds = {kind for _, kind in items}
+        kind = 'mention' if 'mention' in kinds else 'comment'
+        if len(items) == 1:
+            author = latest.author.username
+            if kind == 'mention':
+                title, message = 'メンションされました', f'{author}さんがコメントであなたをメンションしました'
+            elif recipient_id == latest.target_answer.student_id:
+                title, message = '新しいコメント', f'{author}さんがあなたの回答にコメントしました'
+            else:
+                student = latest.target_answer.student.username
+                title, message = '新しいコメント', f'{author}さんが{student}さんの回答にコメントしました'
+        else:
+            authors = '、'.join(dict.fromkeys(comment.author.username for comment, _ in items))
+            title, message = f'{len(items)}件の新しいコメント', f'{authors}さんがコメントしました'
+        notifications.append(Notification(
+            recipient_id=recipient_id, sender_id=latest.author_id, notification_type=kind,
+            title=title, message=message, related_comment=latest,
+        ))
+    return notifications
+
+
+def fan_out_comments(comment_ids):
+    """コメントの通知をまとめて1回の bulk_create で保存し、配信する"""
+    comments = list(
+        Comment.objects.filter(pk__in=comment_ids)
+        .select_related('author', 'target_answer__student', 'target_answer__question__material__group')
+        .order_by('created_at', 'pk')
+    )
+    notifications = build_comment_notifications(comments)
+    if notifications:
+        Notification.objects.bulk_create(notifications)
+        track_unread(Counter(n.recipient_id for n in notifications))
+        publish_notifications(notifications)
+    return notifications
+
+
+class CommentFanout(BatchWorker):
+    """コメント ID を受け取り、バックグラウンドスレッドでまとめて通知を生成する
+
+    最初のコメントから delay 秒のあいだに届いたものを1バッチとして処理するため、
+    同じ回答への連続したコメントはまとめ通知になる。
+    """
+
+    name = 'comment-fanout'
+    error_message = 'コメント通知の生成に失敗しました（%d件）'
+
+    def handle(self, batch):
+        fan_out_comments(batch)
+
+
+_fanout = CommentFanout()
+atexit.register(_fanout.flush)
+
+
+def enqueue_comment(comment_id):
+    """settings.COMMENT_FANOUT_MODE が 'immediate' ならその場で、それ以外はバックグラウンドで通知を生成する"""
+    if getattr(settings, 'COMMENT_FANOUT_MODE', 'background') == 'immediate':
+        fan_out_comments([comment_id])
+    else:
+        _fanout.enqueue(comment_id)
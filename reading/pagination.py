@@ -0,0 +1,29 @@
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+
+
+# --- カーソルページネーション ---
+class KeysetCursorPagination(CursorPagination):
+    """created_at / id のキーセットによるカーソルページネーション
+
+    OFFSET を使わないため、深いページでもページサイズ分の読み取りで済む。
+    並び順は ViewSet の ``cursor_ordering`` で上書きできる（先頭はほぼ一意で不変なフィールド）。
+    """
+    ordering = ('-created_at', '-id')
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+    def get_ordering(self, request, queryset, view):
+        ordering = getattr(view, 'cursor_ordering', None)
+        if ordering is None:
+            return super().get_ordering(request, queryset, view)
+        if isinstance(ordering, str):
+            return (ordering,)
+        return tuple(ordering)
+
+
+# --- 検索結果 ---
+class SearchPagination(PageNumberPagination):
+    """関連度順の検索結果はキーセットで辿れないので、ページ番号で区切る"""
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
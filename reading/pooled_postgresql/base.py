@@ -0,0 +1,58 @@
+from django.db.backends.postgresql import base
+from django.db.backends.postgresql.psycopg_any import IsolationLevel
+
+from reading.dbpool import get_pool
+
+# settings.DATABASES の OPTIONS['pool'] で渡せる値（reading.dbpool.ConnectionPool の引数）
+POOL_OPTIONS = ('max_size', 'timeout', 'max_idle', 'max_lifetime', 'check_after')
+
+
+def _check(connection):
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+    except base.Database.Error:
+        return False
+    return True
+
+
+def _reset(connection):
+    """プールへ返す前に開いたままのトランザクションを終わらせる（戻せない接続は捨てる）"""
+    if connection.closed:
+        return False
+    if connection.info.transaction_status != base.Database.extensions.TRANSACTION_STATUS_IDLE:
+        try:
+            connection.rollback()
+        except base.Database.Error:
+            return False
+    return True
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """PostgreSQL バックエンドの接続を reading.dbpool のプールから借りる版
+
+    CONN_MAX_AGE=0 と組み合わせると、Django が接続を閉じるたびに切断せずプールへ返す。
+    """
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        params.pop('pool', None)
+        return params
+
+    def get_new_connection(self, conn_params):
+        options = self.settings_dict['OPTIONS'].get('pool') or {}
+        # テスト用 DB や接続先 DB 無しの接続と混ざらないよう、DB 名ごとにプールを分ける
+        self._pool = get_pool(
+            (self.alias, self.settings_dict['NAME']), self.alias, check=_check, reset=_reset,
+            **{name: options[name] for name in POOL_OPTIONS if name in options},
+        )
+        connection = self._pool.getconn(lambda: super(DatabaseWrapper, self).get_new_connection(conn_params))
+        # 再利用した接続でも isolation_level を新規接続と同じにしておく
+        isolation_level = self.settings_dict['OPTIONS'].get('isolation_level')
+        self.isolation_level = IsolationLevel.READ_COMMITTED if isolation_level is None else IsolationLevel(isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                return self._pool.putconn(self.connection)
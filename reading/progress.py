@@ -0,0 +1,236 @@
+from django.db import connection, transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, Sum
+from django.utils import timezone
+
+from .gradebook import question_scopes
+from .models import Comment, Group, ProgressSummary, ReadingMaterial, StudentAnswer
+
+# --- 教員ダッシュボード用の進捗集計 ---
+# ProgressSummary はグループ・教材・学生ごとの回答数・コメント数・教員の未読コメント数を持つ。
+# 回答・コメントの作成・削除のたびにシグナル（生 SQL の upsert_drafts はコミット後）で増減し、
+# reconcile_progress で回答・コメントから数え直した値と照合する。
+# 未読コメントは担当教員以外が書いたもので、教員が mark_seen した後に投稿されたもの。
+
+_COUNTERS = ('answered_count', 'comment_count', 'unread_comment_count')
+
+
+def bump(deltas):
+    """{(グループ id, 教材 id, 学生 id): (回答数, コメント数, 未読数) の増減} を反映する
+
+    増やす分は1回の INSERT ... ON CONFLICT で行を作りながら加算する。
+    減らす分は既存の行だけを UPDATE する（行が無ければ照合で直る）。
+    """
+    increments = {cell: delta for cell, delta in deltas.items() if any(delta) and min(delta) >= 0}
+    if increments:
+        _upsert(increments)
+    for (group_id, material_id, student_id), delta in deltas.items():
+        if min(delta) < 0:
+            ProgressSummary.objects.filter(group_id=group_id, material_id=material_id, student_id=student_id).update(
+                **{name: F(name) + value for name, value in zip(_COUNTERS, delta) if value},
+            )
+
+
+def _upsert(increments):
+    qn = connection.ops.quote_name
+    table = qn(ProgressSummary._meta.db_table)
+    columns = ['group_id', 'material_id', 'student_id', *_COUNTERS]
+    rows, params = [], []
+    for cell, delta in increments.items():
+        rows.append('(' + ', '.join(['%s'] * len(columns)) + ')')
+        params.extend([*cell, *delta])
+    updates = ', '.join(f'{qn(name)} = {table}.{qn(name)} + excluded.{qn(name)}' for name in _COUNTERS)
+    sql = (
+        f"INSERT INTO {table} ({', '.join(qn(name) for name in columns)}) VALUES {', '.join(rows)} "
+        f"ON CONFLICT ({qn('group_id')}, {qn('material_id')}, {qn('student_id')}) DO UPDATE SET {updates}"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
+
+def _answer_deltas(answers, sign):
+    """answers は (学生 id, 問題 id) のリスト"""
+    scopes = question_scopes(question_id for _, question_id in answers)
+    deltas = {}
+    for student_id, question_id in answers:
+        if question_id in scopes:
+            material_id, group_id = scopes[question_id]
+            answered = deltas.get((group_id, material_id, student_id), (0, 0, 0))[0]
+            deltas[(group_id, material_id, student_id)] = (answered + sign, 0, 0)
+    return deltas
+
+
+def answers_created(answers):
+    bump(_answer_deltas(answers, 1))
+
+
+def answers_deleted(answers):
+    bump(_answer_deltas(answers, -1))
+
+
+def schedule_answers_created(student_id, question_ids):
+    """upsert_drafts で新しく作られた回答をコミット後に数える（生 SQL なのでシグナルが発火しない）"""
+    answers = [(student_id, question_id) for question_id in question_ids]
+    if answers:
+        transaction.on_commit(lambda: answers_created(answers))
+
+
+def _comment_cell(comment):
+    """コメントの (グループ id, 教材 id, 学生 id) と、教員の未読に数えるか"""
+    row = (
+        StudentAnswer.objects.filter(pk=comment.target_answer_id)
+        .values_list('question__material__group_id', 'question__material_id', 'student_id', 'question__material__group__teacher_id')
+        .first()
+    )
+    if row is None:
+        return None, False
+    return row[:3], comment.author_id != row[3]
+
+
+def comment_added(comment):
+    cell, unread = _comment_cell(comment)
+    if cell is not None:
+        bump({cell: (0, 1, int(unread))})
+
+
+def comment_removed(comment):
+    cell, unread = _comment_cell(comment)
+    if cell is None:
+        return
+    bump({cell: (0, -1, 0)})
+    if unread:
+        # 確認済みのコメントはすでに未読数から外れている
+        group_id, material_id, student_id = cell
+        ProgressSummary.objects.filter(
+            Q(seen_at__isnull=True) | Q(seen_at__lt=comment.created_at),
+            group_id=group_id, material_id=material_id, student_id=student_id, unread_comment_count__gt=0,
+        ).update(unread_comment_count=F('unread_comment_count') - 1)
+
+
+def mark_seen(material_id, student_id=None):
+    """教材（と学生）のコメントを教員が確認済みにする。更新した行数を返す"""
+    cells = ProgressSummary.objects.filter(material_id=material_id)
+    if student_id is not None:
+        cells = cells.filter(student_id=student_id)
+    return cells.update(unread_comment_count=0, seen_at=timezone.now())
+
+
+# --- ダッシュボード ---
+def teacher_dashboard(teacher_id):
+    """教員が担当する全グループの、教材ごとの完了率とコメント数（3クエリ。回答数・コメント数によらない）
+
+    回答・コメントは集計表だけから読む。学生数・問題数は Group.students の中間表と Question を数えるが、
+    どちらも担当グループ・教材の id で索引から引くので、読む行数は担当クラスの学生数と問題数までに収まる
+    （授業の進行で増える回答・コメントと違い、授業中はほぼ変わらない）。
+    """
+    groups = list(
+        Group.objects.filter(teacher_id=teacher_id)
+        .annotate(student_count=Count('students'))
+        .values('id', 'name', 'student_count')
+        .order_by('name', 'id')
+    )
+    materials = (
+        ReadingMaterial.objects.filter(group__teacher_id=teacher_id)
+        .annotate(question_count=Count('questions'))
+        .values('id', 'title', 'group_id', 'question_count')
+        .order_by('created_at', 'id')
+    )
+    # グループから外れた学生の行は数えない
+    cells = {
+        row['material_id']: row
+        for row in ProgressSummary.objects.filter(group__teacher_id=teacher_id, student__student_groups=F('group_id'))
+        .values('material_id')
+        .annotate(
+            answered=Sum('answered_count'), comments=Sum('comment_count'),
+            unread_comments=Sum('unread_comment_count'), started=Count('id', filter=Q(answered_count__gt=0)),
+        )
+        .order_by()
+    }
+    by_group = {group['id']: group for group in groups}
+    for group in groups:
+        group['materials'] = []
+        group['unread_comments'] = 0
+    for material in materials:
+        group = by_group[material['group_id']]
+        cell = cells.get(material['id'], {})
+        expected = material['question_count'] * group['student_count']
+        answered = cell.get('answered') or 0
+        group['materials'].append({
+            'id': material['id'],
+            'title': material['title'],
+            'question_count': material['question_count'],
+            'answered': answered,
+            'students_started': cell.get('started') or 0,
+            'completion': round(min(answered / expected, 1) * 100, 1) if expected else 0.0,
+            'comments': cell.get('comments') or 0,
+            'unread_comments': cell.get('unread_comments') or 0,
+        })
+        group['unread_comments'] += cell.get('unread_comments') or 0
+    return {'teacher': teacher_id, 'groups': groups}
+
+
+# --- 照合 ---
+def expected_progress(group_ids=None):
+    """回答・コメントから数え直した {(グループ id, 教材 id, 学生 id): (回答数, コメント数, 未読数)}"""
+    answers = StudentAnswer.objects.all()
+    comments = Comment.objects.all()
+    if group_ids is not None:
+        answers = answers.filter(question__material__group_id__in=group_ids)
+        comments = comments.filter(target_answer__question__material__group_id__in=group_ids)
+
+    counts = {}
+    for group_id, material_id, student_id, answered in (
+        answers.values_list('question__material__group_id', 'question__material_id', 'student_id')
+        .annotate(n=Count('id')).order_by()
+    ):
+        counts[(group_id, material_id, student_id)] = (answered, 0, 0)
+
+    cell = 'target_answer__question__material__group_id', 'target_answer__question__material_id', 'target_answer__student_id'
+    seen_at = ProgressSummary.objects.filter(
+        group_id=OuterRef(cell[0]), material_id=OuterRef(cell[1]), student_id=OuterRef(cell[2]),
+    ).values('seen_at')
+    unread = ~Q(author_id=F('target_answer__question__material__group__teacher_id')) & (
+        Q(seen_at__isnull=True) | Q(created_at__gt=F('seen_at'))
+    )
+    for group_id, material_id, student_id, total, unread_total in (
+        comments.annotate(seen_at=Subquery(seen_at))
+        .values_list(*cell)
+        .annotate(n=Count('id'), unread=Count('id', filter=unread)).order_by()
+    ):
+        answered = counts.get((group_id, material_id, student_id), (0, 0, 0))[0]
+        counts[(group_id, material_id, student_id)] = (answered, total, unread_total)
+    return counts
+
+
+def reconcile_progress(group_ids=None):
+    """集計表を数え直した値に合わせる。(作成, 更新, 削除) した行数を返す
+
+    すべて 0 になった行は、seen_at を持たないものだけ削除する。
+
+    数え直しとの間に保存された回答・コメントの増減は上書きされることがあるが、次回の照合で直る。
+    """
+    expected = expected_progress(group_ids)
+    rows = ProgressSummary.objects.all()
+    if group_ids is not None:
+        rows = rows.filter(group_id__in=group_ids)
+
+    changed, stale = [], []
+    for row in rows.iterator(chunk_size=2000):
+        cell = (row.group_id, row.material_id, row.student_id)
+        values = expected.pop(cell, (0, 0, 0))
+        if not any(values) and row.seen_at is None:
+            # 教員が確認した行は、未読の基準になる seen_at を失わないよう残す
+            stale.append(row.pk)
+        elif values != tuple(getattr(row, name) for name in _COUNTERS):
+            for name, value in zip(_COUNTERS, values):
+                setattr(row, name, value)
+            changed.append(row)
+    created = [
+        ProgressSummary(group_id=group_id, material_id=material_id, student_id=student_id,
+                        **dict(zip(_COUNTERS, values)))
+        for (group_id, material_id, student_id), values in expected.items()
+    ]
+    with transaction.atomic():
+        ProgressSummary.objects.bulk_create(created, batch_size=1000, ignore_conflicts=True)
+        ProgressSummary.objects.bulk_update(changed, _COUNTERS, batch_size=1000)
+        ProgressSummary.objects.filter(pk__in=stale).delete()
+    return len(created), len(changed), len(stale)
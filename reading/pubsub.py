@@ -0,0 +1,110 @@
+import asyncio
+import json
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+
+# --- Pub/Sub バックエンド ---
+class BasePubSub:
+    """チャンネル単位のメッセージ配信
+
+    publish() は同期コード（シグナルやワーカー）から、subscribe() は ASGI の非同期ビューから呼ぶ。
+    """
+
+    def publish(self, channel, message):
+        raise NotImplementedError
+
+    async def subscribe(self, channel):
+        raise NotImplementedError
+        yield  # pragma: no cover
+
+
+class InProcessPubSub(BasePubSub):
+    """プロセス内の asyncio.Queue で配信する（開発・テスト用、単一プロセス構成向け）"""
+
+    def __init__(self, max_queue=100):
+        self.max_queue = max_queue
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for queue, loop in subscribers:
+            loop.call_soon_threadsafe(self._offer, queue, message)
+
+    @staticmethod
+    def _offer(queue, message):
+        # 受信が遅いクライアントのために送信側を止めない
+        if not queue.full():
+            queue.put_nowait(message)
+
+    def subscriber_count(self, channel):
+        with self._lock:
+            return len(self._subscribers.get(channel, ()))
+
+    async def subscribe(self, channel):
+        entry = (asyncio.Queue(self.max_queue), asyncio.get_running_loop())
+        with self._lock:
+            self._subscribers[channel].add(entry)
+        try:
+            while True:
+                yield await entry[0].get()
+        finally:
+            with self._lock:
+                self._subscribers[channel].discard(entry)
+                if not self._subscribers[channel]:
+                    del self._subscribers[channel]
+
+
+class RedisPubSub(BasePubSub):
+    """Redis の PUBLISH/SUBSCRIBE で配信する（複数プロセス・複数ホスト構成向け）"""
+
+    def __init__(self, url=None):
+        try:
+            import redis
+            import redis.asyncio
+        except ImportError as exc:
+            raise ImproperlyConfigured('RedisPubSub を使うには redis パッケージが必要です') from exc
+        self.url = url or getattr(settings, 'PUBSUB_REDIS_URL', 'redis://localhost:6379/0')
+        self._client = redis.Redis.from_url(self.url)
+        self._async = redis.asyncio
+
+    def publish(self, channel, message):
+        self._client.publish(channel, json.dumps(message))
+
+    async def subscribe(self, channel):
+        client = self._async.Redis.from_url(self.url)
+        pubsub = client.pubsub()
+        await pubsub.subscribe(channel)
+        try:
+            async for item in pubsub.listen():
+                if item['type'] == 'message':
+                    yield json.loads(item['data'])
+        finally:
+            await pubsub.unsubscribe(channel)
+            await pubsub.close()
+            await client.close()
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_pubsub():
+    """settings.PUBSUB_BACKEND（ドット区切りのクラスパス）のインスタンスを返す"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                path = getattr(settings, 'PUBSUB_BACKEND', 'reading.pubsub.InProcessPubSub')
+                _backend = import_string(path)()
+    return _backend
+
+
+def user_channel(user_id):
+    return f'user:{user_id}'
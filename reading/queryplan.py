@@ -0,0 +1,120 @@
+from functools import lru_cache
+
+from django.core.exceptions import FieldDoesNotExist
+from rest_framework import serializers
+
+
+# --- クエリプラン ---
+class QueryPlan:
+    """シリアライザが必要とする select_related / prefetch_related のパス"""
+
+    def __init__(self, select=(), prefetch=()):
+        self.select = tuple(dict.fromkeys(select))
+        self.prefetch = tuple(dict.fromkeys(prefetch))
+
+    def apply(self, queryset):
+        if self.select:
+            queryset = queryset.select_related(*self.select)
+        if self.prefetch:
+            queryset = queryset.prefetch_related(*self.prefetch)
+        return queryset
+
+    def __repr__(self):
+        return f"QueryPlan(select={self.select}, prefetch={self.prefetch})"
+
+
+def _get_relation(model, source):
+    """source が model のリレーションフィールドであればそのフィールドを返す"""
+    if model is None or not source or '.' in source:
+        return None
+    try:
+        field = model._meta.get_field(source)
+    except FieldDoesNotExist:
+        return None
+    return field if field.is_relation else None
+
+
+def _walk(serializer, model, prefix, in_prefetch, select, prefetch):
+    for field in serializer.fields.values():
+        if field.write_only or field.source == '*':
+            continue
+        relation = _get_relation(model, field.source)
+        if relation is None:
+            continue
+        path = f"{prefix}{field.source}"
+        many = relation.many_to_many or relation.one_to_many
+
+        if isinstance(field, serializers.ListSerializer):
+            prefetch.append(path)
+            child = field.child
+            if isinstance(child, serializers.ModelSerializer):
+                _walk(child, relation.related_model, f"{path}__", True, select, prefetch)
+        elif isinstance(field, serializers.ModelSerializer):
+            if many or in_prefetch:
+                prefetch.append(path)
+            else:
+                select.append(path)
+            _walk(field, relation.related_model, f"{path}__", many or in_prefetch, select, prefetch)
+        elif isinstance(field, serializers.ManyRelatedField):
+            prefetch.append(path)
+        elif isinstance(field, serializers.RelatedField) and not isinstance(field, serializers.PrimaryKeyRelatedField):
+            # StringRelatedField などは関連オブジェクト自体を参照する
+            if many or in_prefetch:
+                prefetch.append(path)
+            else:
+                select.append(path)
+
+
+def build_query_plan(serializer):
+    """シリアライザ（インスタンス）のネストしたフィールドからクエリプランを組み立てる"""
+    if isinstance(serializer, serializers.ListSerializer):
+        serializer = serializer.child
+    select, prefetch = [], []
+    model = getattr(getattr(serializer, 'Meta', None), 'model', None)
+    _walk(serializer, model, '', False, select, prefetch)
+    return QueryPlan(select, prefetch)
+
+
+@lru_cache(maxsize=None)
+def get_query_plan(serializer_class):
+    """シリアライザクラスごとのクエリプラン（キャッシュ付き）"""
+    return build_query_plan(serializer_class())
+
+
+# --- ViewSet 用ミックスイン ---
+class QueryPlanMixin:
+    """serializer_class のネスト構造から get_queryset に select/prefetch を自動適用する
+
+    別モデルを返す @action は ``serializer_class`` を指定しておけば、
+    親オブジェクトの取得にはプランが適用されない。
+    シリアライザに現れないリレーションが必要な場合は
+    ``select_related_fields`` / ``prefetch_related_fields`` で追加宣言する。
+    """
+    select_related_fields = ()
+    prefetch_related_fields = ()
+
+    def plan_queryset(self, queryset, serializer_class=None):
+        serializer_class = serializer_class or self.get_serializer_class()
+        meta = getattr(serializer_class, 'Meta', None)
+        if getattr(meta, 'model', None) is not queryset.model:
+            # 別モデルを返すアクション（例: 教材の questions）では親の取得を軽く保つ
+            return queryset
+        request = getattr(self, 'request', None)
+        sparse = request is not None and (
+            'fields' in request.query_params or 'omit' in request.query_params
+            or (self.action == 'list' and getattr(meta, 'list_omit', None))
+        )
+        if sparse:
+            # ?fields= / ?omit= で省いたリレーションは読み込まない
+            plan = build_query_plan(serializer_class(context=self.get_serializer_context()))
+        else:
+            plan = get_query_plan(serializer_class)
+        queryset = plan.apply(queryset)
+        if self.select_related_fields:
+            queryset = queryset.select_related(*self.select_related_fields)
+        if self.prefetch_related_fields:
+            queryset = queryset.prefetch_related(*self.prefetch_related_fields)
+        return queryset
+
+    def get_queryset(self):
+        return self.plan_queryset(super().get_queryset())
@@ -0,0 +1,188 @@
+import re
+import unicodedata
+
+from django.db import connection, transaction
+from django.db.models import F
+from django.db.models.expressions import RawSQL
+
+from .models import Comment, ReadingMaterial, SearchDocument, StudentAnswer
+
+# --- トークン化 ---
+# 英数字は単語ごと、それ以外の文字（日本語など）は連続部分を文字 bigram に分割する
+TOKEN_RE = re.compile(r'[a-z0-9]+|[^\W_a-z0-9]+')
+
+
+def normalize(text):
+    """全角英数字・半角カナをそろえ、小文字にする"""
+    return unicodedata.normalize('NFKC', text or '').lower()
+
+
+def _grams(run, query=False):
+    if run.isascii() or len(run) == 1:
+        return [run]
+    grams = [run[i:i + 2] for i in range(len(run) - 1)]
+    if not query:
+        # 末尾の1文字も入れておくと、1文字の検索語を前方一致で拾える
+        grams.append(run[-1])
+    return grams
+
+
+def tokenize(text):
+    """索引用のトークン列（空白区切りの文字列）"""
+    return ' '.join(gram for run in TOKEN_RE.findall(normalize(text)) for gram in _grams(run))
+
+
+def parse_query(query):
+    """検索語を (トークンのリスト, 前方一致か) の並びにする。各語は隣接したトークン列（フレーズ）として照合する"""
+    terms = []
+    for run in TOKEN_RE.findall(normalize(query)):
+        terms.append((_grams(run, query=True), not run.isascii() and len(run) == 1))
+    return terms
+
+
+def _fts5_query(terms):
+    return ' AND '.join('"{}"{}'.format(' '.join(tokens), '*' if prefix else '') for tokens, prefix in terms)
+
+
+def _tsquery(terms):
+    return ' & '.join('({}{})'.format(' <-> '.join(tokens), ':*' if prefix else '') for tokens, prefix in terms)
+
+
+# --- 検索 ---
+def search(query):
+    """検索語に一致する SearchDocument を関連度（rank）の高い順に返す
+
+    SQLite では FTS5（bm25）、Postgres では to_tsvector の GIN インデックス（ts_rank_cd）を使う。
+    """
+    terms = parse_query(query)
+    if not terms:
+        return SearchDocument.objects.none()
+    qn = connection.ops.quote_name
+    table = qn(SearchDocument._meta.db_table)
+    if connection.vendor == 'postgresql':
+        tsquery = _tsquery(terms)
+        vector = f"to_tsvector('simple'::regconfig, {table}.{qn('tokens')})"
+        match = RawSQL(f"SELECT {qn('id')} FROM {table} WHERE {vector} @@ to_tsquery('simple', %s)", [tsquery])
+        rank = RawSQL(f"ts_rank_cd({vector}, to_tsquery('simple', %s))", [tsquery])
+    else:
+        expression = _fts5_query(terms)
+        fts = qn(SearchDocument._meta.db_table + '_fts')
+        match = RawSQL(f"SELECT rowid FROM {fts} WHERE {fts} MATCH %s", [expression])
+        # FTS5 の rank は bm25 で、小さいほど関連度が高い
+        rank = RawSQL(f"(SELECT -rank FROM {fts} WHERE {fts} MATCH %s AND rowid = {table}.{qn('id')})", [expression])
+    return SearchDocument.objects.filter(pk__in=match).annotate(rank=rank).order_by('-rank', '-id')
+
+
+def snippet(text, query, width=40):
+    """本文のうち最初に検索語が現れる付近を切り出す"""
+    normalized = normalize(text)
+    positions = [normalized.find(run) for run in TOKEN_RE.findall(normalize(query))]
+    positions = [position for position in positions if position >= 0]
+    at = min(positions, default=0)
+    start, end = max(at - width, 0), min(at + width, len(text))
+    return ('…' if start > 0 else '') + text[start:end] + ('…' if end < len(text) else '')
+
+
+# --- 索引の更新 ---
+def material_document(material):
+    return {
+        'kind': 'material', 'object_id': material.pk, 'material_id': material.pk,
+        'user_id': material.created_by_id, 'text': f'{material.title}\n{material.content}',
+    }
+
+
+def answer_document(answer, material_id, texts=None):
+    texts = texts or {'answer_text': answer.answer_text, 'reasoning_note': answer.reasoning_note}
+    return {
+        'kind': 'answer', 'object_id': answer.pk, 'material_id': material_id,
+        'user_id': answer.student_id, 'text': '\n'.join(filter(None, [texts['answer_text'], texts['reasoning_note']])),
+    }
+
+
+def comment_document(comment, material_id):
+    return {
+        'kind': 'comment', 'object_id': comment.pk, 'material_id': material_id,
+        'user_id': comment.author_id, 'text': comment.content,
+    }
+
+
+def save_documents(documents, only_changed=False):
+    """文書を1回の INSERT ... ON CONFLICT で保存する（FTS5 側はトリガーで更新される）
+
+    only_changed=True なら保存済みの内容と同じ文書は書き込まない（索引の更新は重いので先に1回読んで比べる）。
+    """
+    objs = [SearchDocument(tokens=tokenize(document['text']), **document) for document in documents]
+    if only_changed and objs:
+        saved = {
+            (kind, object_id): row
+            for kind, object_id, *row in SearchDocument.objects.filter(
+                kind__in={obj.kind for obj in objs}, object_id__in=[obj.object_id for obj in objs],
+            ).values_list('kind', 'object_id', 'material_id', 'user_id', 'text', 'tokens')
+        }
+        objs = [
+            obj for obj in objs
+            if saved.get((obj.kind, obj.object_id)) != [obj.material_id, obj.user_id, obj.text, obj.tokens]
+        ]
+    if objs:
+        SearchDocument.objects.bulk_create(
+            objs, update_conflicts=True, unique_fields=['kind', 'object_id'],
+            update_fields=['material', 'user', 'text', 'tokens', 'updated_at'],
+        )
+
+
+def remove_document(kind, object_id):
+    SearchDocument.objects.filter(kind=kind, object_id=object_id).delete()
+
+
+def index_materials(material_ids):
+    materials = ReadingMaterial.objects.filter(pk__in=material_ids).select_related('text')
+    save_documents([material_document(material) for material in materials])
+
+
+def index_answers(answer_ids, only_changed=False):
+    """回答を索引する。未適用の差分があれば適用後のテキストを使う"""
+    from .autosave import materialize
+
+    answers = (
+        StudentAnswer.objects.filter(pk__in=answer_ids)
+        .annotate(material_id=F('question__material_id'))
+        .prefetch_related('patches')
+    )
+    save_documents([
+        answer_document(answer, answer.material_id, materialize(answer, answer.patches.all())[0])
+        for answer in answers
+    ], only_changed=only_changed)
+
+
+def index_comments(comment_ids):
+    comments = Comment.objects.filter(pk__in=comment_ids).annotate(
+        material_id=F('target_answer__question__material_id'),
+    )
+    save_documents([comment_document(comment, comment.material_id) for comment in comments])
+
+
+def schedule_material_index(material_ids):
+    material_ids = list(material_ids)
+    if material_ids:
+        transaction.on_commit(lambda: index_materials(material_ids))
+
+
+INDEXERS = {
+    'material': (ReadingMaterial, index_materials),
+    'answer': (StudentAnswer, index_answers),
+    'comment': (Comment, index_comments),
+}
+
+
+def rebuild(kinds=None, chunk_size=500):
+    """索引を作り直す（管理コマンド用）。種類ごとの件数を返す"""
+    counts = {}
+    for kind in kinds or INDEXERS:
+        model, index = INDEXERS[kind]
+        ids = list(model.objects.order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(ids), chunk_size):
+            with transaction.atomic():
+                index(ids[start:start + chunk_size])
+        SearchDocument.objects.filter(kind=kind).exclude(object_id__in=model.objects.values('pk')).delete()
+        counts[kind] = len(ids)
+    return counts
@@ -0,0 +1,248 @@
+import hashlib
+import re
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from difflib import SequenceMatcher
+
+from django.db import transaction
+
+from .citations import mark_changed, sync_citations
+from .httpcache import VersionedLocalCache
+from .intervals import invalidate_annotation_index
+from .models import Annotation, MaterialText, StudentAnswer, TextSegment
+
+# --- 段落・文への分割 ---
+PARAGRAPH_RE = re.compile(r'[^\n]+')
+# 句点・感嘆符・疑問符（続く閉じ括弧を含む）か、空白の前のピリオドで文を区切る
+SENTENCE_RE = re.compile(
+    r'(?:[^。．！？!?.]|\.(?!\s|$))*'
+    r'(?:(?:[。．！？!?]|\.(?=\s|$))+[」』）)】〕"\']*|$)'
+)
+
+
+def split_segments(content):
+    """本文を文単位に区切り、(段落番号, 開始位置, 終了位置, 文) のリストを返す（空白だけの行・文は含めない）"""
+    segments = []
+    paragraph = 0
+    for line in PARAGRAPH_RE.finditer(content or ''):
+        if not line.group().strip():
+            continue
+        for sentence in SENTENCE_RE.finditer(line.group()):
+            if sentence.group().strip():
+                segments.append((paragraph, line.start() + sentence.start(), line.start() + sentence.end(), sentence.group()))
+        paragraph += 1
+    return segments
+
+
+def segment_keys(texts):
+    """文の内容から区切り ID を作る。本文を編集しても、変わっていない文の ID は変わらない"""
+    seen = Counter()
+    keys = []
+    for text in texts:
+        digest = hashlib.sha1(text.strip().encode()).hexdigest()[:12]
+        keys.append(digest if not seen[digest] else f'{digest}-{seen[digest]}')
+        seen[digest] += 1
+    return keys
+
+
+def resegment(material):
+    """教材の区切りを作り直す（変わっていなければ書き込まない）。区切りの数を返す"""
+    segments = split_segments(material.content)
+    keys = segment_keys(text for _, _, _, text in segments)
+    rows = [
+        (key, position, paragraph, start, end)
+        for position, (key, (paragraph, start, end, _)) in enumerate(zip(keys, segments))
+    ]
+    current = list(
+        TextSegment.objects.filter(material=material).order_by('position')
+        .values_list('key', 'position', 'paragraph', 'start', 'end')
+    )
+    if current == rows:
+        return len(rows)
+    with transaction.atomic():
+        TextSegment.objects.filter(material=material).delete()
+        TextSegment.objects.bulk_create([
+            TextSegment(material=material, key=key, position=position, paragraph=paragraph, start=start, end=end, text=text)
+            for (key, position, paragraph, start, end), (_, _, _, text) in zip(rows, segments)
+        ])
+        # 引用の集計は文単位なので、区切りが変わったら再集計する
+        if material.citations.exists():
+            mark_changed([material.pk])
+    invalidate_segment_index(material.pk)
+    return len(rows)
+
+
+# --- 本文の編集に合わせた位置の付け替え ---
+# 教材の保存（リクエスト）の中で行うので、差分の計算量を抑える。
+# 前後の共通部分を除いた範囲が REMAP_CHAR_LIMIT 文字以下なら文字単位、超えたら行単位で比べ、
+# 行数の組み合わせが REMAP_LINE_PAIRS_LIMIT を超えたら範囲全体を1つの書き換えとみなす。
+REMAP_CHAR_LIMIT = 5000
+REMAP_LINE_PAIRS_LIMIT = 1000000
+
+
+def _common_prefix(a, b):
+    """a と b の共通の先頭部分の長さ（スライスの比較による二分探索）"""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _unit_opcodes(units_a, units_b):
+    """units（文字列を区切った断片のリスト）単位の差分を文字位置の opcodes にする"""
+    offsets_a, offsets_b = [0], [0]
+    for unit in units_a:
+        offsets_a.append(offsets_a[-1] + len(unit))
+    for unit in units_b:
+        offsets_b.append(offsets_b[-1] + len(unit))
+    return [
+        (tag, offsets_a[i1], offsets_a[i2], offsets_b[j1], offsets_b[j2])
+        for tag, i1, i2, j1, j2 in SequenceMatcher(None, units_a, units_b, autojunk=False).get_opcodes()
+    ]
+
+
+def diff_opcodes(old, new):
+    """SequenceMatcher.get_opcodes() と同じ形式の差分（文字位置）を、計算量を抑えて返す"""
+    prefix = _common_prefix(old, new)
+    suffix = _common_prefix(old[prefix:][::-1], new[prefix:][::-1])
+    a, b = old[prefix:len(old) - suffix], new[prefix:len(new) - suffix]
+    if not a and not b:
+        middle = []
+    elif len(a) + len(b) <= REMAP_CHAR_LIMIT:
+        middle = SequenceMatcher(None, a, b, autojunk=False).get_opcodes()
+    else:
+        lines_a, lines_b = a.splitlines(keepends=True), b.splitlines(keepends=True)
+        if len(lines_a) * len(lines_b) <= REMAP_LINE_PAIRS_LIMIT:
+            middle = _unit_opcodes(lines_a, lines_b)
+        else:
+            middle = [('replace', 0, len(a), 0, len(b))]
+
+    opcodes = [('equal', 0, prefix, 0, prefix)] if prefix else []
+    opcodes += [(tag, i1 + prefix, i2 + prefix, j1 + prefix, j2 + prefix) for tag, i1, i2, j1, j2 in middle]
+    if suffix:
+        opcodes.append(('equal', len(old) - suffix, len(old), len(new) - suffix, len(new)))
+    return opcodes
+
+
+def offset_mapper(old, new):
+    """旧本文の位置を新本文の位置へ写す関数を返す
+
+    変わっていない部分はそのまま平行移動し、書き換えられた部分の中の位置は
+    書き換え後の範囲の端へ寄せる（開始位置は先頭へ、終了位置は末尾へ）。
+    """
+    opcodes = diff_opcodes(old, new)
+    starts = [i1 for _, i1, _, _, _ in opcodes]
+
+    def remap(offset, side='start'):
+        if not opcodes:
+            return 0
+        offset = min(max(offset, 0), len(old))
+        index = (bisect_right(starts, offset) if side == 'start' else bisect_left(starts, offset)) - 1
+        tag, i1, _, j1, j2 = opcodes[max(index, 0)]
+        if tag == 'equal':
+            return j1 + (offset - i1)
+        return j1 if side == 'start' else j2
+    return remap
+
+
+def _remap_citation(citation, remap):
+    if not isinstance(citation, dict):
+        return citation
+    citation = dict(citation)
+    for start_key, end_key in (('start', 'end'), ('start_position', 'end_position')):
+        if isinstance(citation.get(start_key), int) and isinstance(citation.get(end_key), int):
+            citation[start_key] = remap(citation[start_key], 'start')
+            citation[end_key] = max(remap(citation[end_key], 'end'), citation[start_key])
+    return citation
+
+
+def remap_positions(material, old_content):
+    """本文の変更前の位置で保存された注釈と回答の引用箇所を、新しい本文の位置へ移す"""
+    remap = offset_mapper(old_content, material.content)
+    annotations = []
+    for annotation in Annotation.objects.filter(material=material).only('id', 'start_position', 'end_position'):
+        start = remap(annotation.start_position, 'start')
+        end = max(remap(annotation.end_position, 'end'), start)
+        if (start, end) != (annotation.start_position, annotation.end_position):
+            annotation.start_position, annotation.end_position = start, end
+            annotations.append(annotation)
+    Annotation.objects.bulk_update(annotations, ['start_position', 'end_position'], batch_size=500)
+
+    answers = []
+    for answer in StudentAnswer.objects.filter(question__material=material, citations__isnull=False).only('id', 'citations'):
+        citations = answer.citations
+        remapped = (
+            [_remap_citation(citation, remap) for citation in citations] if isinstance(citations, list)
+            else _remap_citation(citations, remap)
+        )
+        if remapped != citations:
+            answer.citations = remapped
+            answers.append(answer)
+    StudentAnswer.objects.bulk_update(answers, ['citations'], batch_size=500)
+    if answers:
+        sync_citations([answer.pk for answer in answers])
+    if annotations:
+        invalidate_annotation_index(material.pk)
+    return len(annotations), len(answers)
+
+
+def content_saved(material, created=False):
+    """教材の保存後に呼ぶ。本文が変わっていれば位置を付け替えてから区切りを作り直す"""
+    old = getattr(material, '_loaded_digest', None)
+    if not created and old is not None and old != material.text_id:
+        # 以前の本文は（prune_material_texts で消されるまで）MaterialText に残っている
+        old_content = MaterialText.objects.filter(pk=old).values_list('content', flat=True).first()
+        if old_content is not None:
+            remap_positions(material, old_content)
+    if created or old != material.text_id:
+        resegment(material)
+    material._loaded_digest = material.text_id
+
+
+# --- 位置 → 区切りの検索 ---
+class SegmentIndex:
+    """区切りの開始位置の配列。位置から区切りを二分探索で引く"""
+
+    def __init__(self, rows):
+        rows = sorted(rows, key=lambda row: row[2])
+        self.keys = [row[0] for row in rows]
+        self.paragraphs = [row[1] for row in rows]
+        self.starts = [row[2] for row in rows]
+        self.ends = [row[3] for row in rows]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def locate(self, offset):
+        """offset を含む（区切りの間なら直前の）区切りの通し番号。先頭より前なら 0"""
+        return max(bisect_right(self.starts, offset) - 1, 0) if self.starts else None
+
+    def describe(self, offset):
+        position = self.locate(offset)
+        if position is None:
+            return None
+        return {
+            'offset': offset,
+            'key': self.keys[position],
+            'position': position,
+            'paragraph': self.paragraphs[position],
+            'offset_in_segment': offset - self.starts[position],
+        }
+
+
+_indexes = VersionedLocalCache('segment-index:{}')
+
+
+def invalidate_segment_index(material_id):
+    _indexes.invalidate(material_id)
+
+
+def get_segment_index(material_id):
+    """教材の SegmentIndex を返す（プロセス内に保持し、区切りの作り直しで無効になる）"""
+    return _indexes.get(material_id, lambda: SegmentIndex(
+        TextSegment.objects.filter(material_id=material_id).values_list('key', 'paragraph', 'start', 'end')
+    ))
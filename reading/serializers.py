@@ -1,13 +1,68 @@
 from rest_framework import serializers
-from .models import Group, ReadingMaterial, Question, StudentAnswer, Annotation, Comment, Notification
-from django.contrib.auth.models import User
+from .models import Group, MaterialText, ReadingMaterial, Question, StudentAnswer, Annotation, Comment, Notification, SearchDocument, TextSegment
+from django.contrib.auth import get_user_model
+from .activity import CLIENT_EVENT_TYPES
+from .autosave import materialize
+from .search import snippet
 
-class UserSerializer(serializers.ModelSerializer):
+User = get_user_model()
+
+def _split_paths(value):
+    return {path.strip() for path in value.split(',') if path.strip()} if value else set()
+
+# --- フィールドの絞り込み ---
+class SparseFieldsMixin:
+    """?fields= / ?omit= によるレスポンスフィールドの絞り込み
+
+    ネストしたフィールドは ``group.students`` のようにドット区切りで指定する。
+    ルートシリアライザの Meta.list_omit に挙げたフィールドは一覧（list）では省略し、
+    ?fields= で明示されたときだけ返す。
+    """
+
+    def _sparse_path(self):
+        names = []
+        node = self
+        while node.parent is not None:
+            if node.field_name:
+                names.append(node.field_name)
+            node = node.parent
+        return '.'.join(reversed(names)), node
+
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get('request')
+        if request is None:
+            return fields
+
+        prefix, root = self._sparse_path()
+        if isinstance(root, serializers.ListSerializer):
+            root = root.child
+        requested = _split_paths(request.query_params.get('fields'))
+        omit = _split_paths(request.query_params.get('omit'))
+        view = self.context.get('view')
+        list_omit = ()
+        if getattr(view, 'action', None) == 'list':
+            list_omit = getattr(getattr(root, 'Meta', None), 'list_omit', ())
+
+        # このレベルで明示されたフィールド名（親ごと指定された場合は絞り込まない）
+        level = set()
+        if not prefix or prefix not in requested:
+            start = f"{prefix}." if prefix else ''
+            level = {path[len(start):].split('.')[0] for path in requested if path.startswith(start)}
+
+        for name in list(fields):
+            path = f"{prefix}.{name}" if prefix else name
+            asked = any(r == path or r.startswith(f"{path}.") for r in requested)
+            if path in omit or (level and name not in level) or (path in list_omit and not asked):
+                del fields[name]
+        return fields
+
+class UserSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ['id', 'username', 'email', 'first_name', 'last_name']
 
-class GroupSerializer(serializers.ModelSerializer):
+class GroupSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     teacher = UserSerializer(read_only=True)
     students = UserSerializer(many=True, read_only=True)
     
@@ -15,45 +70,233 @@ class GroupSerializer(serializers.ModelSerializer):
         model = Group
         fields = ['id', 'name', 'teacher', 'students', 'created_at']
 
-class ReadingMaterialSerializer(serializers.ModelSerializer):
+class MaterialTextSerializer(serializers.ModelSerializer):
+    """本文の参照（ハッシュと文字数）。本文そのものは /api/texts/<hash>/ で取得してキャッシュできる"""
+    hash = serializers.CharField(source='digest', read_only=True)
+
+    class Meta:
+        model = MaterialText
+        fields = ['hash', 'length']
+
+class ReadingMaterialSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    content = serializers.CharField()
+    text = MaterialTextSerializer(read_only=True)
     group = GroupSerializer(read_only=True)
     created_by = UserSerializer(read_only=True)
     
     class Meta:
         model = ReadingMaterial
-        fields = ['id', 'title', 'content', 'group', 'created_by', 'created_at']
+        fields = ['id', 'title', 'content', 'text', 'group', 'created_by', 'created_at']
+        list_omit = ['content', 'group.students']
 
-class QuestionSerializer(serializers.ModelSerializer):
+class QuestionSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Question
         fields = ['id', 'material', 'question_text', 'question_type', 'choices', 'correct_answer', 'hide_text', 'order']
 
-class StudentAnswerSerializer(serializers.ModelSerializer):
+class ImportQuestionSerializer(serializers.ModelSerializer):
+    key = serializers.CharField(max_length=100, source='external_key')
+
+    class Meta:
+        model = Question
+        fields = ['key', 'question_text', 'question_type', 'choices', 'correct_answer', 'hide_text', 'order']
+
+    def validate(self, attrs):
+        if attrs['question_type'] == 'multiple_choice' and not attrs.get('choices'):
+            raise serializers.ValidationError({'choices': '選択式の問題には選択肢が必要です'})
+        return attrs
+
+class ImportMaterialSerializer(serializers.ModelSerializer):
+    key = serializers.CharField(max_length=100, source='external_key')
+    content = serializers.CharField()
+    questions = ImportQuestionSerializer(many=True, required=False, default=list)
+
+    class Meta:
+        model = ReadingMaterial
+        fields = ['key', 'title', 'content', 'questions']
+
+    def validate_questions(self, value):
+        keys = [question['external_key'] for question in value]
+        if len(keys) != len(set(keys)):
+            raise serializers.ValidationError('問題の key が重複しています')
+        return value
+
+class ImportBundleSerializer(serializers.Serializer):
+    group = serializers.PrimaryKeyRelatedField(queryset=Group.objects.all())
+    materials = ImportMaterialSerializer(many=True, allow_empty=False)
+
+    def validate_materials(self, value):
+        keys = [material['external_key'] for material in value]
+        if len(keys) != len(set(keys)):
+            raise serializers.ValidationError('教材の key が重複しています')
+        return value
+
+class StudentAnswerSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     student = UserSerializer(read_only=True)
     question = QuestionSerializer(read_only=True)
     
     class Meta:
         model = StudentAnswer
-        fields = ['id', 'student', 'question', 'answer_text', 'reasoning_note', 'citations', 'submitted_at', 'updated_at']
+        fields = ['id', 'student', 'question', 'answer_text', 'reasoning_note', 'citations', 'revision', 'submitted_at', 'updated_at']
+        read_only_fields = ['revision']
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        # 未適用の差分があれば最新の内容を返す
+        patches = list(instance.patches.all()) if instance.pk else []
+        if patches:
+            texts, revision, _ = materialize(instance, patches)
+            for name, text in texts.items():
+                if name in data:
+                    data[name] = text
+            if 'revision' in data:
+                data['revision'] = revision
+        return data
+
+class AnswerDraftSerializer(serializers.Serializer):
+    question = serializers.IntegerField()
+    answer_text = serializers.CharField(allow_blank=True, trim_whitespace=False, default='')
+    reasoning_note = serializers.CharField(allow_blank=True, trim_whitespace=False, default='')
+    citations = serializers.JSONField(required=False, allow_null=True, default=None)
+    revision = serializers.IntegerField(min_value=0)
 
-class AnnotationSerializer(serializers.ModelSerializer):
+class AnswerSubmitSerializer(AnswerDraftSerializer):
+    student = serializers.IntegerField()
+
+class PatchOpSerializer(serializers.Serializer):
+    at = serializers.IntegerField(min_value=0)
+    delete = serializers.IntegerField(min_value=0, default=0)
+    insert = serializers.CharField(allow_blank=True, trim_whitespace=False, default='')
+
+class AnswerPatchSerializer(serializers.Serializer):
+    student = serializers.IntegerField()
+    question = serializers.IntegerField()
+    base_revision = serializers.IntegerField(min_value=0)
+    revision = serializers.IntegerField(min_value=1)
+    answer_text = PatchOpSerializer(many=True, required=False)
+    reasoning_note = PatchOpSerializer(many=True, required=False)
+
+    def validate(self, attrs):
+        if attrs['revision'] <= attrs['base_revision']:
+            raise serializers.ValidationError({'revision': 'base_revision より大きい値が必要です'})
+        return attrs
+
+class AutosaveSerializer(serializers.Serializer):
+    student = serializers.IntegerField()
+    drafts = AnswerDraftSerializer(many=True, allow_empty=False, max_length=50)
+
+class AnnotationSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     student = UserSerializer(read_only=True)
     
     class Meta:
         model = Annotation
         fields = ['id', 'student', 'material', 'annotation_type', 'start_position', 'end_position', 'content', 'color', 'created_at']
 
-class CommentSerializer(serializers.ModelSerializer):
+class AnnotationCreateSerializer(serializers.ModelSerializer):
+    client_id = serializers.CharField(max_length=64)
+
+    class Meta:
+        model = Annotation
+        fields = ['client_id', 'annotation_type', 'start_position', 'end_position', 'content', 'color']
+
+    def validate(self, attrs):
+        if attrs['end_position'] < attrs['start_position']:
+            raise serializers.ValidationError({'end_position': 'start_position 以上の値が必要です'})
+        return attrs
+
+class AnnotationUpdateSerializer(serializers.ModelSerializer):
+    id = serializers.IntegerField()
+
+    class Meta:
+        model = Annotation
+        fields = ['id', 'annotation_type', 'start_position', 'end_position', 'content', 'color']
+        extra_kwargs = {name: {'required': False} for name in fields[1:]}
+
+    def validate(self, attrs):
+        # 片方の端だけの変更は、保存済みの値と合わせて AnnotationSyncSerializer で確かめる
+        if 'start_position' in attrs and 'end_position' in attrs and attrs['end_position'] < attrs['start_position']:
+            raise serializers.ValidationError({'end_position': 'start_position 以上の値が必要です'})
+        return attrs
+
+class AnnotationSyncSerializer(serializers.Serializer):
+    student = serializers.IntegerField()
+    material = serializers.IntegerField()
+    since = serializers.CharField(required=False, allow_blank=True)
+    creates = AnnotationCreateSerializer(many=True, required=False, default=list)
+    updates = AnnotationUpdateSerializer(many=True, required=False, default=list)
+    deletes = serializers.ListField(child=serializers.IntegerField(), required=False, default=list)
+
+    def validate(self, attrs):
+        """作成・更新後の範囲が教材の本文に収まるか確かめる（部分更新は保存済みの端と組み合わせる）"""
+        length = ReadingMaterial.objects.filter(pk=attrs['material']).values_list('text__length', flat=True).first()
+        saved = {
+            pk: (start, end)
+            for pk, start, end in Annotation.objects.filter(
+                pk__in=[change['id'] for change in attrs['updates']],
+                student_id=attrs['student'], material_id=attrs['material'],
+            ).values_list('pk', 'start_position', 'end_position')
+        }
+        errors = {}
+        for index, change in enumerate(attrs['creates']):
+            message = _range_error(change['start_position'], change['end_position'], length)
+            if message:
+                errors.setdefault('creates', {})[index] = {'end_position': message}
+        for index, change in enumerate(attrs['updates']):
+            if change['id'] not in saved or not {'start_position', 'end_position'} & change.keys():
+                continue
+            start, end = saved[change['id']]
+            message = _range_error(change.get('start_position', start), change.get('end_position', end), length)
+            if message:
+                errors.setdefault('updates', {})[index] = {'end_position': message}
+        if errors:
+            raise serializers.ValidationError(errors)
+        return attrs
+
+def _range_error(start, end, length):
+    if end < start:
+        return 'start_position 以上の値が必要です'
+    if length is not None and end > length:
+        return f'本文の文字数（{length}）以下の値が必要です'
+    return None
+
+class ActivityEventSerializer(serializers.Serializer):
+    type = serializers.ChoiceField(choices=CLIENT_EVENT_TYPES)
+    question = serializers.IntegerField(required=False, allow_null=True, default=None)
+    position = serializers.IntegerField(min_value=0, required=False, allow_null=True, default=None)
+    at = serializers.DateTimeField(required=False, allow_null=True, default=None)
+
+class ActivityBatchSerializer(serializers.Serializer):
+    student = serializers.IntegerField()
+    material = serializers.IntegerField()
+    events = ActivityEventSerializer(many=True, allow_empty=False, max_length=200)
+
+class CommentSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     author = UserSerializer(read_only=True)
     
     class Meta:
         model = Comment
         fields = ['id', 'author', 'target_answer', 'content', 'created_at', 'updated_at']
 
-class NotificationSerializer(serializers.ModelSerializer):
+class NotificationSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     recipient = UserSerializer(read_only=True)
     sender = UserSerializer(read_only=True)
     
     class Meta:
         model = Notification
         fields = ['id', 'recipient', 'sender', 'notification_type', 'title', 'message', 'is_read', 'created_at']
+
+class TextSegmentSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    class Meta:
+        model = TextSegment
+        fields = ['key', 'position', 'paragraph', 'start', 'end', 'text']
+
+class SearchResultSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    rank = serializers.FloatField(read_only=True)
+    snippet = serializers.SerializerMethodField()
+
+    class Meta:
+        model = SearchDocument
+        fields = ['kind', 'object_id', 'material', 'user', 'rank', 'snippet', 'updated_at']
+
+    def get_snippet(self, obj):
+        return snippet(obj.text, self.context.get('query', ''))
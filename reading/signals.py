@@ -0,0 +1,216 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from .activity import record, record_annotations
+from .authentication import invalidate_token, invalidate_user
+from .citations import replace_citations
+from .gradebook import answers_changed, forget_question_scopes, invalidate_gradebook
+from .httpcache import invalidate
+from .intervals import invalidate_annotation_index
+from .models import Annotation, Comment, CustomUser, Group, Notification, Question, ReadingMaterial, StudentAnswer
+from .notifications import UNREAD_KEY, enqueue_comment, publish_notifications, publish_read_state, track_unread
+from .progress import answers_created, answers_deleted, comment_added, comment_removed
+from .search import answer_document, comment_document, material_document, remove_document, save_documents
+from .segments import content_saved
+
+# --- 教材・問題・回答（レスポンスキャッシュの無効化） ---
+@receiver([post_save, post_delete], sender=ReadingMaterial)
+def material_changed(sender, instance, **kwargs):
+    invalidate(f'material:{instance.pk}')
+    forget_question_scopes()
+    invalidate_gradebook(instance.pk, instance.group_id)
+
+
+@receiver(post_save, sender=ReadingMaterial)
+def segment_material(sender, instance, created, update_fields=None, **kwargs):
+    # 本文の区切りを作り直し、本文が編集されていれば注釈・引用の位置を付け替える
+    if update_fields is None or 'text' in update_fields:
+        content_saved(instance, created)
+
+
+@receiver([post_save, post_delete], sender=Question)
+def question_changed(sender, instance, **kwargs):
+    invalidate(f'material:{instance.material_id}')
+    forget_question_scopes()
+    group_id = ReadingMaterial.objects.filter(pk=instance.material_id).values_list('group_id', flat=True).first()
+    invalidate_gradebook(instance.material_id, group_id)
+
+
+@receiver([post_save, post_delete], sender=StudentAnswer)
+def answer_changed(sender, instance, **kwargs):
+    answers_changed([instance.question_id])
+
+
+# --- 進捗集計（upsert_drafts で作られた回答は reading.autosave が数える） ---
+@receiver(post_save, sender=StudentAnswer)
+def answer_progress(sender, instance, created, **kwargs):
+    if created:
+        answers_created([(instance.student_id, instance.question_id)])
+
+
+@receiver(post_delete, sender=StudentAnswer)
+def answer_deleted_progress(sender, instance, **kwargs):
+    answers_deleted([(instance.student_id, instance.question_id)])
+
+
+@receiver(post_save, sender=Comment)
+def comment_progress(sender, instance, created, **kwargs):
+    if created:
+        comment_added(instance)
+
+
+@receiver(post_delete, sender=Comment)
+def comment_deleted_progress(sender, instance, **kwargs):
+    comment_removed(instance)
+
+
+def _group_materials_changed(groups):
+    for material_id, group_id in ReadingMaterial.objects.filter(group__in=groups).values_list('pk', 'group_id'):
+        invalidate(f'material:{material_id}')
+        invalidate_gradebook(material_id, group_id)
+
+
+@receiver(post_save, sender=Group)
+def group_changed(sender, instance, created, **kwargs):
+    # 教材のレスポンスにはグループ（教員・学生）が入れ子で含まれる
+    if not created:
+        _group_materials_changed([instance])
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(pre_delete, sender=CustomUser)
+def user_responses_changed(sender, instance, created=False, update_fields=None, **kwargs):
+    # 教材（グループ・作成者）と成績表のレスポンスにはユーザー名が入れ子で含まれる（ログイン時刻の更新は除く）
+    if created or set(update_fields or ()) == {'last_login'}:
+        return
+    groups = list(Group.objects.filter(Q(teacher=instance) | Q(students=instance)).distinct())
+    for group in groups:
+        invalidate(f'gradebook:group:{group.pk}')
+    for material_id, group_id in ReadingMaterial.objects.filter(
+        Q(group__in=groups) | Q(created_by=instance),
+    ).values_list('pk', 'group_id'):
+        invalidate(f'material:{material_id}')
+        invalidate_gradebook(material_id, group_id)
+
+
+@receiver(m2m_changed, sender=Group.students.through)
+def group_students_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    groups = list(Group.objects.filter(pk__in=pk_set or ())) if reverse else [instance]
+    for group in groups:
+        invalidate(f'gradebook:group:{group.pk}')
+    _group_materials_changed(groups)
+
+
+# --- 注釈 ---
+@receiver([post_save, post_delete], sender=Annotation)
+def annotation_changed(sender, instance, **kwargs):
+    invalidate_annotation_index(instance.material_id)
+
+
+@receiver(post_save, sender=Annotation)
+def annotation_activity(sender, instance, created, **kwargs):
+    # 一括作成（同期 API）は sync_annotations で記録する
+    if created:
+        record_annotations([instance])
+
+
+@receiver(post_delete, sender=Annotation)
+def annotation_deleted_activity(sender, instance, **kwargs):
+    record(
+        instance.student_id, 'annotation_delete', material_id=instance.material_id,
+        start=instance.start_position, end=instance.end_position, data={'id': instance.pk},
+    )
+
+
+# --- 通知 ---
+@receiver(post_save, sender=Notification)
+def notification_saved(sender, instance, created, update_fields=None, **kwargs):
+    if created:
+        track_unread({instance.recipient_id: 0 if instance.is_read else 1})
+        publish_notifications([instance])
+    elif update_fields is None or 'is_read' in update_fields:
+        was_read = getattr(instance, '_loaded_is_read', None)
+        if was_read is None:
+            transaction.on_commit(lambda: cache.delete(UNREAD_KEY.format(instance.recipient_id)))
+        elif was_read != instance.is_read:
+            track_unread({instance.recipient_id: -1 if instance.is_read else 1})
+        instance._loaded_is_read = instance.is_read
+        publish_read_state(instance.recipient_id, [instance.pk], instance.is_read)
+
+
+@receiver(post_delete, sender=Notification)
+def notification_deleted(sender, instance, **kwargs):
+    if not instance.is_read:
+        track_unread({instance.recipient_id: -1})
+
+
+# --- コメント ---
+@receiver(post_save, sender=Comment)
+def comment_created(sender, instance, created, **kwargs):
+    if created:
+        transaction.on_commit(lambda: enqueue_comment(instance.pk))
+
+
+# --- 全文検索の索引・引用箇所 ---
+def _indexed_fields_changed(update_fields, fields):
+    return update_fields is None or bool(set(update_fields) & set(fields))
+
+
+@receiver(post_save, sender=ReadingMaterial)
+def index_material(sender, instance, update_fields=None, **kwargs):
+    if _indexed_fields_changed(update_fields, ['title', 'text']):
+        save_documents([material_document(instance)])
+
+
+@receiver(post_save, sender=StudentAnswer)
+def index_answer(sender, instance, update_fields=None, **kwargs):
+    if _indexed_fields_changed(update_fields, ['answer_text', 'reasoning_note']):
+        save_documents([answer_document(instance, instance.question.material_id)])
+
+
+@receiver(post_save, sender=StudentAnswer)
+def answer_citations(sender, instance, created, update_fields=None, **kwargs):
+    if created and not instance.citations:
+        return
+    if _indexed_fields_changed(update_fields, ['citations']):
+        replace_citations(
+            [(instance.pk, instance.student_id, instance.question.material_id, instance.citations)], created=created,
+        )
+
+
+@receiver(post_save, sender=Comment)
+def index_comment(sender, instance, update_fields=None, **kwargs):
+    if _indexed_fields_changed(update_fields, ['content']):
+        material_id = Question.objects.filter(studentanswer=instance.target_answer_id).values_list(
+            'material_id', flat=True,
+        ).first()
+        save_documents([comment_document(instance, material_id)])
+
+
+@receiver(post_delete, sender=StudentAnswer)
+def unindex_answer(sender, instance, **kwargs):
+    remove_document('answer', instance.pk)
+
+
+@receiver(post_delete, sender=Comment)
+def unindex_comment(sender, instance, **kwargs):
+    remove_document('comment', instance.pk)
+
+
+# --- 認証キャッシュ ---
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    invalidate_token(instance.key)
+
+
+@receiver(post_save, sender=CustomUser)
+def user_changed(sender, instance, created, update_fields=None, **kwargs):
+    # パスワード・有効フラグなどが変わったらキャッシュ上のユーザーを捨てる（ログイン時刻の更新は除く）
+    if not created and set(update_fields or ()) != {'last_login'}:
+        invalidate_user(instance.pk)
@@ -0,0 +1,86 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core import signing
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .activity import record_annotations
+from .intervals import invalidate_annotation_index
+from .models import Annotation
+
+_SALT = 'reading.annotation-sync'
+
+
+def make_sync_token(material_id, student_id, moment):
+    """moment が None のトークンは「まだ何も受け取っていない」（次回は全件を変更として返す）"""
+    return signing.dumps(
+        {'m': material_id, 's': student_id, 't': moment.isoformat() if moment else None}, salt=_SALT,
+    )
+
+
+def read_sync_token(token, material_id, student_id):
+    """同期トークンから前回同期時刻を取り出す（別の教材・学生のトークンなら BadSignature）"""
+    data = signing.loads(token, salt=_SALT)
+    if data.get('m') != material_id or data.get('s') != student_id:
+        raise signing.BadSignature('sync token does not belong to this material/student')
+    return parse_datetime(data['t']) if data.get('t') else None
+
+
+def next_sync_moment(latest, since=None):
+    """実際に読んだ行の最大 updated_at から、次回の基準時刻を決める
+
+    updated_at はコミットより前に決まるため、並行する書き込みは読んだ最大値より古い時刻で後から見えることがある。
+    ANNOTATION_SYNC_WINDOW_SECONDS だけ戻して拾い直す（重複して返る行はクライアントが id で上書きする）。
+    """
+    if latest is None:
+        return since
+    moment = latest - timedelta(seconds=settings.ANNOTATION_SYNC_WINDOW_SECONDS)
+    return moment if since is None else max(since, moment)
+
+
+def sync_annotations(student_id, material_id, creates=(), updates=(), deletes=()):
+    """学生の注釈の変更をまとめて1トランザクションで適用する
+
+    creates は client_id 付きの新規注釈、updates は id 付きの変更フィールド、deletes は id のリスト。
+    戻り値は (client_id → 新しい id の dict, 更新した id, 削除した id)。
+    """
+    owned = Annotation.objects.filter(student_id=student_id, material_id=material_id)
+    with transaction.atomic():
+        now = timezone.now()
+        created = {}
+        if creates:
+            objs = [
+                Annotation(
+                    student_id=student_id, material_id=material_id,
+                    **{name: value for name, value in change.items() if name != 'client_id'},
+                )
+                for change in creates
+            ]
+            Annotation.objects.bulk_create(objs)
+            record_annotations(objs)
+            created = {change.get('client_id'): obj.pk for change, obj in zip(creates, objs)}
+
+        updated = []
+        if updates:
+            changes = {change['id']: change for change in updates}
+            objs = list(owned.filter(pk__in=changes))
+            fields = {'updated_at'}
+            for obj in objs:
+                for name, value in changes[obj.pk].items():
+                    if name != 'id':
+                        setattr(obj, name, value)
+                        fields.add(name)
+                obj.updated_at = now
+            Annotation.objects.bulk_update(objs, sorted(fields))
+            updated = [obj.pk for obj in objs]
+
+        deleted = []
+        if deletes:
+            deleted = list(owned.filter(pk__in=deletes).values_list('pk', flat=True))
+            Annotation.objects.filter(pk__in=deleted).delete()
+
+        if creates or updated or deleted:
+            transaction.on_commit(lambda: invalidate_annotation_index(material_id))
+    return created, updated, deleted
@@ -1,3 +1,1438 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from .activity import ActivityBuffer, compact_chunks
+from .autosave import refresh_answers
+from .authentication import _shared_ttl
+from .gradebook import answers_changed, question_scopes
+from .httpcache import bump_version
+from . import autosave, benchmark, metrics, views
+from .dbpool import ConnectionPool, PoolTimeout
+from .explain import check_endpoints, endpoint_urls, explain, sequential_scans
+from .intervals import IntervalTree, coverage, invalidate_annotation_index
+from .middleware import StaticFilesMiddleware, choose_encoding
+from . import middleware
+from .models import ActivityChunk, AnswerPatch, CustomUser, Group, MaterialText, ReadingMaterial, Question, StudentAnswer, Annotation, Comment, Notification, ProgressSummary, SearchDocument, TextSegment
+from .notifications import CommentFanout, fan_out_comments, parse_mentions
+from .progress import expected_progress, mark_seen, reconcile_progress
+from .pooled_postgresql.base import DatabaseWrapper as PooledDatabaseWrapper
+from .pubsub import InProcessPubSub, user_channel
+from .search import parse_query, tokenize
+from .segments import invalidate_segment_index, offset_mapper, split_segments
+from .views import _sse_events
+
+
+# --- テスト用ヘルパー ---
+class QueryBudgetMixin:
+    """エンドポイントごとのクエリ数上限を検証するヘルパー"""
+
+    def assertQueryBudget(self, url, budget, grow=None, method='get', **kwargs):
+        """url へのリクエストが budget 件以内のクエリで完了することを検証する
+
+        grow を渡した場合はデータを増やして再度リクエストし、
+        行数に関わらずクエリ数が変わらないことも検証する。
+        コミット後の処理（transaction.on_commit）も実行して数える。
+        バックグラウンドの処理はリクエストの外なので数えず、計測後にこのスレッドで実行する。
+        """
+        def run():
+            with mock.patch.object(autosave._refresher, 'enqueue', autosave._refresher.put):
+                with CaptureQueriesContext(connection) as ctx, self.captureOnCommitCallbacks(execute=True):
+                    response = getattr(self.client, method)(url, **kwargs)
+            autosave._refresher.flush()
+            self.assertLess(response.status_code, 400, response.content)
+            return len(ctx.captured_queries), ctx.captured_queries
+
+        count, queries = run()
+        self.assertLessEqual(
+            count, budget,
+            f"{url}: {count} queries (budget {budget})\n" + "\n".join(q['sql'] for q in queries),
+        )
+        if grow is not None:
+            grow()
+            grown, queries = run()
+            self.assertEqual(
+                grown, count,
+                f"{url}: query count changed with row count ({count} -> {grown})\n"
+                + "\n".join(q['sql'] for q in queries),
+            )
+        return count
+
+
+def make_class(prefix, n_students=3, n_materials=2, n_questions=2):
+    """教員・グループ・学生・教材・問題・回答・注釈・通知をまとめて作成する"""
+    teacher = CustomUser.objects.create_user(f'{prefix}_teacher', user_type='teacher')
+    group = Group.objects.create(name=f'{prefix} class', teacher=teacher)
+    students = [
+        CustomUser.objects.create_user(f'{prefix}_student{i}')
+        for i in range(n_students)
+    ]
+    group.students.add(*students)
+    for m in range(n_materials):
+        material = ReadingMaterial.objects.create(
+            title=f'{prefix} material {m}', content='本文' * 50, group=group, created_by=teacher,
+        )
+        for q in range(n_questions):
+            question = Question.objects.create(
+                material=material, question_text=f'問{q}', question_type='descriptive', order=q,
+            )
+            for student in students:
+                answer = StudentAnswer.objects.create(student=student, question=question, answer_text='回答')
+                comment = Comment.objects.create(author=teacher, target_answer=answer, content='コメント')
+                Notification.objects.create(
+                    recipient=student, sender=teacher, notification_type='comment',
+                    title='新しいコメント', message='コメントがあります', related_comment=comment,
+                )
+        for student in students:
+            Annotation.objects.create(
+                student=student, material=material, annotation_type='highlight',
+                start_position=0, end_position=5,
+            )
+    return teacher, group, students
+
+
+class QueryBudgetTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        make_class('a')
+
+    def grow(self):
+        make_class('b', n_students=6, n_materials=3, n_questions=3)
+
+    def test_materials_list(self):
+        self.assertQueryBudget('/api/materials/', 4, grow=self.grow)
+
+    def test_material_questions(self):
+        material = ReadingMaterial.objects.first()
+        self.assertQueryBudget(f'/api/materials/{material.pk}/questions/', 2)
+
+    def test_material_annotations(self):
+        material = ReadingMaterial.objects.first()
+        self.assertQueryBudget(f'/api/materials/{material.pk}/annotations/', 2)
+
+    def test_answers_list(self):
+        self.assertQueryBudget('/api/answers/', 2, grow=self.grow)
+
+    def test_annotations_list(self):
+        self.assertQueryBudget('/api/annotations/', 1, grow=self.grow)
+
+    def test_comments_list(self):
+        self.assertQueryBudget('/api/comments/', 1, grow=self.grow)
+
+    def test_notifications_list(self):
+        self.assertQueryBudget('/api/notifications/', 1, grow=self.grow)
+
+    def test_unread_notifications(self):
+        student = CustomUser.objects.get(username='a_student0')
+        self.assertQueryBudget(f'/api/notifications/unread/?user_id={student.pk}', 1)
+
+
+class PaginationAndSparseFieldsTests(TestCase):
+    def setUp(self):
+        make_class('a', n_students=3, n_materials=3, n_questions=2)
+
+    def test_cursor_walks_every_row_once(self):
+        seen = []
+        url = '/api/answers/?page_size=5'
+        while url:
+            data = self.client.get(url).json()
+            self.assertLessEqual(len(data['results']), 5)
+            seen.extend(row['id'] for row in data['results'])
+            url = data['next']
+        self.assertEqual(sorted(seen), sorted(StudentAnswer.objects.values_list('id', flat=True)))
+
+    def test_list_omits_content_and_students_by_default(self):
+        row = self.client.get('/api/materials/').json()['results'][0]
+        self.assertNotIn('content', row)
+        self.assertNotIn('students', row['group'])
+        self.assertIn('teacher', row['group'])
+
+    def test_fields_opts_back_in(self):
+        row = self.client.get('/api/materials/?fields=id,content,group.students').json()['results'][0]
+        self.assertEqual(set(row), {'id', 'content', 'group'})
+        self.assertEqual(set(row['group']), {'students'})
+        self.assertEqual(len(row['group']['students']), 3)
+
+    def test_retrieve_and_omit(self):
+        material = ReadingMaterial.objects.first()
+        row = self.client.get(f'/api/materials/{material.pk}/').json()
+        self.assertIn('content', row)
+        self.assertIn('students', row['group'])
+        row = self.client.get(f'/api/materials/{material.pk}/?omit=content,group').json()
+        self.assertNotIn('content', row)
+        self.assertNotIn('group', row)
+
+
+class AutosaveTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        _, _, students = make_class('a', n_students=1, n_materials=1, n_questions=3)
+        self.student = students[0]
+        self.questions = list(Question.objects.values_list('id', flat=True))
+        StudentAnswer.objects.filter(question_id=self.questions[2]).delete()
+        # 問題→教材の対応はプロセス内に保持されるので、定常状態を測るために先に読み込んでおく
+        answers_changed(self.questions)
+
+    def autosave(self, *drafts):
+        return self.client.post(
+            '/api/answers/autosave/',
+            {'student': self.student.pk, 'drafts': list(drafts)},
+            content_type='application/json',
+        )
+
+    def test_batch_upsert_in_one_statement(self):
+        drafts = [
+            {'question': q, 'answer_text': f'下書き{q}', 'revision': 10}
+            for q in self.questions
+        ]
+        # 回答の upsert と、新しく作られた回答の進捗集計。索引・引用箇所はバックグラウンドで更新する
+        self.assertQueryBudget(
+            '/api/answers/autosave/', 2, method='post',
+            data={'student': self.student.pk, 'drafts': drafts}, content_type='application/json',
+        )
+        answers = StudentAnswer.objects.filter(student=self.student)
+        self.assertEqual(answers.count(), 3)
+        self.assertTrue(all(a.revision == 10 and a.answer_text == f'下書き{a.question_id}' for a in answers))
+        self.assertEqual(SearchDocument.objects.filter(kind='answer', user=self.student).count(), 3)
+
+        for draft in drafts:
+            draft['revision'] = 11
+        self.assertQueryBudget(
+            '/api/answers/autosave/', 1, method='post',
+            data={'student': self.student.pk, 'drafts': drafts}, content_type='application/json',
+        )
+
+    def test_refresh_skips_unchanged_answers(self):
+        q = self.questions[0]
+        self.autosave({'question': q, 'answer_text': '根拠は二段落目', 'citations': [{'start': 0, 'end': 3}], 'revision': 1})
+        answer = StudentAnswer.objects.get(student=self.student, question_id=q)
+        refresh_answers([answer.pk])
+        with CaptureQueriesContext(connection) as ctx:
+            refresh_answers([answer.pk])
+        self.assertTrue(all(query['sql'].startswith('SELECT') for query in ctx.captured_queries), ctx.captured_queries)
+        self.assertEqual(list(answer.citation_spans.values_list('start', 'end')), [(0, 3)])
+
+    def test_stale_revision_is_dropped(self):
+        q = self.questions[0]
+        self.autosave({'question': q, 'answer_text': '新しい', 'revision': 5})
+        data = self.autosave({'question': q, 'answer_text': '古い', 'revision': 4}).json()
+        self.assertEqual(data['saved'], [])
+        self.assertEqual(data['stale'], [q])
+        self.assertEqual(data['current'], [{'question': q, 'revision': 5}])
+        self.assertEqual(StudentAnswer.objects.get(student=self.student, question_id=q).answer_text, '新しい')
+
+    def test_create_upserts(self):
+        q = self.questions[2]
+        payload = {'student': self.student.pk, 'question': q, 'answer_text': '一回目'}
+        response = self.client.post('/api/answers/', payload, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        payload['answer_text'] = '二回目'
+        response = self.client.post('/api/answers/', payload, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['answer_text'], '二回目')
+        self.assertEqual(StudentAnswer.objects.filter(student=self.student, question_id=q).count(), 1)
+
+    def test_create_uses_the_autosave_revisions(self):
+        q = self.questions[2]
+        # クライアントの時刻がサーバーより遅れていても、省略時のリビジョンが自動保存を追い越さない
+        self.autosave({'question': q, 'answer_text': '自動保存', 'revision': 1000})
+        payload = {'student': self.student.pk, 'question': q, 'answer_text': '提出'}
+        response = self.client.post('/api/answers/', payload, content_type='application/json')
+        self.assertEqual((response.status_code, response.json()['revision']), (200, 1001))
+        self.assertEqual(self.autosave({'question': q, 'answer_text': '続き', 'revision': 1002}).json()['stale'], [])
+
+        response = self.client.post('/api/answers/', {**payload, 'revision': 1002}, content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['revision'], 1002)
+
+
+class AnswerPatchTests(TestCase):
+    def setUp(self):
+        _, _, students = make_class('a', n_students=1, n_materials=1, n_questions=1)
+        self.student = students[0]
+        self.answer = StudentAnswer.objects.get(student=self.student)
+
+    def patch(self, base, revision, **ops):
+        return self.client.post(
+            '/api/answers/patch/',
+            {'student': self.student.pk, 'question': self.answer.question_id,
+             'base_revision': base, 'revision': revision, **ops},
+            content_type='application/json',
+        )
+
+    def test_patches_apply_without_rewriting_answer(self):
+        self.assertEqual(self.patch(0, 1, answer_text=[{'at': 2, 'insert': 'です'}]).status_code, 200)
+        self.assertEqual(self.patch(1, 2, answer_text=[{'at': 0, 'delete': 2, 'insert': '答え'}]).status_code, 200)
+        self.answer.refresh_from_db()
+        self.assertEqual(self.answer.answer_text, '回答')
+        data = self.client.get(f'/api/answers/{self.answer.pk}/').json()
+        self.assertEqual(data['answer_text'], '答えです')
+        self.assertEqual(data['revision'], 2)
+
+    def test_stale_base_conflicts(self):
+        self.patch(0, 1, answer_text=[{'at': 0, 'insert': 'a'}])
+        response = self.patch(0, 2, answer_text=[{'at': 0, 'insert': 'b'}])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['revision'], 1)
+
+    def test_autosave_older_than_patch_head_is_stale(self):
+        self.patch(0, 10, answer_text=[{'at': 2, 'insert': 'です'}])
+        drafts = {'student': self.student.pk, 'drafts': [{'question': self.answer.question_id, 'answer_text': '古い', 'revision': 7}]}
+        response = self.client.post('/api/answers/autosave/', drafts, content_type='application/json')
+        self.assertEqual(response.json()['stale'], [self.answer.question_id])
+        data = self.client.get(f'/api/answers/{self.answer.pk}/').json()
+        self.assertEqual((data['answer_text'], data['revision']), ('回答です', 10))
+
+        drafts['drafts'][0]['revision'] = 11
+        response = self.client.post('/api/answers/autosave/', drafts, content_type='application/json')
+        self.assertEqual(response.json()['stale'], [])
+        data = self.client.get(f'/api/answers/{self.answer.pk}/').json()
+        self.assertEqual((data['answer_text'], data['revision']), ('古い', 11))
+
+    def test_out_of_range_is_rejected(self):
+        response = self.patch(0, 1, answer_text=[{'at': 10, 'delete': 1}])
+        self.assertEqual(response.status_code, 400)
+
+    def test_compaction_writes_back(self):
+        from .autosave import COMPACT_EVERY
+        for revision in range(1, COMPACT_EVERY + 1):
+            self.patch(revision - 1, revision, reasoning_note=[{'at': revision - 1, 'insert': 'x'}])
+        self.answer.refresh_from_db()
+        self.assertEqual(self.answer.reasoning_note, 'x' * COMPACT_EVERY)
+        self.assertEqual(self.answer.revision, COMPACT_EVERY)
+        self.assertFalse(self.answer.patches.exists())
+
+
+class IntervalIndexTests(TestCase):
+    def test_overlap_matches_brute_force(self):
+        import random
+        rng = random.Random(0)
+        intervals = []
+        for i in range(300):
+            start = rng.randrange(1000)
+            intervals.append((start, start + rng.randrange(1, 80), i))
+        tree = IntervalTree(intervals)
+        for _ in range(200):
+            start = rng.randrange(1000)
+            end = start + rng.randrange(1, 120)
+            expected = sorted(i for i in intervals if i[0] < end and i[1] > start)
+            self.assertEqual(sorted(tree.overlap(start, end)), expected)
+
+    def test_coverage_counts_each_owner_once(self):
+        segments = coverage([(0, 10, 'a'), (5, 15, 'a'), (8, 12, 'b')], key=lambda item: item[2])
+        self.assertEqual(
+            [(start, end, len(owners)) for start, end, owners in segments],
+            [(0, 8, 1), (8, 12, 2), (12, 15, 1)],
+        )
+
+    def test_window_and_coverage_endpoints(self):
+        _, _, students = make_class('a', n_students=2, n_materials=1, n_questions=0)
+        material = ReadingMaterial.objects.get()
+        Annotation.objects.create(
+            student=students[0], material=material, annotation_type='highlight', start_position=50, end_position=60,
+        )
+        rows = self.client.get(f'/api/materials/{material.pk}/annotations/?start=40&end=55').json()['results']
+        self.assertEqual([(r['start_position'], r['end_position']) for r in rows], [(50, 60)])
+        rows = self.client.get(f'/api/materials/{material.pk}/annotations/?start=0&end=3').json()['results']
+        self.assertEqual(len(rows), 2)
+
+        data = self.client.get(f'/api/materials/{material.pk}/annotation_coverage/').json()
+        self.assertEqual(data['max_count'], 2)
+        self.assertEqual(
+            [(s['start'], s['end'], s['count']) for s in data['segments']],
+            [(0, 5, 2), (50, 60, 1)],
+        )
+
+    def test_window_is_paginated_by_start_position(self):
+        _, _, students = make_class('a', n_students=2, n_materials=1, n_questions=0)
+        material = ReadingMaterial.objects.get()
+        Annotation.objects.bulk_create([
+            Annotation(student=students[1], material=material, annotation_type='highlight', start_position=i, end_position=i + 2)
+            for i in range(10, 40)
+        ])
+        invalidate_annotation_index(material.pk)
+        url, seen = f'/api/materials/{material.pk}/annotations/?start=0&end=100&page_size=7', []
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                data = self.client.get(url).json()
+            self.assertLessEqual(len(data['results']), 7)
+            self.assertFalse(any(' IN (' in query['sql'] for query in queries.captured_queries))
+            seen.extend((r['start_position'], r['id']) for r in data['results'])
+            url = data['next']
+        self.assertEqual(len(seen), 32)
+        self.assertEqual(seen, sorted(seen))
+
+
+class AnnotationSyncTests(TestCase):
+    def setUp(self):
+        _, _, students = make_class('a', n_students=1, n_materials=1, n_questions=0)
+        self.student = students[0]
+        self.material = ReadingMaterial.objects.get()
+        self.existing = Annotation.objects.get()
+
+    def sync(self, **changes):
+        return self.client.post(
+            '/api/annotations/sync/',
+            {'student': self.student.pk, 'material': self.material.pk, **changes},
+            content_type='application/json',
+        ).json()
+
+    @override_settings(ANNOTATION_SYNC_WINDOW_SECONDS=0)
+    def test_applies_change_set_and_returns_ids(self):
+        data = self.sync(
+            creates=[
+                {'client_id': 'c1', 'annotation_type': 'highlight', 'start_position': 10, 'end_position': 20},
+                {'client_id': 'c2', 'annotation_type': 'sticky_note', 'start_position': 30, 'end_position': 30,
+                 'content': 'メモ'},
+            ],
+            updates=[{'id': self.existing.pk, 'color': '#99ff99'}],
+        )
+        ids = {row['client_id']: row['id'] for row in data['created']}
+        self.assertEqual(set(ids), {'c1', 'c2'})
+        self.assertEqual(Annotation.objects.get(pk=ids['c2']).content, 'メモ')
+        self.assertEqual(data['updated'], [self.existing.pk])
+        self.existing.refresh_from_db()
+        self.assertEqual(self.existing.color, '#99ff99')
+
+        data = self.sync(since=data['sync_token'], deletes=[ids['c1']])
+        self.assertEqual(data['deleted'], [ids['c1']])
+        self.assertEqual(sorted(data['ids']), sorted([self.existing.pk, ids['c2']]))
+        self.assertEqual(data['changes'], [])
+
+    def test_token_rewinds_from_latest_row(self):
+        # トークンは読んだ行の最大 updated_at から戻すので、コミットの遅れた書き込みも次回に返る
+        token = self.sync()['sync_token']
+        late = Annotation.objects.create(
+            student=self.student, material=self.material, annotation_type='highlight', start_position=1, end_position=2,
+        )
+        Annotation.objects.filter(pk=late.pk).update(updated_at=self.existing.updated_at - timedelta(seconds=1))
+        data = self.sync(since=token)
+        self.assertIn(late.pk, [row['id'] for row in data['changes']])
+
+    def test_partial_update_keeps_range_valid(self):
+        response = self.client.post(
+            '/api/annotations/sync/',
+            {'student': self.student.pk, 'material': self.material.pk,
+             'updates': [{'id': self.existing.pk, 'start_position': 10}]},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('updates', response.json())
+        response = self.client.post(
+            '/api/annotations/sync/',
+            {'student': self.student.pk, 'material': self.material.pk,
+             'updates': [{'id': self.existing.pk, 'end_position': len(self.material.content) + 1}]},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.existing.refresh_from_db()
+        self.assertEqual((self.existing.start_position, self.existing.end_position), (0, 5))
+
+        self.sync(updates=[{'id': self.existing.pk, 'end_position': len(self.material.content)}])
+        self.existing.refresh_from_db()
+        self.assertEqual(self.existing.end_position, len(self.material.content))
+
+    def test_rejects_foreign_token(self):
+        token = self.sync()['sync_token']
+        other = ReadingMaterial.objects.create(
+            title='other', content='x', group=self.material.group, created_by=self.material.created_by,
+        )
+        response = self.client.post(
+            '/api/annotations/sync/',
+            {'student': self.student.pk, 'material': other.pk, 'since': token},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class NotificationPushTests(TestCase):
+    def test_stream_requires_asgi(self):
+        response = self.client.get('/api/notifications/stream/?user_id=1')
+        self.assertEqual(response.status_code, 501)
+
+    def test_failed_publish_does_not_fail_the_save(self):
+        teacher, _, students = make_class('a', n_students=1, n_materials=0)
+        broken = mock.Mock(publish=mock.Mock(side_effect=ConnectionError))
+        with mock.patch('reading.notifications.get_pubsub', return_value=broken), \
+                self.assertLogs('reading.notifications', 'ERROR'):
+            with self.captureOnCommitCallbacks(execute=True):
+                Notification.objects.create(recipient=students[0], sender=teacher, title='t', message='m')
+        self.assertTrue(broken.publish.called)
+
+    def test_created_notification_reaches_stream(self):
+        teacher, _, students = make_class('a', n_students=1, n_materials=0)
+        pubsub = InProcessPubSub()
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        with mock.patch('reading.views.get_pubsub', return_value=pubsub), \
+                mock.patch('reading.notifications.get_pubsub', return_value=pubsub):
+            stream = _sse_events(user_channel(students[0].pk))
+            self.assertTrue(loop.run_until_complete(stream.__anext__()).startswith('retry:'))
+            pending = loop.create_task(stream.__anext__())
+            loop.run_until_complete(asyncio.sleep(0))
+            self.assertEqual(pubsub.subscriber_count(user_channel(students[0].pk)), 1)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                notification = Notification.objects.create(
+                    recipient=students[0], sender=teacher, notification_type='comment', title='t', message='m',
+                )
+            chunk = loop.run_until_complete(asyncio.wait_for(pending, 1))
+            self.assertTrue(chunk.startswith('event: notification\n'))
+            self.assertEqual(json.loads(chunk.split('data: ', 1)[1])['notification']['id'], notification.pk)
+
+            pending = loop.create_task(stream.__anext__())
+            loop.run_until_complete(asyncio.sleep(0))
+            with self.captureOnCommitCallbacks(execute=True):
+                notification.is_read = True
+                notification.save(update_fields=['is_read'])
+            chunk = loop.run_until_complete(asyncio.wait_for(pending, 1))
+            self.assertTrue(chunk.startswith('event: read_state\n'))
+
+            loop.run_until_complete(stream.aclose())
+        self.assertEqual(pubsub.subscriber_count(user_channel(students[0].pk)), 0)
+
+
+@override_settings(COMMENT_FANOUT_MODE='immediate')
+class CommentFanoutTests(TestCase):
+    def setUp(self):
+        self.teacher, _, students = make_class('a', n_students=2, n_materials=1, n_questions=2)
+        self.student, self.classmate = students
+        Notification.objects.all().delete()
+        self.answers = list(StudentAnswer.objects.filter(student=self.student).order_by('pk'))
+
+    def test_comment_notifies_student_teacher_and_mentions(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                '/api/comments/',
+                {'author': self.classmate.pk, 'target_answer': self.answers[0].pk, 'content': '@a_teacher 見てください'},
+                content_type='application/json',
+            )
+        self.assertEqual(response.status_code, 201)
+        kinds = dict(Notification.objects.values_list('recipient__username', 'notification_type'))
+        self.assertEqual(kinds, {'a_student0': 'comment', 'a_teacher': 'mention'})
+
+    def test_mention_followed_by_japanese_text(self):
+        self.assertEqual(parse_mentions('@a_teacherさん 確認して'), {'a_teacher'})
+        with self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(author=self.classmate, target_answer=self.answers[0], content='@a_teacherさん 確認して')
+        self.assertEqual(Notification.objects.get(recipient=self.teacher).notification_type, 'mention')
+
+    def test_burst_collapses_into_digest_with_one_insert(self):
+        comments = [
+            Comment(author=self.teacher, target_answer=self.answers[0], content=f'コメント{i}') for i in range(5)
+        ] + [Comment(author=self.teacher, target_answer=self.answers[1], content='別の回答')]
+        Comment.objects.bulk_create(comments)
+        with CaptureQueriesContext(connection) as ctx:
+            notifications = fan_out_comments([c.pk for c in comments])
+        self.assertEqual(len(ctx.captured_queries), 2)
+        self.assertEqual(len(notifications), 2)
+        digest = Notification.objects.get(related_comment=comments[4])
+        self.assertEqual(digest.title, '5件の新しいコメント')
+        self.assertEqual(digest.recipient, self.student)
+
+    def test_background_worker_batches(self):
+        fanout = CommentFanout(delay=0.01)
+        with mock.patch('reading.notifications.fan_out_comments') as fan_out:
+            fanout.enqueue(1)
+            fanout.enqueue(2)
+            for _ in range(200):
+                if fan_out.called:
+                    break
+                time.sleep(0.01)
+        fan_out.assert_called_once_with([1, 2])
+
+
+class UnreadCountTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.teacher, _, students = make_class('a', n_students=1, n_materials=1, n_questions=3)
+        self.student = students[0]
+        self.url = f'/api/notifications/count/?user_id={self.student.pk}'
+
+    def count(self):
+        return self.client.get(self.url).json()['unread']
+
+    def test_counter_is_cached_and_maintained(self):
+        self.assertEqual(self.count(), 3)
+        self.assertQueryBudget(self.url, 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Notification.objects.create(
+                recipient=self.student, sender=self.teacher, notification_type='comment', title='t', message='m',
+            )
+        self.assertEqual(self.count(), 4)
+
+        notification = Notification.objects.filter(recipient=self.student).first()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(
+                f'/api/notifications/{notification.pk}/', {'is_read': True}, content_type='application/json',
+            )
+        self.assertEqual(self.count(), 3)
+        self.assertQueryBudget(self.url, 0)
+
+    def test_mark_all_read_is_one_update(self):
+        self.assertEqual(self.count(), 3)
+        with CaptureQueriesContext(connection) as ctx:
+            data = self.client.post(
+                '/api/notifications/mark_all_read/', {'user_id': self.student.pk}, content_type='application/json',
+            ).json()
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertEqual(data['updated'], 3)
+        self.assertEqual(self.count(), 0)
+        self.assertFalse(Notification.objects.filter(recipient=self.student, is_read=False).exists())
+
+
+class ConditionalGetTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        make_class('a', n_students=2, n_materials=1, n_questions=2)
+        self.material = ReadingMaterial.objects.get()
+        self.url = f'/api/materials/{self.material.pk}/'
+
+    def test_etag_and_cached_body(self):
+        first = self.client.get(self.url)
+        etag = first['ETag']
+        self.assertQueryBudget(self.url, 0)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        cached = self.client.get(self.url)
+        # キャッシュ済みの本文はフィールドの順序も含めて最初のレスポンスと同じ
+        self.assertEqual(cached.content, first.content)
+        self.assertNotIn('Last-Modified', cached)
+
+    def test_user_rename_invalidates(self):
+        etag = self.client.get(self.url)['ETag']
+        student = self.material.group.students.order_by('pk').first()
+        student.username = 'renamed'
+        student.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('renamed', [user['username'] for user in response.json()['group']['students']])
+
+    def test_question_save_invalidates(self):
+        url = f'{self.url}questions/'
+        etag = self.client.get(url)['ETag']
+        self.assertQueryBudget(url, 0)
+        question = Question.objects.first()
+        question.question_text = '変更後'
+        question.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertIn('変更後', [q['question_text'] for q in response.json()])
+
+    def test_group_membership_invalidates(self):
+        etag = self.client.get(self.url)['ETag']
+        self.material.group.students.add(CustomUser.objects.create_user('late'))
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['group']['students']), 3)
+
+
+class MaterialTextTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        make_class('a', n_students=1, n_materials=2, n_questions=0)
+        self.teacher, self.group, _ = make_class('b', n_students=1, n_materials=0, n_questions=0)
+        # 別のグループで同じ本文を使う
+        self.copy = ReadingMaterial.objects.create(title='写し', content='本文' * 50, group=self.group, created_by=self.teacher)
+
+    def test_identical_texts_are_stored_once(self):
+        self.assertEqual(MaterialText.objects.count(), 1)
+        text = MaterialText.objects.get()
+        self.assertEqual((text.digest, text.length), (MaterialText.digest_of('本文' * 50), 100))
+        self.assertEqual(ReadingMaterial.objects.get(pk=self.copy.pk).content, '本文' * 50)
+
+        self.assertQueryBudget('/api/materials/', 3, grow=lambda: ReadingMaterial.objects.create(
+            title='追加', content='別の本文', group=self.group, created_by=self.teacher,
+        ))
+        rows = self.client.get('/api/materials/').json()['results']
+        self.assertTrue(all('content' not in row for row in rows))
+        self.assertEqual({row['text']['hash'] for row in rows}, set(MaterialText.objects.values_list('digest', flat=True)))
+        # 本文を返さない一覧・?omit=content では本文の列を読まない
+        content_column = f'{MaterialText._meta.db_table}"."content"'
+        for url in ('/api/materials/', f'/api/materials/{self.copy.pk}/?omit=content'):
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(url)
+            self.assertFalse(any(content_column in query['sql'] for query in queries.captured_queries), url)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(f'/api/materials/{self.copy.pk}/?fields=content')
+        self.assertTrue(any(content_column in query['sql'] for query in queries.captured_queries))
+
+        response = self.client.get(f'/api/texts/{text.digest}/')
+        self.assertEqual(response.json(), {'hash': text.digest, 'content': '本文' * 50, 'length': 100})
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(self.client.get(f'/api/texts/{text.digest}/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.client.get(f'/api/texts/{"0" * 64}/').status_code, 404)
+
+    def test_edit_keeps_old_text_until_pruned(self):
+        old = self.copy.text_id
+        self.copy.content = '書き換えた本文'
+        self.copy.save()
+        self.assertEqual(MaterialText.objects.count(), 2)
+        self.assertEqual(MaterialText.prune(timezone.now() + timedelta(seconds=1)), 0)
+        ReadingMaterial.objects.exclude(pk=self.copy.pk).delete()
+        self.assertEqual(MaterialText.prune(timezone.now() - timedelta(hours=1)), 0)
+        self.assertEqual(MaterialText.prune(timezone.now() + timedelta(seconds=1)), 1)
+        self.assertFalse(MaterialText.objects.filter(pk=old).exists())
+
+
+class CompressionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        make_class('a', n_students=5, n_materials=1, n_questions=0)
+        self.url = f'/api/materials/{ReadingMaterial.objects.get().pk}/'
+
+    def test_gzip_is_negotiated_and_keeps_conditional_get(self):
+        plain = self.client.get(self.url)
+        self.assertFalse(plain.has_header('Content-Encoding'))
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(json.loads(gzip.decompress(response.content)), plain.json())
+        self.assertLess(len(response.content), len(plain.content))
+        self.assertEqual(response['ETag'], 'W/' + plain['ETag'])
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        small = self.client.get('/api/notifications/count/?user_id=1', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(small.has_header('Content-Encoding'))
+        self.assertFalse(self.client.get(self.url, HTTP_ACCEPT_ENCODING='identity').has_header('Content-Encoding'))
+
+    def test_choose_encoding(self):
+        with mock.patch.object(middleware, 'brotli', None):
+            self.assertEqual(choose_encoding('gzip, deflate, br'), 'gzip')
+            self.assertIsNone(choose_encoding('br'))
+        with mock.patch.object(middleware, 'brotli', object()):
+            self.assertEqual(choose_encoding('gzip, deflate, br'), 'br')
+            self.assertEqual(choose_encoding('br;q=0.5, gzip'), 'gzip')
+            self.assertIsNone(choose_encoding('gzip;q=0, br;q=0'))
+            self.assertEqual(choose_encoding('*'), 'br')
+
+
+class GradebookTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        teacher, self.group, students = make_class('a', n_students=3, n_materials=2, n_questions=0)
+        self.material = ReadingMaterial.objects.order_by('pk').first()
+        self.mc = Question.objects.create(
+            material=self.material, question_text='選べ', question_type='multiple_choice',
+            choices=['ア', 'イ'], correct_answer='イ', order=1,
+        )
+        self.desc = Question.objects.create(
+            material=self.material, question_text='書け', question_type='descriptive', order=2,
+        )
+        self.alice, self.bob, self.carol = students
+        StudentAnswer.objects.create(student=self.alice, question=self.mc, answer_text=' イ ')
+        StudentAnswer.objects.create(student=self.alice, question=self.desc, answer_text='説明')
+        StudentAnswer.objects.create(student=self.bob, question=self.mc, answer_text='ア')
+
+    def test_material_gradebook(self):
+        url = f'/api/materials/{self.material.pk}/gradebook/'
+        self.assertQueryBudget(url, 2)
+        data = self.client.get(url).json()
+        self.assertEqual(data['material']['question_count'], 2)
+        self.assertEqual(data['material']['multiple_choice_count'], 1)
+        rows = {row['username']: (row['answered'], row['correct']) for row in data['students']}
+        self.assertEqual(rows, {'a_student0': (2, 1), 'a_student1': (1, 0), 'a_student2': (0, 0)})
+
+    def test_autosave_invalidates_cached_gradebook(self):
+        url = f'/api/materials/{self.material.pk}/gradebook/'
+        self.client.get(url)
+        self.assertQueryBudget(url, 0)
+        self.client.post(
+            '/api/answers/autosave/',
+            {'student': self.carol.pk, 'drafts': [{'question': self.mc.pk, 'answer_text': 'イ', 'revision': 1}]},
+            content_type='application/json',
+        )
+        rows = {row['username']: row['correct'] for row in self.client.get(url).json()['students']}
+        self.assertEqual(rows['a_student2'], 1)
+
+    def test_question_scopes_follow_other_workers(self):
+        other = ReadingMaterial.objects.order_by('pk').last()
+        self.assertEqual(question_scopes([self.mc.pk]), {self.mc.pk: (self.material.pk, self.group.pk)})
+        # 別のプロセスで問題が他の教材に移った（このプロセスのシグナルは発火しない）
+        Question.objects.filter(pk=self.mc.pk).update(material=other)
+        bump_version('question-scopes:all')
+        self.assertEqual(question_scopes([self.mc.pk]), {self.mc.pk: (other.pk, self.group.pk)})
+
+    def test_group_gradebook(self):
+        url = f'/api/materials/gradebook/?group_id={self.group.pk}'
+        self.assertQueryBudget(url, 3)
+        data = self.client.get(url).json()
+        self.assertEqual(len(data['materials']), 2)
+        alice = next(row for row in data['students'] if row['username'] == 'a_student0')
+        self.assertEqual(alice['materials'][str(self.material.pk)]['correct'], 1)
+
+
+@override_settings(ACTIVITY_LOG_MODE='off', ANSWER_REFRESH_MODE='immediate')
+class ProgressTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.teacher, self.group, self.students = make_class('p', n_students=2, n_materials=1, n_questions=2)
+        self.material = ReadingMaterial.objects.get()
+        self.url = f'/api/progress/?teacher_id={self.teacher.pk}'
+
+    def dashboard(self):
+        return self.client.get(self.url).json()['groups'][0]['materials'][0]
+
+    def test_counters_follow_answers_and_comments(self):
+        self.assertEqual(
+            (self.dashboard()['answered'], self.dashboard()['comments'], self.dashboard()['unread_comments']), (4, 4, 0),
+        )
+        question = Question.objects.create(material=self.material, question_text='問2', question_type='descriptive', order=2)
+        with self.captureOnCommitCallbacks(execute=True):
+            for revision in (1, 2):
+                self.client.post('/api/answers/autosave/', {
+                    'student': self.students[0].pk, 'drafts': [{'question': question.pk, 'answer_text': '下書き', 'revision': revision}],
+                }, content_type='application/json')
+        answer = StudentAnswer.objects.get(student=self.students[0], question=question)
+        reply = Comment.objects.create(author=self.students[0], target_answer=answer, content='質問です')
+        row = self.dashboard()
+        self.assertEqual((row['answered'], row['comments'], row['unread_comments']), (5, 5, 1))
+        self.assertEqual(row['completion'], round(5 / 6 * 100, 1))
+
+        self.assertEqual(self.client.post(
+            '/api/progress/seen/', {'material': self.material.pk}, content_type='application/json',
+        ).json()['updated'], 2)
+        reply.delete()
+        answer.delete()
+        row = self.dashboard()
+        self.assertEqual((row['answered'], row['comments'], row['unread_comments']), (4, 4, 0))
+
+    def test_dashboard_reads_only_the_summary(self):
+        def grow():
+            question = Question.objects.create(material=self.material, question_text='追加', question_type='descriptive')
+            for student in self.students:
+                StudentAnswer.objects.create(student=student, question=question, answer_text='回答')
+        self.assertQueryBudget(self.url, 3, grow=grow)
+        self.assertEqual(self.dashboard()['completion'], 100.0)
+        self.group.students.remove(self.students[1])
+        self.assertEqual(self.dashboard()['answered'], 3)
+
+    def test_reconcile_repairs_drift(self):
+        question = Question.objects.create(material=self.material, question_text='一括', question_type='descriptive')
+        # bulk_create はシグナルを発火しないので集計から漏れる
+        StudentAnswer.objects.bulk_create([StudentAnswer(student=self.students[0], question=question, answer_text='回答')])
+        ProgressSummary.objects.filter(student=self.students[1]).update(comment_count=9, unread_comment_count=3)
+        Comment.objects.bulk_create([Comment(
+            author=self.students[1], target_answer=StudentAnswer.objects.filter(student=self.students[1]).first(), content='質問',
+        )])
+        self.assertEqual(reconcile_progress(), (0, 2, 0))
+        rows = {
+            (row.group_id, row.material_id, row.student_id): (row.answered_count, row.comment_count, row.unread_comment_count)
+            for row in ProgressSummary.objects.all()
+        }
+        self.assertEqual(rows, expected_progress())
+        self.assertEqual(rows[(self.group.pk, self.material.pk, self.students[1].pk)], (2, 3, 1))
+        self.assertEqual(reconcile_progress([self.group.pk]), (0, 0, 0))
+
+    def test_reconcile_keeps_seen_rows(self):
+        mark_seen(self.material.pk, self.students[0].pk)
+        seen_at = ProgressSummary.objects.get(student=self.students[0]).seen_at
+        with self.captureOnCommitCallbacks(execute=True):
+            StudentAnswer.objects.filter(student=self.students[0]).delete()
+        reconcile_progress()
+        row = ProgressSummary.objects.get(student=self.students[0])
+        self.assertEqual((row.answered_count, row.comment_count, row.seen_at), (0, 0, seen_at))
+        # 他の学生の行（seen_at なし）は 0 になれば消える
+        with self.captureOnCommitCallbacks(execute=True):
+            StudentAnswer.objects.filter(student=self.students[1]).delete()
+        reconcile_progress()
+        self.assertFalse(ProgressSummary.objects.filter(student=self.students[1]).exists())
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        make_class('a', n_students=2, n_materials=2, n_questions=2)
+        self.material = ReadingMaterial.objects.order_by('pk').first()
+
+    def test_csv_answers_for_material(self):
+        response = self.client.get(f'/api/export/answers/?material_id={self.material.pk}')
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode('utf-8-sig').splitlines()
+        self.assertEqual(lines[0].split(',')[:3], ['id', 'student_id', 'student__username'])
+        self.assertEqual(len(lines), 1 + 4)
+
+    def test_csv_escapes_formulas_and_applies_patches_without_writing(self):
+        answer = StudentAnswer.objects.filter(question__material=self.material).order_by('pk').first()
+        answer.answer_text = '=HYPERLINK("http://example.com")'
+        answer.save()
+        AnswerPatch.objects.create(answer=answer, base_revision=0, revision=1, ops={'reasoning_note': [{'at': 0, 'insert': '@根拠'}]})
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(f'/api/export/answers/?material_id={self.material.pk}')
+            rows = list(csv.reader(b''.join(response.streaming_content).decode('utf-8-sig').splitlines()))
+        self.assertFalse([q['sql'] for q in ctx.captured_queries if not q['sql'].startswith('SELECT')])
+        row = dict(zip(rows[0], rows[1]))
+        self.assertEqual((row['answer_text'], row['reasoning_note']), ('\'=HYPERLINK("http://example.com")', "'@根拠"))
+        self.assertTrue(AnswerPatch.objects.filter(answer=answer).exists())
+
+    def test_jsonl_comments(self):
+        response = self.client.get('/api/export/comments/?output=jsonl')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(len(rows), Comment.objects.count())
+        self.assertEqual(rows[0]['author__username'], 'a_teacher')
+
+    def test_unknown_kind(self):
+        self.assertEqual(self.client.get('/api/export/users/').status_code, 400)
+
+    def test_command_writes_file(self):
+        path = os.path.join(tempfile.mkdtemp(), 'annotations.jsonl')
+        call_command('export_results', 'annotations', output='jsonl', file=path, stderr=open(os.devnull, 'w'))
+        with open(path, encoding='utf-8') as f:
+            self.assertEqual(sum(1 for _ in f), Annotation.objects.count())
+
+
+class ImportTests(TestCase):
+    def setUp(self):
+        self.teacher, self.group, _ = make_class('i', n_students=1, n_materials=0)
+
+    def bundle(self, title='第1章'):
+        return {
+            'group': self.group.pk,
+            'materials': [{
+                'key': 'ch1', 'title': title, 'content': '本文',
+                'questions': [
+                    {'key': 'q1', 'question_text': '問1', 'question_type': 'descriptive', 'order': 1},
+                    {'key': 'q2', 'question_text': '問2', 'question_type': 'multiple_choice',
+                     'choices': ['ア', 'イ'], 'correct_answer': 'ア', 'order': 2},
+                ],
+            }],
+        }
+
+    def test_reimport_is_idempotent(self):
+        url = '/api/materials/import/'
+        response = self.client.post(url, self.bundle(), content_type='application/json')
+        self.assertEqual(response.json(), {
+            'materials_created': 1, 'materials_updated': 0, 'questions_created': 2, 'questions_updated': 0,
+        })
+        self.client.post(url, self.bundle(), content_type='application/json')
+        response = self.client.post(url, self.bundle('第1章（改訂）'), content_type='application/json')
+        self.assertEqual(response.json()['materials_updated'], 1)
+        self.assertEqual(ReadingMaterial.objects.filter(group=self.group).count(), 1)
+        self.assertEqual(Question.objects.filter(material__group=self.group).count(), 2)
+        self.assertEqual(ReadingMaterial.objects.get(external_key='ch1').created_by, self.teacher)
+
+    def test_invalid_bundle_writes_nothing(self):
+        bundle = self.bundle()
+        bundle['materials'][0]['questions'][1]['choices'] = None
+        response = self.client.post('/api/materials/import/', bundle, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('details', response.json())
+        self.assertFalse(ReadingMaterial.objects.filter(group=self.group).exists())
+
+    def test_malformed_files_are_bad_requests(self):
+        for fmt, body in (
+            ('yaml', 'materials: [1, 2'),
+            ('yaml', '- a\n- b'),
+            ('csv', 'title,content\n第1章,本文\n'),
+            ('csv', 'material_key,question_key,order\nch1,q1,一\n'),
+        ):
+            response = self.client.post(
+                f'/api/materials/import/?type={fmt}&group={self.group.pk}', body, content_type='text/plain',
+            )
+            self.assertEqual(response.status_code, 400, (fmt, body, response.content))
+        self.assertFalse(ReadingMaterial.objects.filter(group=self.group).exists())
+
+    def test_csv_command(self):
+        path = os.path.join(tempfile.mkdtemp(), 'materials.csv')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('material_key,title,content,question_key,question_text,question_type,choices,order\n'
+                    'ch1,第1章,本文,q1,問1,multiple_choice,ア|イ,1\n'
+                    'ch1,第1章,本文,q2,問2,descriptive,,2\n')
+        call_command('import_materials', path, group=self.group.pk, stdout=open(os.devnull, 'w'))
+        self.assertEqual(
+            list(Question.objects.filter(material__external_key='ch1').values_list('choices', flat=True)),
+            [['ア', 'イ'], None],
+        )
+
+
+@override_settings(ACTIVITY_LOG_MODE='immediate', ANSWER_REFRESH_MODE='immediate')
+class SearchTests(TestCase):
+    def setUp(self):
+        self.teacher, self.group, self.students = make_class('s', n_students=2, n_materials=1, n_questions=2)
+        self.material = ReadingMaterial.objects.get(group=self.group)
+        self.material.content = '筆者は読解力の低下を懸念している。'
+        self.material.save()
+        self.answer = StudentAnswer.objects.filter(student=self.students[0]).first()
+        self.answer.answer_text = '読解力とは文章を理解する力だと思う'
+        self.answer.save()
+
+    def search(self, **params):
+        return self.client.get('/api/search/', params).json()
+
+    def test_tokenize_uses_bigrams(self):
+        self.assertEqual(tokenize('読解力 ＡＢＣ'), '読解 解力 力 abc')
+        self.assertEqual(parse_query('読解力'), [(['読解', '解力'], False)])
+
+    def test_phrase_and_ranking(self):
+        data = self.search(q='読解力')
+        self.assertEqual({(r['kind'], r['object_id']) for r in data['results']},
+                         {('material', self.material.pk), ('answer', self.answer.pk)})
+        self.assertIn('読解力', data['results'][0]['snippet'])
+        # 「力」と「読解」が離れている本文には一致しない
+        self.assertEqual(self.search(q='解読')['count'], 0)
+        self.assertEqual(self.search(q='力', kind='answer')['count'], 1)
+
+    def test_index_follows_changes(self):
+        comment = Comment.objects.create(author=self.teacher, target_answer=self.answer, content='根拠を示しましょう')
+        self.assertEqual(self.search(q='根拠', group_id=self.group.pk)['results'][0]['object_id'], comment.pk)
+        comment.delete()
+        self.assertEqual(self.search(q='根拠')['count'], 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/answers/autosave/', {
+                'student': self.students[1].pk,
+                'drafts': [{'question': self.answer.question_id, 'answer_text': '要約が難しい', 'revision': 1}],
+            }, content_type='application/json')
+        self.assertEqual(self.search(q='要約')['results'][0]['user'], self.students[1].pk)
+
+    def test_query_is_required(self):
+        self.assertEqual(self.client.get('/api/search/').status_code, 400)
+
+
+class SegmentTests(TestCase):
+    CONTENT = '春が来た。「花が咲いた！」と彼は言った。\n\n夏は暑い。'
+
+    def setUp(self):
+        self.teacher, self.group, self.students = make_class('g', n_students=1, n_materials=1, n_questions=1)
+        self.material = ReadingMaterial.objects.get(group=self.group)
+        self.material.content = self.CONTENT
+        self.material.save()
+        self.url = f'/api/materials/{self.material.pk}/'
+
+    def test_split_into_sentences_and_paragraphs(self):
+        segments = split_segments(self.CONTENT)
+        self.assertEqual([text for _, _, _, text in segments], ['春が来た。', '「花が咲いた！」', 'と彼は言った。', '夏は暑い。'])
+        self.assertEqual([paragraph for paragraph, _, _, _ in segments], [0, 0, 0, 1])
+        self.assertEqual(TextSegment.objects.filter(material=self.material).count(), 4)
+
+    def test_chunks_by_segment_range(self):
+        data = self.client.get(self.url + 'segments/', {'from': 1, 'limit': 2}).json()
+        self.assertEqual((data['total'], data['next']), (4, 3))
+        self.assertEqual([s['text'] for s in data['segments']], ['「花が咲いた！」', 'と彼は言った。'])
+
+    def test_locate_offsets(self):
+        data = self.client.get(self.url + 'locate/', {'offsets': '0,7,24'}).json()
+        self.assertEqual([o['position'] for o in data['offsets']], [0, 1, 3])
+        self.assertEqual(data['offsets'][1]['offset_in_segment'], 2)
+
+    def test_locate_rejects_offsets_outside_the_text(self):
+        for offsets in ('-1', f'0,{len(self.CONTENT) + 1}'):
+            self.assertEqual(self.client.get(self.url + 'locate/', {'offsets': offsets}).status_code, 400)
+        self.assertEqual(self.client.get(self.url + 'locate/', {'offsets': str(len(self.CONTENT))}).status_code, 200)
+
+    def test_get_does_not_create_missing_segments(self):
+        TextSegment.objects.filter(material=self.material).delete()
+        invalidate_segment_index(self.material.pk)
+        self.assertEqual(self.client.get(self.url + 'segments/').status_code, 409)
+        self.assertEqual(self.client.get(self.url + 'locate/', {'offsets': '0'}).status_code, 409)
+        self.assertFalse(TextSegment.objects.filter(material=self.material).exists())
+        call_command('segment_materials', stdout=open(os.devnull, 'w'))
+        self.assertEqual(self.client.get(self.url + 'segments/').json()['total'], 4)
+
+    def test_edit_remaps_annotations_and_keeps_segment_ids(self):
+        keys = list(TextSegment.objects.filter(material=self.material).values_list('key', flat=True))
+        start = self.CONTENT.index('夏')
+        annotation = Annotation.objects.create(
+            student=self.students[0], material=self.material, annotation_type='highlight',
+            start_position=start, end_position=start + 2,
+        )
+        material = ReadingMaterial.objects.get(pk=self.material.pk)
+        material.content = 'とうとう' + self.CONTENT
+        material.save()
+        annotation.refresh_from_db()
+        self.assertEqual(material.content[annotation.start_position:annotation.end_position], '夏は')
+        new_keys = list(TextSegment.objects.filter(material=material).values_list('key', flat=True))
+        self.assertEqual(new_keys[1:], keys[1:])
+
+    def test_large_edit_is_remapped_by_lines(self):
+        lines = [f'{i}行目の文です。\n' for i in range(2000)]
+        old = ''.join(lines)
+        new = ''.join(lines[:1000] + ['挿入した行です。\n'] + lines[1000:1500] + lines[1600:])
+        remap = offset_mapper(old, new)
+        at = old.index('1200行目')
+        self.assertEqual(new[remap(at):remap(at) + 6], '1200行目')
+        # 削除された行の中の位置は、削除された範囲の端（前後の行の境目付近）へ寄せる
+        self.assertTrue(new.index('1499行目') <= remap(old.index('1550行目')) <= new.index('1600行目'))
+        with mock.patch('reading.segments.REMAP_LINE_PAIRS_LIMIT', 0):
+            remap = offset_mapper(old, new)
+            self.assertEqual(remap(old.index('1999行目')), new.index('1999行目'))
+
+
+@override_settings(ACTIVITY_LOG_MODE='immediate')
+class CitationTests(TestCase):
+    def setUp(self):
+        self.teacher, self.group, self.students = make_class('c', n_students=3, n_materials=1, n_questions=1)
+        self.material = ReadingMaterial.objects.get(group=self.group)
+        self.material.content = '一文目です。二文目です。三文目です。'
+        self.material.save()
+        self.question = Question.objects.get(material=self.material)
+        self.url = f'/api/materials/{self.material.pk}/cited_passages/'
+
+    def cite(self, student, *spans):
+        answer = StudentAnswer.objects.get(student=student, question=self.question)
+        answer.citations = [{'start': start, 'end': end} for start, end in spans]
+        answer.save()
+        return answer
+
+    def test_side_table_follows_answer(self):
+        answer = self.cite(self.students[0], (0, 3), (6, 9), (6, 9), (5, 2))
+        self.assertEqual(list(answer.citation_spans.order_by('start').values_list('start', 'end')), [(0, 3), (6, 9)])
+        answer.citations = None
+        answer.save()
+        self.assertFalse(answer.citation_spans.exists())
+
+    def test_most_cited_passages(self):
+        self.cite(self.students[0], (6, 9))
+        self.cite(self.students[1], (7, 8), (0, 2))
+        self.cite(self.students[2], (8, 14))
+        # 集計するまでは空の結果を stale として返す（GET では集計しない）
+        with CaptureQueriesContext(connection) as ctx:
+            data = self.client.get(self.url).json()
+        self.assertEqual((data['passages'], data['stale']), ([], True))
+        self.assertTrue(all(query['sql'].startswith('SELECT') for query in ctx.captured_queries))
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('refresh_cited_passages', stdout=open(os.devnull, 'w'))
+        data = self.client.get(self.url).json()
+        self.assertEqual([(p['text'], p['citation_count'], p['student_count']) for p in data['passages']],
+                         [('二文目です。', 3, 3), ('一文目です。', 1, 1), ('三文目です。', 1, 1)])
+        self.assertFalse(data['stale'])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.cite(self.students[0], (0, 1))
+        self.assertTrue(self.client.get(self.url).json()['stale'])
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('refresh_cited_passages', stdout=open(os.devnull, 'w'))
+        data = self.client.get(self.url).json()
+        self.assertFalse(data['stale'])
+        self.assertEqual(data['passages'][0]['citation_count'], 2)
+
+
+@override_settings(PROFILING_ENABLED=True, PROFILING_SAMPLE_RATE=1.0, PROFILING_SLOW_REQUEST_MS=100000)
+class ProfilingTests(TestCase):
+    def setUp(self):
+        make_class('p', n_students=1, n_materials=1, n_questions=1)
+        metrics.reset()
+
+    def test_records_per_route_metrics(self):
+        material = ReadingMaterial.objects.first()
+        self.client.get(f'/api/materials/{material.pk}/questions/')
+        text = self.client.get('/api/metrics/').content.decode()
+        labels = '{route="readingmaterial-questions",method="GET"}'
+        self.assertIn(f'reading_request_seconds_count{labels} 1', text)
+        self.assertIn(f'reading_db_queries_count{labels} 1', text)
+        self.assertIn(f'reading_serialize_seconds_count{labels} 1', text)
+        self.assertIn('reading_requests_total{route="readingmaterial-questions",method="GET",status="200"} 1', text)
+
+    @override_settings(PROFILING_SLOW_REQUEST_MS=0)
+    def test_slow_request_logs_sql(self):
+        with self.assertLogs('reading.profiling', 'WARNING') as logs:
+            self.client.get('/api/materials/')
+        self.assertIn('SELECT', logs.output[0])
+
+    @override_settings(PROFILING_METRICS_TOKEN='secret')
+    def test_metrics_token(self):
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 401)
+        response = self.client.get('/api/metrics/', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(ROOT_URLCONF='reading_app_backend.urls_asgi')
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        _, _, students = make_class('as', n_students=1, n_materials=1, n_questions=2)
+        self.student = students[0]
+        self.material = ReadingMaterial.objects.get()
+
+    def get(self, url, **headers):
+        return self.request('get', url, headers=headers)
+
+    def request(self, method, url, **kwargs):
+        async def send():
+            return await getattr(self.async_client, method)(url, **kwargs)
+        return async_to_sync(send)()
+
+    def test_cached_responses_match_sync_views(self):
+        for url in [f'/api/materials/{self.material.pk}/', f'/api/materials/{self.material.pk}/questions/']:
+            # 1回目は非同期 ORM で読んでキャッシュを作り、2回目はキャッシュから DB に触れずに返す
+            first = self.get(url)
+            with CaptureQueriesContext(connection) as ctx:
+                second = self.get(url)
+            self.assertEqual(len(ctx.captured_queries), 0)
+            self.assertEqual(second.content, first.content)
+            self.assertEqual(second['ETag'], first['ETag'])
+            self.assertEqual(self.get(url, **{'If-None-Match': first['ETag']}).status_code, 304)
+
+    def test_cache_miss_is_built_with_async_orm(self):
+        for url in [f'/api/materials/{self.material.pk}/', f'/api/materials/{self.material.pk}/questions/']:
+            with mock.patch('reading.views._render_sync_view') as fallback:
+                first = self.get(url)
+            self.assertFalse(fallback.called)
+            # 同期のビュー（DRF）が作るものと本文・ETag が一致する
+            cache.clear()
+            with override_settings(ROOT_URLCONF='reading_app_backend.urls'):
+                expected = self.client.get(url)
+            self.assertEqual(first.content, expected.content)
+            self.assertEqual(first['ETag'], expected['ETag'])
+        with mock.patch('reading.views._render_sync_view', wraps=views._render_sync_view) as fallback:
+            self.assertEqual(self.get('/api/materials/0/').status_code, 404)
+        self.assertTrue(fallback.called)
+
+    def test_notifications_and_autosave(self):
+        sync_urls = [f'/api/notifications/{name}/?user_id={self.student.pk}' for name in ('unread', 'count')]
+        for url in sync_urls:
+            self.assertEqual(self.get(url).json(), self.client.get(url).json())
+        self.assertEqual(self.get(sync_urls[1]).json(), {'unread': 2})
+
+        question = Question.objects.first()
+        data = {'student': self.student.pk, 'drafts': [{'question': question.pk, 'answer_text': '非同期', 'revision': 5}]}
+        response = self.request('post', '/api/answers/autosave/', data=data, content_type='application/json')
+        self.assertEqual(response.json()['saved'][0]['revision'], 5)
+        self.assertEqual(StudentAnswer.objects.get(student=self.student, question=question).answer_text, '非同期')
+        response = self.request(
+            'post', '/api/answers/autosave/', data={'student': self.student.pk, 'drafts': []}, content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_invalid_token_is_rejected(self):
+        response = self.get(f'/api/materials/{self.material.pk}/', Authorization='Token invalid')
+        self.assertEqual(response.status_code, 401)
+
+    def test_middleware_chain_stays_async(self):
+        async def get_response(request):
+            pass
+        self.assertTrue(iscoroutinefunction(StaticFilesMiddleware(get_response)))
+        self.assertFalse(iscoroutinefunction(StaticFilesMiddleware(lambda request: None)))
+
+
+class FakeConnection:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTests(TestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def test_reuses_connections_and_counts_checkouts(self):
+        pool = ConnectionPool('pooltest', max_size=2)
+        first = pool.getconn(FakeConnection)
+        pool.putconn(first)
+        self.assertIs(pool.getconn(FakeConnection), first)
+        self.assertEqual(pool.stats(), {'idle': 0, 'in_use': 1, 'size': 1})
+        text = metrics.render()
+        self.assertIn('reading_db_pool_checkouts_total{alias="pooltest"} 2', text)
+        self.assertIn('reading_db_pool_connects_total{alias="pooltest"} 1', text)
+
+    def test_waits_then_times_out(self):
+        pool = ConnectionPool('pooltest', max_size=1, timeout=0.5)
+        held = pool.getconn(FakeConnection)
+        threading.Timer(0.05, pool.putconn, [held]).start()
+        self.assertIs(pool.getconn(FakeConnection), held)
+
+        pool.timeout = 0.01
+        with self.assertRaises(PoolTimeout):
+            pool.getconn(FakeConnection)
+        text = metrics.render()
+        self.assertIn('reading_db_pool_waits_total{alias="pooltest"} 2', text)
+        self.assertIn('reading_db_pool_timeouts_total{alias="pooltest"} 1', text)
+
+    def test_discards_unhealthy_and_unresettable_connections(self):
+        healthy = {'ok': False}
+        pool = ConnectionPool('pooltest', check_after=0, check=lambda conn: healthy['ok'], reset=lambda conn: not conn.dirty)
+        first = pool.getconn(FakeConnection)
+        first.dirty = False
+        pool.putconn(first)
+        second = pool.getconn(FakeConnection)
+        self.assertIsNot(second, first)
+        self.assertTrue(first.closed)
+
+        second.dirty = True
+        pool.putconn(second)
+        self.assertTrue(second.closed)
+        self.assertEqual(pool.stats(), {'idle': 0, 'in_use': 0, 'size': 0})
+
+    def test_backend_does_not_pass_pool_options_to_the_driver(self):
+        settings_dict = {
+            **connection.settings_dict, 'ENGINE': 'reading.pooled_postgresql', 'NAME': 'reading',
+            'USER': '', 'PASSWORD': '', 'HOST': '', 'PORT': '', 'OPTIONS': {'pool': {'max_size': 2}},
+        }
+        params = PooledDatabaseWrapper(settings_dict, alias='pooltest').get_connection_params()
+        self.assertNotIn('pool', params)
+        self.assertEqual(params['dbname'], 'reading')
+
+
+@override_settings(ACTIVITY_LOG_MODE='immediate', ANSWER_REFRESH_MODE='immediate')
+class ActivityLogTests(TestCase):
+    def setUp(self):
+        _, _, students = make_class('ac', n_students=1, n_materials=1, n_questions=2)
+        self.student = students[0]
+        self.material = ReadingMaterial.objects.get()
+        self.questions = list(Question.objects.order_by('order'))
+
+    def test_buffer_writes_a_batch_in_one_insert(self):
+        buffer = ActivityBuffer()
+        now = timezone.now()
+        for i in range(20):
+            question = self.questions[i % 2]
+            buffer.put((now - timedelta(seconds=i), self.student.pk, None, question.pk, 'answer_edit', None, None, {'n': i}))
+        with CaptureQueriesContext(connection) as ctx:
+            buffer.flush()
+        # 問題から教材を引く SELECT と INSERT の2件
+        self.assertEqual(len(ctx.captured_queries), 2)
+        chunk = ActivityChunk.objects.get()
+        self.assertEqual(chunk.event_count, 20)
+        self.assertEqual(chunk.ended_at - chunk.started_at, timedelta(seconds=19))
+
+    def test_session_is_reconstructed_in_time_order(self):
+        question = self.questions[0]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/activity/', {
+                'student': self.student.pk, 'material': self.material.pk,
+                'events': [{'type': 'navigate', 'question': question.pk, 'at': (timezone.now() - timedelta(minutes=1)).isoformat()}],
+            }, content_type='application/json')
+            self.client.post('/api/answers/autosave/', {
+                'student': self.student.pk, 'drafts': [{'question': question.pk, 'answer_text': '筆者は', 'revision': 1}],
+            }, content_type='application/json')
+            Annotation.objects.create(
+                student=self.student, material=self.material, annotation_type='sticky_note',
+                start_position=3, end_position=8, content='根拠',
+            )
+        self.assertEqual(
+            self.client.post('/api/activity/', {'student': self.student.pk, 'material': self.material.pk, 'events': [
+                {'type': 'answer_edit'},
+            ]}, content_type='application/json').status_code, 400,
+        )
+
+        data = self.client.get(f'/api/activity/?student_id={self.student.pk}&material_id={self.material.pk}').json()
+        self.assertEqual([event['type'] for event in data['events']], ['navigate', 'answer_edit', 'sticky_note'])
+        self.assertEqual(data['events'][1]['data']['answer_text'], '筆者は')
+        self.assertEqual(data['events'][2]['start'], 3)
+        self.assertEqual(len(data['sessions']), 1)
+        self.assertEqual(data['counts'], {'navigate': 1, 'answer_edit': 1, 'sticky_note': 1})
+
+        since = (timezone.now() - timedelta(seconds=30)).isoformat()
+        data = self.client.get('/api/activity/', {'student_id': self.student.pk, 'since': since, 'limit': 1}).json()
+        self.assertEqual([event['type'] for event in data['events']], ['answer_edit'])
+        self.assertTrue(data['truncated'])
+
+    def test_compact_merges_old_chunks(self):
+        buffer = ActivityBuffer()
+        old = timezone.now() - timedelta(days=2)
+        for i in range(3):
+            buffer.put((old + timedelta(minutes=i), self.student.pk, self.material.pk, None, 'navigate', i, None, None))
+            buffer.flush()
+        self.assertEqual(ActivityChunk.objects.count(), 3)
+        self.assertEqual(compact_chunks(timezone.now() - timedelta(days=1)), (1, 3))
+        chunk = ActivityChunk.objects.get()
+        self.assertEqual((chunk.event_count, chunk.started_at), (3, old))
+
+
+class BenchmarkTests(TestCase):
+    def test_runs_scenarios_against_seeded_data(self):
+        data = benchmark.seed('tiny')
+        self.assertEqual(StudentAnswer.objects.count(), 5 * 4)
+        results = benchmark.run(
+            benchmark.InProcessDriver(), benchmark.scenarios(data), requests=3, warmup=1,
+            only=['materials-questions', 'answers-autosave'],
+        )
+        self.assertEqual(set(results), {'materials-questions', 'answers-autosave'})
+        self.assertEqual(results['materials-questions']['requests'], 3)
+
+    def test_seed_can_be_rerun_and_loaded(self):
+        self.assertIsNone(benchmark.load('tiny'))
+        benchmark.seed('tiny')
+        data = benchmark.seed('tiny')
+        self.assertEqual(StudentAnswer.objects.count(), 5 * 4)
+        loaded = benchmark.load('tiny')
+        requests = lambda d: [(name, method, url, body and body(0)) for name, method, url, body in benchmark.scenarios(d)]
+        self.assertEqual(requests(loaded), requests(data))
+        self.assertIsNone(benchmark.load('tiny', random_seed=1))
+
+    def test_runs_wsgi_and_asgi_side_by_side(self):
+        data = benchmark.seed('tiny')
+        runs = benchmark.run_modes(
+            benchmark.scenarios(data), ['wsgi', 'asgi'], requests=2, warmup=1,
+            only=['materials-retrieve', 'notifications-count'],
+        )
+        self.assertEqual(set(runs), {'wsgi', 'asgi'})
+        self.assertEqual(runs['asgi']['materials-retrieve']['queries'], 0)
+        self.assertIn('asgi p95', benchmark.format_side_by_side(runs))
+
+    def test_compare_flags_regressions(self):
+        baseline = {'a': {'p95_ms': 10.0, 'queries': 2}, 'b': {'p95_ms': 10.0, 'queries': 2}}
+        results = {'a': {'p95_ms': 11.0, 'queries': 2}, 'b': {'p95_ms': 13.0, 'queries': 3}}
+        regressions = benchmark.compare(results, baseline, threshold=20)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(all(line.startswith('b:') for line in regressions))
+
+
+class QueryPlanCheckTests(TestCase):
+    def test_flags_sequential_scan(self):
+        plan = explain("SELECT id FROM reading_comment WHERE content = 'x'")
+        self.assertEqual(sequential_scans(plan), ['reading_comment'])
+
+    def test_hot_filters_use_indexes(self):
+        for sql in [
+            'SELECT id FROM reading_notification WHERE recipient_id = 1 AND NOT is_read ORDER BY created_at DESC',
+            'SELECT id FROM reading_question WHERE material_id = 1 ORDER BY "order"',
+            'SELECT id FROM reading_comment WHERE target_answer_id = 1 ORDER BY created_at DESC',
+            'SELECT MAX(updated_at) FROM reading_studentanswer WHERE question_id = 1',
+            'SELECT id FROM reading_annotation WHERE material_id = 1 AND student_id = 1',
+        ]:
+            self.assertEqual(sequential_scans(explain(sql)), [], sql)
+
+    def test_endpoints_have_no_sequential_scans(self):
+        data = benchmark.seed('tiny')
+        self.assertEqual(check_endpoints(endpoint_urls(data)), [])
+
+
+class TokenAuthCacheTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        _, _, students = make_class('t', n_students=1, n_materials=1, n_questions=2)
+        self.student = students[0]
+        self.token = Token.objects.create(user=self.student)
+        self.auth = {'HTTP_AUTHORIZATION': f'Token {self.token.key}'}
+        self.question = Question.objects.first()
+        answers_changed([self.question.pk])
+
+    def test_autosave_costs_no_auth_queries_when_warm(self):
+        data = {'student': self.student.pk, 'drafts': [{'question': self.question.pk, 'answer_text': 'a', 'revision': 1}]}
+        self.client.post('/api/answers/autosave/', data, content_type='application/json', **self.auth)
+        data['drafts'][0]['revision'] = 2
+        self.assertQueryBudget(
+            '/api/answers/autosave/', 1, method='post', data=data, content_type='application/json', **self.auth,
+        )
+
+    def test_logout_and_user_change_invalidate(self):
+        self.assertEqual(self.client.post('/api/auth/logout/', **self.auth).status_code, 200)
+        self.assertEqual(self.client.get('/api/materials/', **self.auth).status_code, 401)
+
+        token = Token.objects.create(user=self.student)
+        auth = {'HTTP_AUTHORIZATION': f'Token {token.key}'}
+        self.assertEqual(self.client.get('/api/materials/', **auth).status_code, 200)
+        self.student.is_active = False
+        self.student.save()
+        self.assertEqual(self.client.get('/api/materials/', **auth).status_code, 401)
+
+    def test_process_local_cache_is_rechecked_after_local_ttl(self):
+        # プロセス内キャッシュは他のワーカーの失効を受け取れないので、共有キャッシュの TTL を使わない
+        with override_settings(AUTH_TOKEN_LOCAL_TTL=5, AUTH_TOKEN_CACHE_TTL=300):
+            self.assertEqual(_shared_ttl(), 5)
+            with override_settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+            }}):
+                self.assertEqual(_shared_ttl(), 300)
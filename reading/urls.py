@@ -15,7 +15,14 @@ def api_root(request):
             "answers": "/api/answers/",
             "annotations": "/api/annotations/",
             "comments": "/api/comments/",
+            "export": "/api/export/<answers|annotations|comments>/",
             "notifications": "/api/notifications/",
+            "notifications_stream": "/api/notifications/stream/",
+            "search": "/api/search/?q=",
+            "texts": "/api/texts/<hash>/",
+            "activity": "/api/activity/?student_id=",
+            "progress": "/api/progress/?teacher_id=",
+            "metrics": "/api/metrics/",
             "auth_login": "/api/auth/login/",
             "auth_register": "/api/auth/register/",
             "auth_logout": "/api/auth/logout/",
@@ -30,11 +37,34 @@ router.register(r'answers', views.StudentAnswerViewSet)
 router.register(r'annotations', views.AnnotationViewSet)
 router.register(r'comments', views.CommentViewSet)
 router.register(r'notifications', views.NotificationViewSet)
+router.register(r'search', views.SearchViewSet)
+router.register(r'activity', views.ActivityViewSet)
+router.register(r'progress', views.ProgressViewSet)
 
 urlpatterns = [
     path('', api_root, name='api_root'),  # ← ルートURL追加
+    path('api/notifications/stream/', views.notification_stream, name='notification_stream'),
+    path('api/export/<str:kind>/', views.export_results, name='export_results'),
+    path('api/metrics/', views.metrics_endpoint, name='metrics'),
+    path('api/texts/<str:digest>/', views.material_text, name='material_text'),
     path('api/', include(router.urls)),
     path('api/auth/login/', views.CustomAuthToken.as_view(), name='api_token_auth'),
     path('api/auth/register/', views.register_user, name='api_register'),
     path('api/auth/logout/', views.logout_user, name='api_logout'),
 ]
+
+# SERVER_MODE=asgi のとき urlpatterns より先に照合する（reading_app_backend/urls_asgi.py）
+# 名前は DRF のルートと同じにして、計測のラベルや reverse() を変えない
+_drf_views = {pattern.name: pattern.callback for pattern in router.urls}
+async_urlpatterns = [
+    path('api/materials/<int:pk>/', views.with_sync_fallback(
+        views.material_retrieve_async, _drf_views['readingmaterial-detail']), name='readingmaterial-detail'),
+    path('api/materials/<int:pk>/questions/', views.with_sync_fallback(
+        views.material_questions_async, _drf_views['readingmaterial-questions']), name='readingmaterial-questions'),
+    path('api/answers/autosave/', views.with_sync_fallback(
+        views.autosave_async, _drf_views['studentanswer-autosave']), name='studentanswer-autosave'),
+    path('api/notifications/unread/', views.with_sync_fallback(
+        views.notifications_unread_async, _drf_views['notification-unread']), name='notification-unread'),
+    path('api/notifications/count/', views.with_sync_fallback(
+        views.notifications_count_async, _drf_views['notification-count']), name='notification-count'),
+]
@@ -1,81 +1,419 @@
-from rest_framework import viewsets, status
+import asyncio
+import json
+import sys
+from datetime import timedelta
+
+from rest_framework import mixins, viewsets, status
+from rest_framework.exceptions import AuthenticationFailed, ValidationError
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
-from django.contrib.auth.models import User
-from .models import Group, ReadingMaterial, Question, StudentAnswer, Annotation, Comment, Notification
+from rest_framework.renderers import JSONRenderer
+from django.core import signing
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.db import IntegrityError
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.http import quote_etag
+from .models import ActivityChunk, Group, MaterialText, ReadingMaterial, Question, StudentAnswer, Annotation, Comment, Notification, ProgressSummary, SearchDocument, TextSegment
 from .serializers import (
     GroupSerializer, ReadingMaterialSerializer, QuestionSerializer,
     StudentAnswerSerializer, AnnotationSerializer, CommentSerializer,
-    NotificationSerializer, UserSerializer
+    NotificationSerializer, UserSerializer, AnswerSubmitSerializer, AutosaveSerializer,
+    AnswerPatchSerializer, AnnotationSyncSerializer, SearchResultSerializer, TextSegmentSerializer,
+    ActivityBatchSerializer,
 )
+from .activity import record, record_answer_edits, session_events, split_sessions
+from .asyncdb import db_slot, run_sync
+from .authentication import CachedTokenAuthentication, invalidate_token
+from .autosave import PATCHED_FIELDS, PatchConflict, append_patch, head_revisions, next_revision, upsert_drafts
+from .citations import most_cited_passages
+from .export import EXPORTS, FORMATS, iter_export
+from .gradebook import group_gradebook, material_gradebook
+from .httpcache import cached_response_async, conditional_response, etag_matches
+from .importer import BundleError, import_bundle, parse_bundle, validate_bundle
+from .intervals import coverage, get_annotation_index
+from . import metrics
+from .notifications import publish_read_state, reset_unread, unread_count, unread_count_async
+from .pagination import SearchPagination
+from .progress import mark_seen, teacher_dashboard
+from .pubsub import get_pubsub, user_channel
+from .queryplan import QueryPlanMixin, get_query_plan
+from .search import search
+from .segments import get_segment_index
+from .sync import make_sync_token, next_sync_moment, read_sync_token, sync_annotations
+
+SEGMENT_PAGE_SIZE = 50
+SEGMENT_MAX_PAGE_SIZE = 500
+# 教材本文（/api/texts/<hash>/）のキャッシュ期間
+TEXT_MAX_AGE = 60 * 60 * 24 * 365
 
-class ReadingMaterialViewSet(viewsets.ModelViewSet):
+class ReadingMaterialViewSet(QueryPlanMixin, viewsets.ModelViewSet):
     queryset = ReadingMaterial.objects.all()
     serializer_class = ReadingMaterialSerializer
     permission_classes = [AllowAny]  # 開発用：本番では認証が必要
+    cursor_ordering = None  # 一覧は既定（作成日時の新しい順）。注釈の範囲検索は @action で上書きする
+
+    def plan_queryset(self, queryset, serializer_class=None):
+        """本文（MaterialText.content）は content を返すときだけ読み込む（一覧や ?omit=content ではハッシュと文字数のみ）"""
+        queryset = super().plan_queryset(queryset, serializer_class)
+        if queryset.model is not ReadingMaterial or (serializer_class or self.get_serializer_class()) is not ReadingMaterialSerializer:
+            return queryset
+        fields = self.get_serializer().fields
+        if 'content' in fields:
+            return queryset.select_related('text')
+        if 'text' in fields:
+            return queryset.defer('text__content')
+        return queryset
     
-    @action(detail=True, methods=['get'])
+    def retrieve(self, request, *args, **kwargs):
+        """教材の取得（変更が無ければ 304、キャッシュ済みなら DB に触れない）"""
+        build = lambda: super(ReadingMaterialViewSet, self).retrieve(request, *args, **kwargs).data
+        return conditional_response(request, f"material:{kwargs['pk']}", 'retrieve', build)
+
+    @action(detail=True, methods=['get'], serializer_class=QuestionSerializer)
     def questions(self, request, pk=None):
         """特定の教材の問題一覧を取得"""
-        material = self.get_object()
-        questions = Question.objects.filter(material=material).order_by('order')
-        serializer = QuestionSerializer(questions, many=True)
-        return Response(serializer.data)
+        def build():
+            material = self.get_object()
+            questions = self.plan_queryset(Question.objects.filter(material=material).order_by('order'))
+            return self.get_serializer(questions, many=True).data
+        return conditional_response(request, f'material:{pk}', 'questions', build)
     
     @action(detail=True, methods=['get'])
+    def gradebook(self, request, pk=None):
+        """教材の成績表（学生ごとの回答数・正答数・最終更新）"""
+        return conditional_response(request, f'gradebook:material:{pk}', 'material', lambda: material_gradebook(pk))
+
+    @action(detail=False, methods=['get'], url_path='gradebook')
+    def group_gradebook(self, request):
+        """グループの成績表（学生×教材）"""
+        group_id = request.query_params.get('group_id')
+        if not group_id or not group_id.isdigit():
+            return Response({'error': 'group_id を指定してください'}, status=status.HTTP_400_BAD_REQUEST)
+        return conditional_response(
+            request, f'gradebook:group:{group_id}', 'group', lambda: group_gradebook(int(group_id)),
+        )
+
+    @action(detail=True, methods=['get'], serializer_class=AnnotationSerializer,
+            cursor_ordering=('start_position', 'end_position', 'id'))
     def annotations(self, request, pk=None):
-        """特定の教材の注釈一覧を取得"""
+        """特定の教材の注釈一覧を取得
+
+        start/end を指定するとその範囲に重なる注釈のみを開始位置順に、カーソルページネーションで返す。
+        """
         material = self.get_object()
         student_id = request.query_params.get('student_id')
-        if student_id:
+        window = _parse_window(request)
+        if window:
+            # 区間木で重なる注釈の開始位置の下限を求め、索引の [下限, end) の範囲だけを読む
+            # （id を IN に並べないので、広い範囲でもパラメータ数・レスポンスがページサイズで収まる）
+            hits = get_annotation_index(material.pk).overlap(*window)
+            if student_id:
+                hits = [hit for hit in hits if str(hit[3]) == student_id]
+            lowest = hits[0][0] if hits else window[1]
+            annotations = Annotation.objects.filter(
+                material=material, start_position__gte=lowest, start_position__lt=window[1], end_position__gt=window[0],
+            )
+            if student_id:
+                annotations = annotations.filter(student_id=student_id)
+            page = self.paginate_queryset(self.plan_queryset(annotations))
+            return self.get_paginated_response(self.get_serializer(page, many=True).data)
+        elif student_id:
             annotations = Annotation.objects.filter(material=material, student_id=student_id)
         else:
             annotations = Annotation.objects.filter(material=material)
-        serializer = AnnotationSerializer(annotations, many=True)
+        serializer = self.get_serializer(self.plan_queryset(annotations), many=True)
         return Response(serializer.data)
 
-class QuestionViewSet(viewsets.ModelViewSet):
+    @action(detail=True, methods=['get'])
+    def annotation_coverage(self, request, pk=None):
+        """本文の区間ごとに、注釈を付けた学生の人数を集計（ヒートマップ用）"""
+        material = self.get_object()
+        window = _parse_window(request) or (0, material.text.length)
+        annotation_type = request.query_params.get('annotation_type')
+        hits = get_annotation_index(material.pk).overlap(*window)
+        if annotation_type:
+            hits = [hit for hit in hits if hit[4] == annotation_type]
+        clipped = [(max(hit[0], window[0]), min(hit[1], window[1]), hit[3]) for hit in hits]
+        segments = [
+            {'start': start, 'end': end, 'count': len(students)}
+            for start, end, students in coverage(clipped, key=lambda item: item[2])
+        ]
+        return Response({
+            'material': material.pk,
+            'start': window[0],
+            'end': window[1],
+            'max_count': max((segment['count'] for segment in segments), default=0),
+            'segments': segments,
+        })
+
+    @action(detail=False, methods=['post'], url_path='import')
+    def import_bundle(self, request):
+        """教材と問題をまとめて取り込む（external_key が同じものは更新、何度送っても結果は同じ）
+
+        JSON 本文のほか、?type=yaml / csv と ?group= を付けてファイルの中身をそのまま送れる。
+        """
+        fmt = request.query_params.get('type', 'json')
+        try:
+            if fmt == 'json':
+                data = request.data
+            else:
+                data = parse_bundle(request.body.decode('utf-8'), fmt)
+            bundle = validate_bundle(data, group=request.query_params.get('group'))
+        except BundleError as error:
+            return Response({'error': '取り込みデータが不正です', 'details': error.errors},
+                            status=status.HTTP_400_BAD_REQUEST)
+        except (ValueError, KeyError) as error:
+            return Response({'error': f'取り込みデータを読み込めません: {error}'}, status=status.HTTP_400_BAD_REQUEST)
+        created_by = request.user if request.user.is_authenticated else None
+        summary = import_bundle(bundle, created_by=created_by)
+        return Response(summary, status=status.HTTP_200_OK)
+
+    @action(detail=True, methods=['get'], serializer_class=TextSegmentSerializer)
+    def segments(self, request, pk=None):
+        """本文を文単位の区切りで少しずつ取得（?from=通し番号&limit=件数、長い本文の遅延読み込み用）"""
+        try:
+            start = max(int(request.query_params.get('from', 0)), 0)
+            limit = min(max(int(request.query_params.get('limit', SEGMENT_PAGE_SIZE)), 1), SEGMENT_MAX_PAGE_SIZE)
+        except ValueError:
+            return Response({'error': 'from / limit は整数で指定してください'}, status=status.HTTP_400_BAD_REQUEST)
+
+        def build():
+            index = self._segment_index(pk)
+            if index is None:
+                raise _NotSegmented
+            total = len(index)
+            rows = TextSegment.objects.filter(material_id=pk, position__gte=start, position__lt=start + limit)
+            return {
+                'material': int(pk),
+                'total': total,
+                'from': start,
+                'next': start + limit if start + limit < total else None,
+                'segments': self.get_serializer(rows.order_by('position'), many=True).data,
+            }
+        try:
+            return conditional_response(request, f'material:{pk}', 'segments', build)
+        except _NotSegmented:
+            return _not_segmented_response()
+
+    @action(detail=True, methods=['get'])
+    def locate(self, request, pk=None):
+        """本文中の位置を区切り（ID・段落・区切り内の位置）に変換
+
+        ?offsets=10,250 で任意の位置、?student_id= でその学生の注釈、?answer_id= で回答の引用箇所を変換する。
+        """
+        index = self._segment_index(pk)
+        if index is None:
+            return _not_segmented_response()
+        response = {'material': int(pk)}
+        offsets = request.query_params.get('offsets')
+        if offsets:
+            try:
+                offsets = [int(offset) for offset in offsets.split(',')]
+            except ValueError:
+                return Response({'error': 'offsets は整数のカンマ区切りで指定してください'}, status=status.HTTP_400_BAD_REQUEST)
+            length = ReadingMaterial.objects.filter(pk=pk).values_list('text__length', flat=True).first()
+            if any(offset < 0 or offset > length for offset in offsets):
+                return Response({'error': f'offsets は 0 以上 {length} 以下で指定してください'}, status=status.HTTP_400_BAD_REQUEST)
+            response['offsets'] = [index.describe(offset) for offset in offsets]
+        student_id = request.query_params.get('student_id')
+        if student_id:
+            rows = Annotation.objects.filter(material_id=pk, student_id=student_id).values_list(
+                'id', 'start_position', 'end_position',
+            )
+            response['annotations'] = [
+                {'id': pk_, 'start': index.describe(start), 'end': index.describe(end)} for pk_, start, end in rows
+            ]
+        answer_id = request.query_params.get('answer_id')
+        if answer_id:
+            citations = StudentAnswer.objects.filter(pk=answer_id, question__material_id=pk).values_list(
+                'citations', flat=True,
+            ).first()
+            if isinstance(citations, dict):
+                citations = [citations]
+            response['citations'] = [
+                {**citation, 'start_segment': index.describe(citation['start']), 'end_segment': index.describe(citation['end'])}
+                for citation in citations or []
+                if isinstance(citation, dict) and isinstance(citation.get('start'), int) and isinstance(citation.get('end'), int)
+            ]
+        return Response(response)
+
+    @action(detail=True, methods=['get'])
+    def cited_passages(self, request, pk=None):
+        """よく引用される文（集計表から引用数の多い順、?limit= 件）"""
+        limit = request.query_params.get('limit', '10')
+        if not limit.isdigit():
+            return Response({'error': 'limit は整数で指定してください'}, status=status.HTTP_400_BAD_REQUEST)
+        limit = min(max(int(limit), 1), 100)
+        return conditional_response(request, f'cited:{pk}', 'passages', lambda: most_cited_passages(int(pk), limit))
+
+    def _segment_index(self, pk):
+        """教材の SegmentIndex。区切りが未作成なら None（GET では作らず、segment_materials コマンドに任せる）"""
+        index = get_segment_index(pk)
+        if not len(index) and self.get_object().content.strip():
+            return None
+        return index
+
+
+class _NotSegmented(Exception):
+    """区切りが未作成の教材（キャッシュせずに 409 を返す）"""
+
+
+def _not_segmented_response():
+    return Response(
+        {'error': '本文の区切りが未作成です（segment_materials コマンドで作成してください）'},
+        status=status.HTTP_409_CONFLICT,
+    )
+
+def _parse_window(request):
+    """?start=&end= で指定された本文の範囲（未指定なら None）"""
+    start = request.query_params.get('start')
+    end = request.query_params.get('end')
+    if start is None and end is None:
+        return None
+    try:
+        start = int(start) if start is not None else 0
+        end = int(end) if end is not None else sys.maxsize
+    except ValueError:
+        raise ValidationError({'start': '整数で指定してください'})
+    if start < 0 or end <= start:
+        raise ValidationError({'end': 'start より大きい値を指定してください'})
+    return start, end
+
+class QuestionViewSet(QueryPlanMixin, viewsets.ModelViewSet):
     queryset = Question.objects.all()
     serializer_class = QuestionSerializer
     permission_classes = [AllowAny]
+    cursor_ordering = ('id',)
 
-class StudentAnswerViewSet(viewsets.ModelViewSet):
+class StudentAnswerViewSet(QueryPlanMixin, viewsets.ModelViewSet):
     queryset = StudentAnswer.objects.all()
     serializer_class = StudentAnswerSerializer
     permission_classes = [AllowAny]
+    cursor_ordering = ('-submitted_at', '-id')
+    prefetch_related_fields = ('patches',)
     
     def create(self, request, *args, **kwargs):
-        """回答の作成または更新"""
-        student_id = request.data.get('student')
-        question_id = request.data.get('question')
-        
-        # 既存の回答があるかチェック
+        """回答の作成または更新（1回の upsert で保存）
+
+        リビジョンは自動保存と同じくクライアントが送る値を使い、省略時は保存済みの次の値にする。
+        保存済みより古いリビジョンは 409 と最新のリビジョンを返す。
+        """
+        data = {key: request.data.get(key) for key in request.data}
+        if data.get('revision') is None:
+            try:
+                data['revision'] = next_revision(int(data['student']), int(data['question']))
+            except (KeyError, TypeError, ValueError):
+                pass  # 不正な student / question は下のバリデーションで返す
+        draft = AnswerSubmitSerializer(data=data)
+        draft.is_valid(raise_exception=True)
+        student, question = draft.validated_data['student'], draft.validated_data['question']
         try:
-            existing_answer = StudentAnswer.objects.get(
-                student_id=student_id, 
-                question_id=question_id
+            saved = upsert_drafts(student, [draft.validated_data])
+        except IntegrityError:
+            return Response({'error': '学生または問題が存在しません'}, status=status.HTTP_400_BAD_REQUEST)
+        if not saved:
+            return Response(
+                {'error': 'リビジョンが最新ではありません', 'revision': head_revisions(student, [question])[question]},
+                status=status.HTTP_409_CONFLICT,
             )
-            # 既存の回答を更新
-            serializer = self.get_serializer(existing_answer, data=request.data, partial=True)
-            serializer.is_valid(raise_exception=True)
-            serializer.save()
-            return Response(serializer.data)
-        except StudentAnswer.DoesNotExist:
-            # 新しい回答を作成
-            return super().create(request, *args, **kwargs)
+        record_answer_edits(student, [draft.validated_data], saved, 'answer_submit')
+        created = saved[0][3]
+        serializer = self.get_serializer(self.get_queryset().get(pk=saved[0][0]))
+        return Response(serializer.data, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
 
-class AnnotationViewSet(viewsets.ModelViewSet):
+    @action(detail=False, methods=['post'], serializer_class=AutosaveSerializer)
+    def autosave(self, request):
+        """複数の問題の下書きをまとめて自動保存（古いリビジョンは破棄）"""
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data, code = autosave_drafts(serializer.validated_data)
+        return Response(data, status=code)
+
+    @action(detail=False, methods=['post'], serializer_class=AnswerPatchSerializer)
+    def patch(self, request):
+        """既知のリビジョンに対する差分で下書きを保存"""
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        ops = {name: data[name] for name in PATCHED_FIELDS if data.get(name)}
+        try:
+            revision = append_patch(data['student'], data['question'], data['base_revision'], data['revision'], ops)
+        except PatchConflict as exc:
+            return Response(
+                {'error': 'リビジョンが最新ではありません', 'revision': exc.revision},
+                status=status.HTTP_409_CONFLICT,
+            )
+        except ValueError as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        except IntegrityError:
+            return Response({'error': '学生または問題が存在しません'}, status=status.HTTP_400_BAD_REQUEST)
+        record(data['student'], 'answer_patch', question_id=data['question'], data={
+            'revision': revision, 'base_revision': data['base_revision'], 'ops': ops,
+        })
+        return Response({'question': data['question'], 'revision': revision})
+
+class AnnotationViewSet(QueryPlanMixin, viewsets.ModelViewSet):
     queryset = Annotation.objects.all()
     serializer_class = AnnotationSerializer
     permission_classes = [AllowAny]
 
-class CommentViewSet(viewsets.ModelViewSet):
+    @action(detail=False, methods=['post'], serializer_class=AnnotationSyncSerializer)
+    def sync(self, request):
+        """教材1つ分の注釈の作成・更新・削除をまとめて適用し、前回同期以降の変更を返す"""
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        student_id, material_id = data['student'], data['material']
+
+        since = None
+        if data.get('since'):
+            try:
+                since = read_sync_token(data['since'], material_id, student_id)
+            except signing.BadSignature:
+                return Response({'error': '同期トークンが不正です'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            created, updated, deleted = sync_annotations(
+                student_id, material_id, data['creates'], data['updates'], data['deletes'],
+            )
+        except IntegrityError:
+            return Response({'error': '学生または教材が存在しません'}, status=status.HTTP_400_BAD_REQUEST)
+
+        owned = Annotation.objects.filter(student_id=student_id, material_id=material_id)
+        response = {
+            'created': [{'client_id': client_id, 'id': pk} for client_id, pk in created.items()],
+            'updated': updated,
+            'deleted': deleted,
+        }
+        if data.get('since'):
+            # 他の端末での変更分と、削除を検出するための現存 id の一覧
+            changes = owned if since is None else owned.filter(updated_at__gt=since)
+            changes = list(self.plan_queryset(changes.order_by('updated_at', 'id'), AnnotationSerializer))
+            response['changes'] = AnnotationSerializer(changes, many=True).data
+            response['ids'] = list(owned.values_list('pk', flat=True))
+            latest = changes[-1].updated_at if changes else None
+        else:
+            latest = owned.aggregate(latest=Max('updated_at'))['latest']
+        # 壁時計ではなく実際に読んだ行の時刻から次回の基準を決める
+        response['sync_token'] = make_sync_token(material_id, student_id, next_sync_moment(latest, since))
+        return Response(response)
+
+class CommentViewSet(QueryPlanMixin, viewsets.ModelViewSet):
     queryset = Comment.objects.all()
     serializer_class = CommentSerializer
     permission_classes = [AllowAny]
 
-class NotificationViewSet(viewsets.ModelViewSet):
+    def perform_create(self, serializer):
+        """投稿者はログインユーザー（未ログインの開発時は author で指定）"""
+        if self.request.user.is_authenticated:
+            serializer.save(author=self.request.user)
+        else:
+            serializer.save(author_id=self.request.data.get('author'))
+
+class NotificationViewSet(QueryPlanMixin, viewsets.ModelViewSet):
     queryset = Notification.objects.all()
     serializer_class = NotificationSerializer
     permission_classes = [AllowAny]
@@ -85,7 +423,7 @@ class NotificationViewSet(viewsets.ModelViewSet):
         """未読通知の取得"""
         user_id = request.query_params.get('user_id')
         if user_id:
-            notifications = Notification.objects.filter(
+            notifications = self.get_queryset().filter(
                 recipient_id=user_id, 
                 is_read=False
             )
@@ -93,6 +431,318 @@ class NotificationViewSet(viewsets.ModelViewSet):
             return Response(serializer.data)
         return Response([])
 
+    @action(detail=False, methods=['get'])
+    def count(self, request):
+        """未読通知の件数のみを取得（バッジ表示用）"""
+        user_id = request.query_params.get('user_id')
+        if not user_id or not user_id.isdigit():
+            return Response({'unread': 0})
+        return Response({'unread': unread_count(int(user_id))})
+
+    @action(detail=False, methods=['post'])
+    def mark_all_read(self, request):
+        """未読通知を1回の UPDATE ですべて既読にする"""
+        user_id = request.data.get('user_id')
+        if not str(user_id or '').isdigit():
+            return Response({'error': 'user_id を指定してください'}, status=status.HTTP_400_BAD_REQUEST)
+        user_id = int(user_id)
+        updated = Notification.objects.filter(recipient_id=user_id, is_read=False).update(is_read=True)
+        reset_unread(user_id)
+        if updated:
+            publish_read_state(user_id, None, True)
+        return Response({'updated': updated, 'unread': 0})
+
+class SearchViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
+    """教材本文・回答・コメントの全文検索（関連度順）
+
+    ?q= 検索語（空白区切りで AND）、?kind=material,answer,comment、?material_id=、?group_id=、?user_id= で絞り込む。
+    """
+    queryset = SearchDocument.objects.all()
+    serializer_class = SearchResultSerializer
+    pagination_class = SearchPagination
+    permission_classes = [AllowAny]
+
+    def get_queryset(self):
+        query = self.request.query_params.get('q', '').strip()
+        if not query:
+            raise ValidationError({'q': '検索語を指定してください'})
+        queryset = search(query)
+        params = self.request.query_params
+        if params.get('kind'):
+            queryset = queryset.filter(kind__in=params['kind'].split(','))
+        for param, lookup in (('material_id', 'material_id'), ('group_id', 'material__group_id'), ('user_id', 'user_id')):
+            value = params.get(param)
+            if value:
+                if not value.isdigit():
+                    raise ValidationError({param: '整数で指定してください'})
+                queryset = queryset.filter(**{lookup: int(value)})
+        return queryset
+
+    def get_serializer_context(self):
+        return {**super().get_serializer_context(), 'query': self.request.query_params.get('q', '')}
+
+class ActivityViewSet(viewsets.GenericViewSet):
+    """学習中の操作ログ（授業の再生用）
+
+    POST: クライアント側の操作（問題の移動など）をまとめて送る。バッファに積むだけで 202 を返す。
+    GET: ?student_id= の操作を時刻順に再構成する。?since= / ?until=（既定は直近24時間）、
+    ?material_id=、?limit=（既定 5000）で絞り込む。
+    """
+    queryset = ActivityChunk.objects.all()
+    serializer_class = ActivityBatchSerializer
+    permission_classes = [AllowAny]
+
+    def create(self, request):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        now = timezone.now()
+        for event in data['events']:
+            # 端末の時計のずれで未来や大昔の時刻にならないようにする
+            at = min(max(event['at'] or now, now - timedelta(days=1)), now)
+            record(
+                data['student'], event['type'], material_id=data['material'], question_id=event['question'],
+                start=event['position'], at=at,
+            )
+        return Response({'accepted': len(data['events'])}, status=status.HTTP_202_ACCEPTED)
+
+    def list(self, request):
+        params = request.query_params
+        student_id, material_id = params.get('student_id', ''), params.get('material_id', '')
+        if not student_id.isdigit() or (material_id and not material_id.isdigit()):
+            return Response({'error': 'student_id（と material_id）を数値で指定してください'}, status=status.HTTP_400_BAD_REQUEST)
+        until = parse_datetime(params['until']) if params.get('until') else timezone.now()
+        since = parse_datetime(params['since']) if params.get('since') else until - timedelta(days=1)
+        if since is None or until is None:
+            return Response({'error': 'since / until は ISO 8601 形式で指定してください'}, status=status.HTTP_400_BAD_REQUEST)
+        since, until = (value if timezone.is_aware(value) else timezone.make_aware(value) for value in (since, until))
+        try:
+            limit = min(max(int(params.get('limit', 5000)), 1), 20000)
+        except ValueError:
+            return Response({'error': 'limit は数値で指定してください'}, status=status.HTTP_400_BAD_REQUEST)
+
+        events, truncated = session_events(
+            int(student_id), since, until, int(material_id) if material_id else None, limit,
+        )
+        counts = {}
+        for event in events:
+            counts[event[2]] = counts.get(event[2], 0) + 1
+        return Response({
+            'student': int(student_id),
+            'material': int(material_id) if material_id else None,
+            'since': since,
+            'until': until,
+            'truncated': truncated,
+            'counts': counts,
+            'sessions': [
+                {'started_at': started_at, 'ended_at': ended_at, 'event_count': count}
+                for started_at, ended_at, count in split_sessions(events)
+            ],
+            'events': [
+                {'at': at, 'material': material, 'type': kind, 'question': question, 'start': start, 'end': end, 'data': data}
+                for at, material, kind, question, start, end, data in events
+            ],
+        })
+
+class ProgressViewSet(viewsets.GenericViewSet):
+    """教員ダッシュボード（担当グループの教材ごとの完了率・コメント数）
+
+    GET: ?teacher_id=（ログイン中の教員なら省略可）。集計表 ProgressSummary だけを読む。
+    POST seen/: {material, student（省略可）} のコメントを確認済みにして未読数を 0 に戻す。
+    """
+    queryset = ProgressSummary.objects.all()
+    permission_classes = [AllowAny]
+
+    def list(self, request):
+        teacher_id = request.query_params.get('teacher_id')
+        if not teacher_id and request.user.is_authenticated:
+            teacher_id = str(request.user.pk)
+        if not teacher_id or not teacher_id.isdigit():
+            return Response({'error': 'teacher_id を指定してください'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(teacher_dashboard(int(teacher_id)))
+
+    @action(detail=False, methods=['post'])
+    def seen(self, request):
+        material_id, student_id = request.data.get('material'), request.data.get('student')
+        if not str(material_id or '').isdigit() or (student_id is not None and not str(student_id).isdigit()):
+            return Response({'error': 'material（と student）を数値で指定してください'}, status=status.HTTP_400_BAD_REQUEST)
+        updated = mark_seen(int(material_id), int(student_id) if student_id is not None else None)
+        return Response({'updated': updated})
+
+# --- 通知のプッシュ配信 ---
+SSE_HEARTBEAT_SECONDS = 15
+
+async def notification_stream(request):
+    """新しい通知と既読状態の変更を Server-Sent Events で配信（ASGI で動かすこと）"""
+    if settings.SERVER_MODE != 'asgi':
+        # sync ワーカーでは接続が切れるまでワーカーを1つ占有してしまう
+        return JsonResponse({'error': '通知のプッシュ配信は ASGI（SERVER_MODE=asgi）でのみ利用できます'}, status=501)
+    user_id = request.GET.get('user_id')
+    if not user_id or not user_id.isdigit():
+        return JsonResponse({'error': 'user_id を指定してください'}, status=400)
+    response = StreamingHttpResponse(_sse_events(user_channel(user_id)), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+async def _sse_events(channel):
+    events = get_pubsub().subscribe(channel)
+    pending = None
+    try:
+        yield 'retry: 5000\n\n'
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(events.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=SSE_HEARTBEAT_SECONDS)
+            if not done:
+                # 接続維持のためのコメント行
+                yield ': keep-alive\n\n'
+                continue
+            event = pending.result()
+            pending = None
+            yield f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+    finally:
+        if pending is not None:
+            pending.cancel()
+        await events.aclose()
+
+# --- 非同期ビュー（SERVER_MODE=asgi のとき reading/urls.py の async_urlpatterns で割り当てる） ---
+# 速く返せるリクエストだけをイベントループ上で処理し、それ以外（ブラウザブル API、
+# ?fields= などの指定、キャッシュに無いレスポンス、更新系）は同期の DRF ビューに任せる。
+# DB には reading.asyncdb の区間の中でだけ触れる。
+
+def autosave_drafts(validated_data):
+    """自動保存の本体（同期・非同期のビューで共有）。(レスポンスのデータ, ステータス) を返す"""
+    drafts = validated_data['drafts']
+    try:
+        saved = upsert_drafts(validated_data['student'], drafts)
+    except IntegrityError:
+        return {'error': '学生または問題が存在しません'}, status.HTTP_400_BAD_REQUEST
+    record_answer_edits(validated_data['student'], drafts, saved)
+    stale = sorted({d['question'] for d in drafts} - {question_id for _, question_id, _, _ in saved})
+    # 破棄した下書きは保存済みのリビジョンを返し、クライアントはそれより大きいリビジョンで送り直す
+    current = head_revisions(validated_data['student'], stale) if stale else {}
+    return {
+        'saved': [
+            {'id': pk, 'question': question_id, 'revision': revision}
+            for pk, question_id, revision, _ in saved
+        ],
+        'stale': stale,
+        'current': [{'question': question_id, 'revision': current[question_id]} for question_id in sorted(current)],
+    }, status.HTTP_200_OK
+
+def with_sync_fallback(handler, sync_view):
+    """handler が None を返したリクエストを sync_view（DRF のビュー）で処理する非同期ビューを作る"""
+    async def view(request, **kwargs):
+        try:
+            await CachedTokenAuthentication().authenticate_async(request)
+        except AuthenticationFailed as exc:
+            response = _json_response({'detail': str(exc.detail)}, status.HTTP_401_UNAUTHORIZED)
+            response['WWW-Authenticate'] = CachedTokenAuthentication.keyword
+            return response
+        response = await handler(request, **kwargs)
+        if response is None:
+            response = await run_sync(_render_sync_view, sync_view, request, **kwargs)
+        return response
+    # DRF のビューと同じく CSRF の確認は認証クラスに任せる
+    view.csrf_exempt = True
+    return view
+
+def _render_sync_view(sync_view, request, **kwargs):
+    response = sync_view(request, **kwargs)
+    if hasattr(response, 'render'):
+        response.render()
+    return response
+
+def _json_response(data, code=status.HTTP_200_OK):
+    # DRF の JSONRenderer と同じ本文にする
+    response = HttpResponse(JSONRenderer().render(data), content_type='application/json', status=code)
+    response['Vary'] = 'Accept'
+    return response
+
+def _plain_get(request, *sparse):
+    """JSON を返す素の GET か（ブラウザブル API や、指定したクエリパラメータ付きは同期のビューへ）"""
+    return (
+        request.method in ('GET', 'HEAD')
+        and 'text/html' not in request.headers.get('Accept', '')
+        and not any(name in request.GET for name in ('format', *sparse))
+    )
+
+def _sparse(request):
+    # ?fields= / ?omit= の絞り込みは同期のビューで作る（キャッシュ済みなら非同期のビューでも返せる）
+    return 'fields' in request.GET or 'omit' in request.GET
+
+async def material_retrieve_async(request, pk):
+    """教材の取得: キャッシュに無ければ非同期 ORM で読み、同期のビューと同じデータをキャッシュする"""
+    if not _plain_get(request):
+        return None
+
+    async def build():
+        queryset = get_query_plan(ReadingMaterialSerializer).apply(ReadingMaterial.objects.all())
+        async with db_slot():
+            try:
+                material = await queryset.aget(pk=pk)
+            except ReadingMaterial.DoesNotExist:
+                return None  # 404 は同期のビューに任せる
+        return ReadingMaterialSerializer(material).data
+    return await cached_response_async(request, f'material:{pk}', 'retrieve', None if _sparse(request) else build)
+
+async def material_questions_async(request, pk):
+    """教材の問題一覧: キャッシュに無ければ非同期 ORM で読み、同期のビューと同じデータをキャッシュする"""
+    if not _plain_get(request):
+        return None
+
+    async def build():
+        async with db_slot():
+            if not await ReadingMaterial.objects.filter(pk=pk).aexists():
+                return None
+            questions = [question async for question in Question.objects.filter(material_id=pk).order_by('order')]
+        return QuestionSerializer(questions, many=True).data
+    return await cached_response_async(request, f'material:{pk}', 'questions', None if _sparse(request) else build)
+
+async def autosave_async(request):
+    """下書きの自動保存: 検証はイベントループ上で行い、UPSERT だけ DB の区間で実行する
+
+    upsert_drafts は生 SQL（INSERT ... ON CONFLICT）で、Django 4.2 には非同期のカーソルが無いため
+    スレッドで実行する（run_sync）。イベントループを塞がないことと、同時接続数の制限が目的。
+    """
+    if request.method != 'POST' or request.content_type != 'application/json':
+        return None
+    try:
+        payload = json.loads(request.body)
+    except ValueError:
+        return None
+    serializer = AutosaveSerializer(data=payload)
+    if not serializer.is_valid():
+        return _json_response(serializer.errors, status.HTTP_400_BAD_REQUEST)
+    data, code = await run_sync(autosave_drafts, serializer.validated_data)
+    return _json_response(data, code)
+
+async def notifications_unread_async(request):
+    """未読通知の取得（非同期 ORM）"""
+    if not _plain_get(request):
+        return None
+    user_id = request.GET.get('user_id')
+    if not user_id:
+        return _json_response([])
+    if not user_id.isdigit():
+        return None
+    queryset = get_query_plan(NotificationSerializer).apply(
+        Notification.objects.filter(recipient_id=user_id, is_read=False)
+    )
+    async with db_slot():
+        notifications = [notification async for notification in queryset]
+    return _json_response(NotificationSerializer(notifications, many=True).data)
+
+async def notifications_count_async(request):
+    """未読通知の件数（キャッシュに無ければ非同期 ORM で数える）"""
+    if not _plain_get(request):
+        return None
+    user_id = request.GET.get('user_id')
+    if not user_id or not user_id.isdigit():
+        return _json_response({'unread': 0})
+    return _json_response({'unread': await unread_count_async(int(user_id))})
+
 from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.authtoken.models import Token
 from rest_framework.response import Response
@@ -152,7 +802,48 @@ def register_user(request):
 def logout_user(request):
     """ログアウト"""
     try:
+        invalidate_token(request.user.auth_token.key)
         request.user.auth_token.delete()
         return Response({'message': 'ログアウトしました'})
     except:
         return Response({'error': 'ログアウトに失敗しました'}, status=400)
+
+# --- エクスポート ---
+@api_view(['GET'])
+@permission_classes([AllowAny])  # 開発用：本番では教員のみに制限する
+def export_results(request, kind):
+    """回答・注釈・コメントを CSV / JSONL でストリーミング出力"""
+    output = request.query_params.get('output', 'csv')
+    if kind not in EXPORTS or output not in FORMATS:
+        return Response({'error': '出力の種類または形式が不正です'}, status=status.HTTP_400_BAD_REQUEST)
+    filters = {}
+    for name in ('material_id', 'group_id'):
+        value = request.query_params.get(name)
+        if value is not None:
+            if not value.isdigit():
+                return Response({'error': f'{name} は整数で指定してください'}, status=status.HTTP_400_BAD_REQUEST)
+            filters[name] = int(value)
+    response = StreamingHttpResponse(iter_export(kind, output, **filters), content_type=FORMATS[output])
+    response['Content-Disposition'] = f'attachment; filename="{kind}.{output}"'
+    return response
+
+def material_text(request, digest):
+    """教材本文をハッシュで取得する。内容はハッシュで決まるので、クライアントは無期限にキャッシュしてよい"""
+    etag = quote_etag(digest)
+    if etag_matches(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        text = MaterialText.objects.filter(pk=digest).values('content', 'length').first()
+        if text is None:
+            return JsonResponse({'error': '本文が見つかりません'}, status=status.HTTP_404_NOT_FOUND)
+        response = JsonResponse({'hash': digest, **text}, json_dumps_params={'ensure_ascii': False})
+    response['ETag'] = etag
+    response['Cache-Control'] = f'public, max-age={TEXT_MAX_AGE}, immutable'
+    return response
+
+def metrics_endpoint(request):
+    """計測値を Prometheus のテキスト形式で返す（PROFILING_METRICS_TOKEN を設定した場合は Bearer 認証）"""
+    token = getattr(settings, 'PROFILING_METRICS_TOKEN', '')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return HttpResponse(status=401)
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -3,6 +3,9 @@ ASGI config for reading_app_backend project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+The notification push stream (/api/notifications/stream/) is an async
+Server-Sent Events view and should be served through this entry point.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -30,7 +30,10 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    # WhiteNoise の非同期対応版（ASGI でリクエストを同期スレッドに移さない）
+    'reading.middleware.StaticFilesMiddleware',
+    # API のレスポンスを brotli / gzip で圧縮する（静的ファイルは WhiteNoise が圧縮済みのものを返す）
+    'reading.middleware.CompressionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -38,9 +41,21 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # PROFILING_ENABLED が False のときは読み込まれない
+    'reading.middleware.ProfilingMiddleware',
 ]
 
-ROOT_URLCONF = 'reading_app_backend.urls'
+# 実行モード: 'wsgi'（gunicorn の sync ワーカー）または 'asgi'（uvicorn ワーカー）。gunicorn.conf.py も参照
+SERVER_MODE = os.environ.get('SERVER_MODE', 'wsgi')
+# ASGI では教材・問題・自動保存・未読通知を非同期ビューで返す
+ASYNC_VIEWS = SERVER_MODE == 'asgi'
+# 非同期ビューが同時に使う DB 接続の上限（ワーカーあたり）。DB_POOL_MAX_SIZE 以下にする
+ASYNC_DB_CONCURRENCY = int(os.environ.get('ASYNC_DB_CONCURRENCY', '8'))
+# DB 接続のプール（ASGI では既定で使う）と、プールを使わないときの永続接続の秒数。DATABASES を参照
+DB_POOL = os.environ.get('DB_POOL', str(SERVER_MODE == 'asgi')) == 'True'
+DB_CONN_MAX_AGE = int(os.environ.get('DB_CONN_MAX_AGE', '600'))
+
+ROOT_URLCONF = 'reading_app_backend.urls_asgi' if ASYNC_VIEWS else 'reading_app_backend.urls'
 
 TEMPLATES = [
     {
@@ -63,11 +78,27 @@ WSGI_APPLICATION = 'reading_app_backend.wsgi.application'
 # ★★★ 重要な修正：本番DBとローカルDBを適切に分ける ★★★
 if 'DATABASE_URL' in os.environ:
     # 本番環境（Railway）: DATABASE_URL環境変数が存在する場合
+    # 接続の再利用:
+    # - DB_POOL=True: プロセス内のプール（reading.pooled_postgresql）。sync / ASGI どちらのワーカーでも使え、
+    #   ワーカーあたりの接続数は DB_POOL_MAX_SIZE まで。Django が閉じた接続はプールへ返る（conn_max_age=0）
+    # - DB_POOL=False: スレッドごとの永続接続（DB_CONN_MAX_AGE 秒）。ASGI ではリクエストごとに
+    #   スレッドが変わり接続が溜まるので、持ち越さない
+    # どちらも使う前に疎通を確認する（health checks）
     DATABASES = {
         'default': dj_database_url.config(
-            default=os.environ['DATABASE_URL']
+            default=os.environ['DATABASE_URL'],
+            conn_max_age=0 if DB_POOL or SERVER_MODE == 'asgi' else DB_CONN_MAX_AGE,
+            conn_health_checks=True,
         )
     }
+    if DB_POOL:
+        DATABASES['default']['ENGINE'] = 'reading.pooled_postgresql'
+        DATABASES['default'].setdefault('OPTIONS', {})['pool'] = {
+            'max_size': int(os.environ.get('DB_POOL_MAX_SIZE', '10')),
+            'timeout': float(os.environ.get('DB_POOL_TIMEOUT', '5')),
+            'max_idle': float(os.environ.get('DB_POOL_MAX_IDLE', '300')),
+            'max_lifetime': float(os.environ.get('DB_POOL_MAX_LIFETIME', '3600')),
+        }
 else:
     # ローカル環境：SQLiteを使用
     DATABASES = {
@@ -77,6 +108,31 @@ else:
         }
     }
 
+# キャッシュ：レスポンスキャッシュの世代キー・トークン認証・セッションは全ワーカーで共有する必要がある
+# REDIS_URL があれば Redis、無ければ本番は DB のキャッシュ表（createcachetable で作る）、
+# ローカル開発（DEBUG）は単一プロセスなのでプロセス内メモリを使う
+REDIS_URL = os.environ.get('REDIS_URL', '')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+elif DEBUG:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'reading_cache',
+        }
+    }
+
 AUTH_USER_MODEL = 'reading.CustomUser'
 
 AUTHENTICATION_BACKENDS = [
@@ -85,17 +141,66 @@ AUTHENTICATION_BACKENDS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
+        # トークンを先に判定する（トークンで来たリクエストはセッションを読まない）
+        'reading.authentication.CachedTokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',
-        'rest_framework.authentication.TokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    'DEFAULT_PAGINATION_CLASS': 'reading.pagination.KeysetCursorPagination',
+    'PAGE_SIZE': 50,
 }
 
-SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+# 通知のプッシュ配信（SSE、ASGI のみ）に使う Pub/Sub
+# プロセス内の配信は同じワーカーの接続にしか届かないので、REDIS_URL があるときや
+# ASGI のワーカーが複数のとき（gunicorn.conf.py と同じく WEB_CONCURRENCY か CPU 数）は Redis を使う
+_ASGI_WORKERS = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1)) if SERVER_MODE == 'asgi' else 1
+PUBSUB_BACKEND = os.environ.get(
+    'PUBSUB_BACKEND',
+    'reading.pubsub.RedisPubSub' if REDIS_URL or _ASGI_WORKERS > 1 else 'reading.pubsub.InProcessPubSub',
+)
+PUBSUB_REDIS_URL = os.environ.get('PUBSUB_REDIS_URL', REDIS_URL or 'redis://localhost:6379/0')
+
+# コメント通知の生成: 'background'（ワーカースレッドでまとめて処理）または 'immediate'
+COMMENT_FANOUT_MODE = os.environ.get('COMMENT_FANOUT_MODE', 'background')
+
+# 自動保存・差分保存後の全文検索の索引と引用箇所の更新: 'background'（ワーカースレッドでまとめて処理）/ 'immediate' / 'off'
+ANSWER_REFRESH_MODE = os.environ.get('ANSWER_REFRESH_MODE', 'background')
+ANSWER_REFRESH_SECONDS = float(os.environ.get('ANSWER_REFRESH_SECONDS', '2'))
+
+# 注釈の同期トークン: 読んだ最大の更新日時からこの秒数だけ戻す（コミットの遅れた並行書き込みを取りこぼさない）
+ANNOTATION_SYNC_WINDOW_SECONDS = float(os.environ.get('ANNOTATION_SYNC_WINDOW_SECONDS', '5'))
+
+# 操作ログ（授業の再生用）: 'background'（バッファして FLUSH_SECONDS ごとにまとめて追記）/ 'immediate' / 'off'
+ACTIVITY_LOG_MODE = os.environ.get('ACTIVITY_LOG_MODE', 'background')
+ACTIVITY_FLUSH_SECONDS = float(os.environ.get('ACTIVITY_FLUSH_SECONDS', '5'))
+# バッファの上限（超えたイベントはリクエストを待たせずに捨て、reading_activity_dropped_total で数える）
+ACTIVITY_QUEUE_SIZE = int(os.environ.get('ACTIVITY_QUEUE_SIZE', '100000'))
+
+# レスポンスの圧縮（brotli パッケージがあれば br、無ければ gzip）。小さい本文は圧縮しない
+RESPONSE_COMPRESSION = os.environ.get('RESPONSE_COMPRESSION', 'True') == 'True'
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.environ.get('RESPONSE_COMPRESSION_MIN_BYTES', '512'))
+RESPONSE_GZIP_LEVEL = int(os.environ.get('RESPONSE_GZIP_LEVEL', '6'))
+RESPONSE_BROTLI_QUALITY = int(os.environ.get('RESPONSE_BROTLI_QUALITY', '5'))
+
+# リクエストの計測（/api/metrics/ で Prometheus 形式で公開）
+# 処理時間は全リクエスト、クエリ・レンダリング・サイズは SAMPLE_RATE の割合で計測する
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', 'False') == 'True'
+PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', '0.01'))
+PROFILING_SLOW_REQUEST_MS = int(os.environ.get('PROFILING_SLOW_REQUEST_MS', '1000'))
+PROFILING_METRICS_TOKEN = os.environ.get('PROFILING_METRICS_TOKEN', '')
+
+# トークン認証のキャッシュ（秒）。プロセス内 LRU の TTL は他プロセスでの失効の反映が遅れる最大時間
+# （共有キャッシュを使わない構成では、キャッシュ全体がこの TTL で DB を引き直す。
+#   REDIS_URL が無く DatabaseCache を使う構成では、LRU の期限切れのたびにキャッシュ表への1クエリがかかる）
+AUTH_TOKEN_CACHE_TTL = int(os.environ.get('AUTH_TOKEN_CACHE_TTL', '300'))
+AUTH_TOKEN_LOCAL_TTL = int(os.environ.get('AUTH_TOKEN_LOCAL_TTL', '5'))
+
+# セッションはキャッシュ経由で読み、変更があったときだけ書き込む
+SESSION_ENGINE = os.environ.get('SESSION_ENGINE', 'django.contrib.sessions.backends.cached_db')
 SESSION_COOKIE_AGE = 86400
-SESSION_SAVE_EVERY_REQUEST = True
+SESSION_SAVE_EVERY_REQUEST = os.environ.get('SESSION_SAVE_EVERY_REQUEST', 'False') == 'True'
 
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
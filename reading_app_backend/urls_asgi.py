@@ -0,0 +1,11 @@
+"""
+URL configuration used when SERVER_MODE=asgi.
+
+The hot read/autosave endpoints are routed to async views first; everything
+else falls through to the regular URL configuration.
+"""
+from reading.urls import async_urlpatterns
+
+from .urls import urlpatterns as sync_urlpatterns
+
+urlpatterns = async_urlpatterns + sync_urlpatterns